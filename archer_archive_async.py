@@ -0,0 +1,162 @@
+"""
+Asyncio execution core for the shell commands run by the archer archiving script
+Commands are run with asyncio.create_subprocess_exec on one event loop, in a background thread, shared by all the threads archiving projects,
+so the waits of many commands (ssh, rsync, upload) overlap without a blocked thread per pipe. The number of commands of each stage
+running at once is already limited by the stage slots of the threads running them (ArcherArchive.stage_slots). Each command:
+- has its output read line by line as it is produced, keeping at most config.subprocess_output_limit bytes of stdout
+(the most recent lines, so the exit status echoed at the end of a command is kept) and 1MB of stderr
+- is killed if it runs for longer than the timeout of its stage (config.subprocess_timeouts), or if it is cancelled
+
+Threads run a command with AsyncRunner.run(), which submits the coroutine to the loop with asyncio.run_coroutine_threadsafe and waits for it.
+Needs python 3.8 or later (see config.subprocess_engine).
+"""
+
+import asyncio, collections, os, signal, sys, threading
+import archer_archive_config as config
+
+STDERR_LIMIT = 1024 * 1024
+
+
+class CommandResult(collections.namedtuple("CommandResult", ["stdout", "stderr", "returncode", "timed_out", "truncated"])):
+	"""
+	Result of a command. returncode is None if the command was killed (timed out or cancelled)
+	truncated is True if the start of stdout was dropped to stay within the output limit
+	"""
+	__slots__ = ()
+
+
+def _text(data):
+	# decoded as Popen(universal_newlines=True) would, with \r\n and \r translated to \n
+	return data.decode("utf-8", "replace").replace("\r\n", "\n").replace("\r", "\n")
+
+
+async def _read_lines(stream, limit):
+	"""
+	Read stream line by line until it ends, keeping the most recent lines up to limit bytes
+	Returns (bytes kept, True if earlier lines were dropped)
+	"""
+	lines = collections.deque()
+	size = 0
+	truncated = False
+	# chunks of the line not yet ended, joined once its newline arrives so a long line (e.g. the null separated inventory) is
+	# not copied on every read
+	partial = []
+	while True:
+		chunk = await stream.read(64 * 1024)
+		if not chunk:
+			break
+		# lines are split here rather than with readline(), so a line longer than the StreamReader limit does not raise an error
+		if b"\n" not in chunk:
+			partial.append(chunk)
+			continue
+		first, *complete, last = chunk.split(b"\n")
+		partial.append(first)
+		for line in [b"".join(partial)] + complete:
+			lines.append(line + b"\n")
+			size += len(line) + 1
+		partial = [last] if last else []
+		while size > limit and len(lines) > 1:
+			size -= len(lines.popleft())
+			truncated = True
+	if partial:
+		lines.append(b"".join(partial))
+	return b"".join(lines), truncated
+
+
+class AsyncRunner():
+	"""
+	Event loop (in a background thread) which runs shell commands
+	timeouts is the seconds after which a command of each stage is killed ("other" for commands run outside a stage)
+	"""
+	def __init__(self, timeouts=None, output_limit=None):
+		# before python 3.8 the child watcher only works with an event loop in the main thread, so every command would fail
+		if sys.version_info < (3, 8):
+			raise RuntimeError("the asyncio subprocess engine needs python 3.8 or later, set subprocess_engine to popen")
+		self.timeouts = config.subprocess_timeouts if timeouts is None else timeouts
+		self.output_limit = config.subprocess_output_limit if output_limit is None else output_limit
+		self.loop = asyncio.new_event_loop()
+		self._tasks = set()
+		self.thread = threading.Thread(target=self.loop.run_forever, name="archer_archive_async", daemon=True)
+		self.thread.start()
+
+	async def run_command(self, command, stdin=None, stage=None):
+		"""
+		Run command with /bin/bash, sending stdin (str, optional) to it. Returns a CommandResult
+		stage is the stage the command is run for, which sets its timeout
+		"""
+		task = asyncio.current_task()
+		self._tasks.add(task)
+		proc = await asyncio.create_subprocess_exec("/bin/bash", "-c", command,
+			stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+			stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+
+		async def write_stdin():
+			if stdin is not None:
+				try:
+					proc.stdin.write(stdin.encode())
+					await proc.stdin.drain()
+					proc.stdin.close()
+				except (BrokenPipeError, ConnectionResetError):
+					# the command exited before reading all of stdin (e.g. ssh or cd failed), as with Popen.communicate the
+					# failure is reported by its exit status
+					pass
+
+		async def communicate():
+			_, (out, truncated), (err, _) = await asyncio.gather(
+				write_stdin(), _read_lines(proc.stdout, self.output_limit), _read_lines(proc.stderr, STDERR_LIMIT))
+			await proc.wait()
+			return out, err, truncated
+
+		timeout = self.timeouts.get(stage if stage is not None else "other")
+		try:
+			out, err, truncated = await asyncio.wait_for(communicate(), timeout)
+		except asyncio.TimeoutError:
+			self._kill(proc)
+			await proc.wait()
+			return CommandResult("", "command timed out after %s seconds" % (timeout), None, True, False)
+		except asyncio.CancelledError:
+			self._kill(proc)
+			await proc.wait()
+			raise
+		finally:
+			self._tasks.discard(task)
+		err = _text(err)
+		if truncated:
+			err += "\nstdout truncated to the last %s bytes" % (self.output_limit)
+		return CommandResult(_text(out), err, proc.returncode, False, truncated)
+
+	def _kill(self, proc):
+		# the command is the leader of its own process group, so the processes it started (e.g. ssh, rsync) are killed with it
+		try:
+			os.killpg(proc.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+
+	def run(self, command, stdin=None, stage=None):
+		"""
+		Run command on the event loop from another thread and wait for it. Returns a CommandResult
+		"""
+		return asyncio.run_coroutine_threadsafe(self.run_command(command, stdin, stage), self.loop).result()
+
+	async def _cancel_all(self):
+		tasks = list(self._tasks)
+		for task in tasks:
+			task.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+
+	def cancel_all(self):
+		"""
+		Cancel all running commands and wait for their processes to be killed
+		"""
+		asyncio.run_coroutine_threadsafe(self._cancel_all(), self.loop).result()
+
+	def close(self):
+		"""
+		Kill any commands still running and stop the event loop
+		"""
+		if self.loop.is_closed():
+			return
+		self.cancel_all()
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+		self.loop.close()
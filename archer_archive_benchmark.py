@@ -0,0 +1,306 @@
+"""
+Benchmarks for the archer archiving script
+Run with python archer_archive_benchmark.py <benchmark> -h for the options of each benchmark
+
+compression
+	Compares the parallel compression engine (archer_archive_compress) with the single threaded tar -czf command used by
+	create_project_tar(), on a synthetic project folder of FASTQ-like files
+
+logging
+	Compares the time taken per log message by /usr/bin/logger (run in a subprocess for each message, as in earlier releases)
+	and by archer_archive_logging, writing to a local stand-in for the system log
+
+archive
+	Archives synthetic archer servers of 10 to 1000 projects from end to end with ArcherArchive, with the commands for the archer server
+	run in a local shell (config.archer_local_shell) and the uploads sent to archer_archive_fakes.FakeDNAnexusServer.
+	Reports the time, bytes and throughput of each stage and the number of subprocesses run at each scale, and can write them
+	to a JSON file (--output) so runs of different versions of the script can be compared
+"""
+
+import os, time, tempfile, subprocess, argparse, socket, threading, gzip, shutil, json, io, contextlib
+import archer_archive_compress
+
+# FASTQ bases and quality scores are drawn from these characters
+BASES = b"ACGT"
+QUALITIES = bytes(range(ord("!"), ord("J") + 1))
+
+
+def synthetic_fastq(path, size_bytes, read_length=150):
+	"""
+	Write a FASTQ-like file of roughly size_bytes to path
+	Reads have random bases and quality scores, which compress to a similar ratio to real FASTQs
+	"""
+	base_table = bytes(BASES[i % len(BASES)] for i in range(256))
+	quality_table = bytes(QUALITIES[i % len(QUALITIES)] for i in range(256))
+	written = 0
+	read_number = 0
+	with open(path, "wb") as fastq:
+		while written < size_bytes:
+			read_number += 1
+			sequence = os.urandom(read_length).translate(base_table)
+			quality = os.urandom(read_length).translate(quality_table)
+			record = b"@ADX00001_S1_L001:%d 1:N:0\n%s\n+\n%s\n" % (read_number, sequence, quality)
+			fastq.write(record)
+			written += len(record)
+	return written
+
+
+def build_synthetic_project(folder, archer_project_ID, size_bytes, files=4):
+	"""
+	Make a project folder containing FASTQ-like files totalling roughly size_bytes, in the layout of an Archer project folder
+	Returns the path to the project folder
+	"""
+	project_folder = os.path.join(folder, archer_project_ID)
+	os.makedirs(project_folder, exist_ok=True)
+	# the files are generated once then copied, to save time generating random reads
+	first_fastq = os.path.join(project_folder, "ADX00001_S1_R1_001.fastq")
+	synthetic_fastq(first_fastq, size_bytes // files)
+	for file_number in range(2, files + 1):
+		subprocess.check_call(["cp", first_fastq, os.path.join(project_folder, "ADX00001_S%s_R1_001.fastq" % (file_number))])
+	return project_folder
+
+
+def benchmark_compression(args):
+	"""
+	Time tar -czf and the parallel compression engine (for each number of workers) compressing the same synthetic project
+	"""
+	with tempfile.TemporaryDirectory() as folder:
+		build_synthetic_project(folder, "4767", args.size_mb * 1024 * 1024)
+		uncompressed_bytes = int(subprocess.check_output(["du", "-sb", os.path.join(folder, "4767")]).split()[0])
+		results = []
+		# current command used by create_project_tar()
+		start = time.time()
+		subprocess.check_call("cd %s; tar -czf tar.tar.gz 4767" % (folder), shell=True)
+		results.append(("tar -czf", time.time() - start, os.path.getsize(os.path.join(folder, "tar.tar.gz"))))
+		for workers in args.workers:
+			output_path = os.path.join(folder, "parallel_%s.tar.gz" % (workers))
+			start = time.time()
+			proc = subprocess.Popen("cd %s; tar -cf - 4767" % (folder), shell=True, stdout=subprocess.PIPE)
+			with open(output_path, "wb") as output:
+				archer_archive_compress.compress_stream(proc.stdout, output, workers, args.level)
+			proc.wait()
+			results.append(("parallel, %s workers" % (workers), time.time() - start, os.path.getsize(output_path)))
+			# check the output is a valid gzip file
+			subprocess.check_call(["gzip", "-t", output_path])
+	print("%s MB of FASTQ-like data, compression level %s" % (uncompressed_bytes // (1024 * 1024), args.level))
+	print("%-24s %10s %10s %10s %8s" % ("engine", "seconds", "MB/s", "MB out", "ratio"))
+	for engine, seconds, compressed_bytes in results:
+		print("%-24s %10.2f %10.1f %10.1f %8.3f" % (
+			engine, seconds, uncompressed_bytes / (1024 * 1024) / seconds, compressed_bytes / (1024 * 1024), compressed_bytes / uncompressed_bytes))
+
+
+class SyslogStandIn():
+	"""
+	Unix datagram socket which receives system log messages, in place of /dev/log
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.messages = []
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.socket.bind(path)
+		self.thread = threading.Thread(target=self._receive, daemon=True)
+		self.thread.start()
+
+	def _receive(self):
+		while True:
+			message = self.socket.recv(65536)
+			if not message:
+				break
+			self.messages.append(message.decode("utf-8", "replace").rstrip("\0\n"))
+
+	def wait_for(self, count, timeout=30):
+		end = time.time() + timeout
+		while len(self.messages) < count and time.time() < end:
+			time.sleep(0.01)
+
+
+def benchmark_logging(args):
+	"""
+	Time writing args.messages log messages with /usr/bin/logger in a subprocess and with archer_archive_logging
+	"""
+	import archer_archive_logging
+	tool = "Archer archive"
+	message = "Project 4767 ADX22001 has been archived in Archer software. Can be backed up to DNA Nexus."
+	with tempfile.TemporaryDirectory() as folder:
+		syslog = SyslogStandIn(os.path.join(folder, "log"))
+		results = []
+		# earlier releases: a shell and /usr/bin/logger for every message (-u sends it to the stand-in rather than /dev/log)
+		start = time.time()
+		for _ in range(args.messages):
+			subprocess.call(["/usr/bin/logger -u %s -t %s '%s'" % (syslog.path, tool, message)], shell=True)
+		results.append(("/usr/bin/logger subprocess", time.time() - start))
+		syslog.wait_for(args.messages)
+		logger_example = syslog.messages[-1]
+		start = time.time()
+		logger = archer_archive_logging.get_syslog_logger(syslog.path)
+		for _ in range(args.messages):
+			logger.info(archer_archive_logging.syslog_message(message, tool))
+		results.append(("archer_archive_logging", time.time() - start))
+		syslog.wait_for(args.messages * 2)
+		native_example = syslog.messages[-1]
+	print("%s messages" % (args.messages))
+	print("%-28s %10s %16s" % ("backend", "seconds", "us per message"))
+	for backend, seconds in results:
+		print("%-28s %10.3f %16.1f" % (backend, seconds, seconds / args.messages * 1000000))
+	print("message received from /usr/bin/logger:      %s" % (logger_example))
+	print("message received from archer_archive_logging: %s" % (native_example))
+
+
+def build_archer_server(folder, projects, samples, fastq_bytes, first_project=5001):
+	"""
+	Make a synthetic archer server in folder, in the layout archer_archive_script expects:
+	- analysis/<project ID>: an archived project folder for each project, containing the gzipped FASTQs of its samples (named
+	ADX<number>_S<sample>_R<read>_001.fastq.gz, so the ADX project name is taken from them) and <project ID>.tar.gz
+	- picked_up_files: the FASTQs of every project, as picked up by the archer platform
+	Every FASTQ is a hard link to one generated file of roughly fastq_bytes (before compression), to save time and disk space
+	Returns (analysis folder, picked up files folder, [(DNAnexus project ID, DNAnexus project name)] of the matching DNAnexus projects)
+	"""
+	analysis_folder = os.path.join(folder, "analysis")
+	picked_up_folder = os.path.join(folder, "picked_up_files")
+	os.makedirs(analysis_folder)
+	os.makedirs(picked_up_folder)
+	fastq_path = os.path.join(folder, "sample.fastq")
+	synthetic_fastq(fastq_path, fastq_bytes)
+	with open(fastq_path, "rb") as fastq, gzip.open(fastq_path + ".gz", "wb") as compressed:
+		shutil.copyfileobj(fastq, compressed)
+	os.remove(fastq_path)
+	dnanexus_projects = []
+	for project_number in range(projects):
+		archer_project_ID = str(first_project + project_number)
+		project_adx = "ADX%s" % (30000 + project_number)
+		project_folder = os.path.join(analysis_folder, archer_project_ID)
+		os.makedirs(project_folder)
+		for sample in range(1, samples + 1):
+			for read in (1, 2):
+				fastq_name = "%s_S%s_R%s_001.fastq.gz" % (project_adx, sample, read)
+				os.link(fastq_path + ".gz", os.path.join(picked_up_folder, fastq_name))
+				os.link(fastq_path + ".gz", os.path.join(project_folder, fastq_name))
+		# marks the project as archived on the archer platform
+		with open(os.path.join(project_folder, "%s.tar.gz" % (archer_project_ID)), "wb") as archer_tar:
+			archer_tar.write(os.urandom(1024))
+		dnanexus_projects.append(("project-%024d" % (project_number + 1), "002_%s_ARCHER" % (project_adx)))
+	os.remove(fastq_path + ".gz")
+	return analysis_folder, picked_up_folder, dnanexus_projects
+
+
+@contextlib.contextmanager
+def configured(**settings):
+	"""
+	Set archer_archive_config settings, restoring them afterwards
+	Settings read when first used (e.g. Nexus_API_Key) are not read to be restored, but removed again afterwards
+	"""
+	import archer_archive_config as config
+	settings_dict = vars(config)
+	previous = {name: settings_dict[name] for name in settings if name in settings_dict}
+	settings_dict.update(settings)
+	try:
+		yield
+	finally:
+		for name in settings:
+			settings_dict.pop(name, None)
+		settings_dict.update(previous)
+
+
+def archive_synthetic_server(folder, projects, args):
+	"""
+	Archive a synthetic archer server of projects projects with ArcherArchive, in folder
+	Returns the results of the run (dict)
+	"""
+	import archer_archive_script, archer_archive_fakes
+	analysis_folder, picked_up_folder, dnanexus_projects = build_archer_server(folder, projects, args.samples, int(args.fastq_mb * 1024 * 1024))
+	for subfolder in ("copy", "logs", "fastq_locations"):
+		os.makedirs(os.path.join(folder, subfolder))
+	syslog = SyslogStandIn(os.path.join(folder, "log"))
+	with archer_archive_fakes.FakeDNAnexusServer(dnanexus_projects, keep_data=False) as server, configured(
+			archer_local_shell=True, testing=False, path_to_analysis_folder=analysis_folder, path_to_picked_up_files=picked_up_folder,
+			copy_location=os.path.join(folder, "copy"), script_logfile_folder=os.path.join(folder, "logs"),
+			fastq_locations_folder=os.path.join(folder, "fastq_locations"), syslog_address=syslog.path,
+			path_to_archived_projects_ledger=os.path.join(folder, "ledger.sqlite"), path_to_archived_project_ids=None,
+			path_to_dnanexus_project_cache=os.path.join(folder, "dnanexus_projects.json"), upload_engine="dxpy",
+			dnanexus_api_server=server.api_server_info(), project_workers=args.project_workers, local_free_space_headroom_bytes=0,
+			deduplicate_fastqs=args.deduplicate, throttle_profiles=[],
+			Nexus_API_Key="benchmark-token"):
+		archive = archer_archive_script.ArcherArchive(transfer_mode=args.transfer_mode)
+		start = time.time()
+		# every log message is also printed, which is not part of the benchmark
+		with contextlib.redirect_stdout(io.StringIO()):
+			archive.go()
+		seconds = time.time() - start
+		archive.ledger.connection.close()
+		api_requests = sum(count for route, count in server.calls.items() if route != "upload")
+	syslog.socket.close()
+	stage_totals = archive.metrics.stage_totals()
+	subprocesses = sum(total["subprocesses"] for total in stage_totals.values()) + archive.metrics.other_subprocesses
+	return {
+		"projects": projects,
+		"archived": len([outcome for outcome in archive.project_results.values() if outcome == "archived"]),
+		"failed": len([outcome for outcome in archive.project_results.values() if outcome.startswith("failed")]),
+		"bytes_freed": archive.bytes_freed,
+		"seconds": round(seconds, 3),
+		"subprocesses": subprocesses,
+		"ssh_connections": archive.archer.connections_opened,
+		"dnanexus_api_requests": api_requests,
+		"part_uploads": server.calls.get("upload", 0),
+		"stage_totals": stage_totals,
+	}
+
+
+def benchmark_archive(args):
+	"""
+	Archive synthetic archer servers of each number of projects in args.projects, and print the time and throughput of each stage
+	"""
+	if args.transfer_mode == "staged" and not shutil.which("rsync"):
+		raise SystemExit("rsync is required to copy projects in the staged transfer mode")
+	results = []
+	for projects in args.projects:
+		with tempfile.TemporaryDirectory() as folder:
+			result = archive_synthetic_server(folder, projects, args)
+		results.append(result)
+		print("%s projects (%s samples, %s MB FASTQs before compression, %s transfer, %s project workers): %s archived, %s failed" % (
+			projects, args.samples, args.fastq_mb, args.transfer_mode, args.project_workers, result["archived"], result["failed"]))
+		print("%-14s %6s %10s %10s %10s %8s" % ("stage", "count", "seconds", "MB", "MB/s", "procs"))
+		for stage, total in sorted(result["stage_totals"].items(), key=lambda item: -item[1]["seconds"]):
+			print("%-14s %6s %10.2f %10.1f %10s %8s" % (stage, total["count"], total["seconds"], total["bytes"] / (1024 * 1024),
+				total["mb_per_second"] or "-", total["subprocesses"]))
+		print()
+	print("%8s %10s %12s %12s %8s %14s %10s %12s" % (
+		"projects", "seconds", "projects/s", "freed MB/s", "procs", "procs/project", "ssh", "API requests"))
+	for result in results:
+		print("%8s %10.2f %12.2f %12.1f %8s %14.1f %10s %12s" % (result["projects"], result["seconds"], result["projects"] / result["seconds"],
+			result["bytes_freed"] / (1024 * 1024) / result["seconds"], result["subprocesses"], result["subprocesses"] / result["projects"],
+			result["ssh_connections"], result["dnanexus_api_requests"]))
+	if args.output:
+		with open(args.output, "w") as output:
+			json.dump({"settings": {"samples": args.samples, "fastq_mb": args.fastq_mb, "transfer_mode": args.transfer_mode,
+				"project_workers": args.project_workers, "deduplicate": args.deduplicate}, "results": results}, output, indent=1)
+		print("Results written to %s" % (args.output))
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmarks for the archer archiving script")
+	benchmarks = parser.add_subparsers(dest="benchmark")
+	benchmarks.required = True
+	compression = benchmarks.add_parser("compression", help="compare the parallel compression engine with tar -czf")
+	compression.add_argument("--size-mb", type=int, default=256, help="size of the synthetic project folder (MB)")
+	compression.add_argument("--workers", type=int, nargs="+", default=[1, 2, os.cpu_count() or 1], help="numbers of workers to benchmark")
+	compression.add_argument("--level", type=int, default=6, help="gzip compression level")
+	compression.set_defaults(function=benchmark_compression)
+	logging_parser = benchmarks.add_parser("logging", help="compare /usr/bin/logger with archer_archive_logging")
+	logging_parser.add_argument("--messages", type=int, default=1000, help="number of messages to log")
+	logging_parser.set_defaults(function=benchmark_logging)
+	archive = benchmarks.add_parser("archive", help="archive synthetic archer servers with local stand-ins for the archer server and DNAnexus")
+	archive.add_argument("--projects", type=int, nargs="+", default=[10, 100, 1000], help="numbers of projects to benchmark")
+	archive.add_argument("--samples", type=int, default=4, help="samples per project (each with an R1 and R2 FASTQ)")
+	archive.add_argument("--fastq-mb", type=float, default=1, help="size of each FASTQ before compression (MB)")
+	archive.add_argument("--transfer-mode", choices=["staged", "streaming"], default="staged", help="see config.transfer_mode")
+	archive.add_argument("--project-workers", type=int, default=1, help="number of projects archived at the same time (see config.project_workers)")
+	archive.add_argument("--deduplicate", action="store_true",
+		help="deduplicate FASTQs (config.deduplicate_fastqs). All the synthetic FASTQs are the same, so only the first project's are archived")
+	archive.add_argument("--output", help="write the results to this JSON file")
+	archive.set_defaults(function=benchmark_archive)
+	args = parser.parse_args(argv)
+	args.function(args)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,155 @@
+"""
+Parallel gzip compression of project tarballs
+The data is split into blocks which are deflated on a pool of threads (zlib releases the GIL while compressing) and written in order
+as a single standard gzip member, so the output can be read by gzip, tar and any other gzip reader.
+As with pigz, each block is primed with the last 32KB of the block before it, so the compression ratio is close to that of single threaded gzip.
+When the data is a tar archive, the md5 checksum of each file in it can be calculated as it passes (copy_tar()), and the md5 checksum
+of the compressed output by writing it through an MD5Writer, so neither the files nor the tarball need to be read again.
+"""
+
+import collections, hashlib, struct, tarfile, time, zlib
+import concurrent.futures
+
+# deflate can refer back up to 32KB, so this much of the previous block is used as the dictionary for the next
+DICTIONARY_SIZE = 32 * 1024
+
+
+def _deflate_block(data, level, zdict):
+	"""
+	Deflate one block as raw deflate data (no gzip header), ending with a sync flush so blocks can be joined into one stream
+	"""
+	if zdict:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+	else:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter():
+	"""
+	File-like object which gzip compresses everything written to it into fileobj, using workers threads
+	close() must be called to write the end of the gzip stream (fileobj itself is not closed)
+	"""
+	def __init__(self, fileobj, workers, level=6, block_size=1024 * 1024):
+		self.fileobj = fileobj
+		self.level = level
+		self.block_size = block_size
+		self.workers = max(1, workers)
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+		# blocks being compressed, in the order they must be written. Bounded so memory use doesn't grow with the input
+		self.pending = collections.deque()
+		self.buffer = bytearray()
+		self.previous_block = b""
+		self.crc = 0
+		self.size = 0
+		self.closed = False
+		# gzip header: magic number, deflate, no flags, modification time, no extra flags, unknown OS
+		self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", int(time.time())) + b"\x00\xff")
+
+	def write(self, data):
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			block = bytes(self.buffer[:self.block_size])
+			del self.buffer[:self.block_size]
+			self._submit(block)
+		return len(data)
+
+	def _submit(self, block):
+		# the crc and length of the uncompressed data are calculated in order here rather than in the workers
+		self.crc = zlib.crc32(block, self.crc)
+		self.size += len(block)
+		zdict = self.previous_block[-DICTIONARY_SIZE:]
+		self.pending.append(self.pool.submit(_deflate_block, block, self.level, zdict))
+		self.previous_block = block
+		while len(self.pending) > self.workers * 2:
+			self.fileobj.write(self.pending.popleft().result())
+
+	def close(self):
+		if self.closed:
+			return
+		if self.buffer:
+			self._submit(bytes(self.buffer))
+			self.buffer = bytearray()
+		while self.pending:
+			self.fileobj.write(self.pending.popleft().result())
+		self.pool.shutdown()
+		# an empty final deflate block ends the stream, followed by the gzip trailer (crc32 and length of the uncompressed data)
+		self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+		self.fileobj.write(struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff))
+		self.closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# the gzip stream is only completed if everything was written successfully
+		if exc_type is None:
+			self.close()
+		else:
+			self.pool.shutdown()
+
+
+class MD5Writer():
+	"""
+	File-like object which writes to fileobj, calculating the md5 checksum of everything written
+	"""
+	def __init__(self, fileobj):
+		self.fileobj = fileobj
+		self.md5 = hashlib.md5()
+
+	def write(self, data):
+		self.md5.update(data)
+		return self.fileobj.write(data)
+
+	def hexdigest(self):
+		return self.md5.hexdigest()
+
+
+class _TeeReader():
+	"""
+	File-like object which reads from source, writing everything read to destination
+	"""
+	def __init__(self, source, destination):
+		self.source = source
+		self.destination = destination
+
+	def read(self, size=-1):
+		data = self.source.read(size)
+		self.destination.write(data)
+		return data
+
+
+def copy_tar(source, destination, block_size=1024 * 1024):
+	"""
+	Copy the tar archive read from source to destination, calculating the md5 checksum of each file in it as it passes
+	Returns {path in the archive: md5 checksum}. Raises tarfile.ReadError if source is not a complete tar archive
+	"""
+	reader = _TeeReader(source, destination)
+	md5s = {}
+	with tarfile.open(fileobj=reader, mode="r|", bufsize=block_size) as archive:
+		for member in archive:
+			if member.isfile():
+				md5 = hashlib.md5()
+				member_file = archive.extractfile(member)
+				for chunk in iter(lambda: member_file.read(block_size), b""):
+					md5.update(chunk)
+				md5s[member.name] = md5.hexdigest()
+	# tarfile stops at the end of archive marker, so the zero blocks padding the last record are copied here
+	for chunk in iter(lambda: reader.read(block_size), b""):
+		pass
+	return md5s
+
+
+def compress_stream(source, destination, workers, level=6, block_size=1024 * 1024, member_md5s=None):
+	"""
+	Read source until it is exhausted and write it, gzip compressed, to destination
+	If member_md5s is a dict, source must be a tar archive and the md5 checksum of each file in it is added to member_md5s (see copy_tar())
+	Returns the number of uncompressed bytes read
+	"""
+	with ParallelGzipWriter(destination, workers, level, block_size) as writer:
+		if member_md5s is not None:
+			member_md5s.update(copy_tar(source, writer, block_size))
+		else:
+			for chunk in iter(lambda: source.read(block_size), b""):
+				writer.write(chunk)
+	return writer.size
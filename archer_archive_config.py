@@ -1,4 +1,4 @@
-import os
+import os, sys
 testing = False
 docker = True
 # =====location of input/output files=====
@@ -13,22 +13,83 @@ processed_runs_folder = os.path.join(logfile_folder,"processed_runs")
 archive_logs_folder = os.path.join(logfile_folder,"archer_archive_logs")
 fastq_locations_folder = os.path.join(archive_logs_folder,"fastq_locations")
 
-# DNA Nexus authentication token
+# DNA Nexus authentication token (Nexus_API_Key), read from this file when first used. An error is raised if the file is missing
 nexus_api_key_file = os.path.join(document_root,".dnanexus_auth_token")
-with open(nexus_api_key_file, "r") as nexus_api:
-	Nexus_API_Key = nexus_api.readline().rstrip()
 
 # archerdx VM login
 path_to_archerdx_pw = "{document_root}/.archerVM_pw".format(document_root=document_root)
+archer_user = "s_archerupload"
+archer_server = "grpvgaa01.viapath.local"
+# send all ssh and rsync commands to the archer server down a single ssh connection (ssh ControlMaster), opened once per run
+ssh_multiplex = True
+# socket for the ssh master connection. %C is replaced by ssh with a hash of the connection details
+ssh_control_path = "/tmp/archer_archive_ssh_%C"
+# run the commands intended for the archer server in a local shell instead, e.g. against a local copy of the analysis folders
+archer_local_shell = False
 
 copy_location = os.path.join(document_root,"dx_downloads")
-path_to_watch_folder = "/watched/aledjones\@nhs.net/FusionPlexPanSolidTumorv1_0" #folder made by RLH 20210622
+path_to_watch_folder = "/watched/aledjones@nhs.net/FusionPlexPanSolidTumorv1_0" #folder made by RLH 20210622
 path_to_analysis_folder = "/var/www/analysis"
 path_to_analysis_test_folder = "/var/www/analysis/test1"
-path_to_picked_up_files = "/watched/aledjones\@nhs.net/FusionPlexPanSolidTumorv1_0/picked_up_files"
+# paths are written unescaped: they are quoted (shlex.quote) wherever they are put into a shell command
+path_to_picked_up_files = "/watched/aledjones@nhs.net/FusionPlexPanSolidTumorv1_0/picked_up_files"
 path_to_picked_up_test_files = os.path.join(path_to_analysis_test_folder,"fastqs")
-export_environment = "export DX_API_TOKEN=%s" % Nexus_API_Key
+# =====DNAnexus project index=====
+# the DNAnexus projects are listed once and the index of projects by ADX name is cached in this file
+path_to_dnanexus_project_cache = os.path.join(archive_logs_folder,"dnanexus_projects.json")
+# seconds before the cached index expires and is remade
+dnanexus_project_cache_ttl = 24 * 60 * 60
+# when a project is not found in the index it is remade, but not more often than this (seconds)
+dnanexus_project_cache_min_refresh_interval = 5 * 60
+
+# =====transfer mode=====
+# "staged": the project folder is copied to copy_location with rsync, compressed with tar and uploaded (see upload_engine)
+# "streaming": the project folder is archived with tar on the archer server and streamed over ssh, compressed, straight into DNAnexus
+# so no copy of the project is written to copy_location. Can be changed for a run with the --transfer-mode command line argument
+transfer_mode = "staged"
+# size of each part uploaded to DNAnexus when streaming (DNAnexus requires all parts except the last to be at least 5MB)
+stream_part_size = 64 * 1024 * 1024
+# =====copy=====
+# rsync options used to copy project folders to copy_location (staged transfer mode). -r recursive, -t preserves modification times.
+# --partial-dir keeps partly copied files in the project folder so an interrupted copy is resumed by the next run
+rsync_options = "-rt --partial --partial-dir=.rsync-partial"
+# record the md5 checksum of each copied file in the manifest of the copy (see archer_archive_manifest). With the parallel compression
+# engine they are taken as the tar is made, otherwise by reading the copy once it is made
+copy_manifest_checksums = True
+# check the md5 checksums in the manifest (rather than only sizes and modification times) before a copy from an earlier run is reused
+copy_verify_checksums = False
+# =====FASTQ deduplication=====
+# FASTQs in a project folder which were archived with an earlier project (same md5 checksum and size, recorded in the ledger) are not
+# copied, tarred or uploaded again. Their rows in the fastq locations files give the DNAnexus file (project tar) they are stored in.
+# Only FASTQs the same size as an archived FASTQ are checksummed on the archer server, unless the checksums can't be taken from the
+# copy manifest (streaming transfer mode, or copy_manifest_checksums = False), when every FASTQ is checksummed
+deduplicate_fastqs = True
+# =====upload=====
+# "dxpy": files are uploaded by archer_archive_dnanexus.upload_file(), in parts on upload_workers threads, and verified with md5 checksums
+# "ua": files are uploaded by the DNAnexus upload agent (path_to_dx_upload_agent)
+upload_engine = "dxpy"
+# size of each part of a file uploaded with dxpy (DNAnexus requires all parts except the last to be at least 5MB)
+upload_part_size = 64 * 1024 * 1024
+upload_workers = 4
+# number of times a failed part is uploaded again, waiting upload_retry_backoff seconds (doubling after each attempt)
+upload_retries = 3
+upload_retry_backoff = 2
+# (host, port, protocol) of the DNAnexus API server, e.g. ("127.0.0.1", 8090, "http") for archer_archive_fakes.FakeDNAnexusServer.
+# None to use the DNAnexus API
+dnanexus_api_server = None
+# =====compression=====
+# "parallel": tar output is gzip compressed on compression_workers threads by archer_archive_compress (a standard .tar.gz is produced)
+# "tar": single threaded compression with tar -czf (gzip when streaming)
+compression_engine = "parallel"
+compression_workers = os.cpu_count() or 1
+# gzip compression level (1 fastest - 9 smallest)
+compression_level = 6
+# size of the blocks of data compressed by each worker
+compression_block_size = 1024 * 1024
+# text file of archived project IDs used by earlier releases. Imported into the ledger below when the ledger is created
 path_to_archived_project_ids = os.path.join(document_root,archive_logs_folder,"archer_archived_projects.txt")
+# ledger (SQLite database) of archived projects
+path_to_archived_projects_ledger = os.path.join(archive_logs_folder,"archer_archived_projects.sqlite")
 
 # when testing the script it may be easier to do so without running the docker image. Different paths are required for some inputs in this case
 if docker:
@@ -36,4 +97,100 @@ if docker:
     path_to_dx_upload_agent = os.path.join(resources_root,"resources","dnanexus-upload-agent-1.5.33-linux","ua")
 else:
     source_command = " source %s" % (os.path.join(document_root,"apps","dx-toolkit","environment"))
-    path_to_dx_upload_agent = os.path.join(document_root,"apps","dnanexus-upload-agent-1.5.33-linux","ua")
\ No newline at end of file
+    path_to_dx_upload_agent = os.path.join(document_root,"apps","dnanexus-upload-agent-1.5.33-linux","ua")
+
+# =====logging=====
+# system log socket (or (host, port) tuple for a syslog server) that log messages are written to
+syslog_address = "/dev/log"
+
+# =====concurrency=====
+# number of archer projects archived at the same time. When set to 1 projects are archived one after another
+project_workers = 1
+# maximum number of projects that can be in each stage at the same time (used when project_workers > 1)
+# rsync (copy) and the upload are network bound and tar is CPU bound, so these stages can overlap across projects
+stage_pool_sizes = {
+    "check": 4,
+    "dedup": 2,
+    "copy": 2,
+    "tar": 1,
+    "find": 4,
+    "upload": 2,
+    "cleanup": 2,
+}
+
+# =====throttling=====
+# limits on bandwidth and priority used at times of day, so projects can be archived while the servers are in use (see archer_archive_throttle)
+# the first profile covering the time of day (start and end "HH:MM", days 0 Monday - 6 Sunday) is used, otherwise throttle_default_profile.
+# bandwidth_kbps caps all transfers together and stage_bandwidth_kbps the transfers of each stage (copy, upload), in KiB/s.
+# nice (0-19), ionice_class (1 realtime, 2 best effort, 3 idle) and ionice_level (0-7) set the priority of rsync, tar, md5sum and the
+# upload agent (on both servers, so ionice must be installed on the archer server). compression_workers replaces compression_workers.
+# adaptive adjusts the caps and compression workers to the load of the servers (measuring the archer server's load over ssh)
+# no profiles by default, so nothing is throttled. For example, to throttle during lab hours:
+# throttle_profiles = [
+#     {"name": "lab hours", "days": [0, 1, 2, 3, 4], "start": "08:00", "end": "18:00", "bandwidth_kbps": 20 * 1024,
+#         "stage_bandwidth_kbps": {"copy": 10 * 1024}, "nice": 19, "ionice_class": 3, "compression_workers": 2, "adaptive": True},
+# ]
+throttle_profiles = []
+throttle_default_profile = {"name": "default", "bandwidth_kbps": None, "stage_bandwidth_kbps": {}, "nice": None, "ionice_class": None,
+    "ionice_level": None, "compression_workers": None, "adaptive": False}
+# in adaptive profiles the limits are halved (to no less than throttle_min_factor of the profile's limits) while the 1 minute load average
+# per CPU of the genomics server or the archer server is above throttle_load_high, and doubled (up to the profile's limits) while both are
+# below throttle_load_low. The load is measured at most every throttle_adjust_interval seconds
+throttle_load_high = 0.8
+throttle_load_low = 0.5
+throttle_min_factor = 0.1
+throttle_adjust_interval = 60
+
+# =====daemon mode=====
+# seconds between polls of the archer server (python archer_archive_script.py --daemon)
+daemon_poll_interval = 60
+# a run is made at least this often (seconds) even if the poll shows no change, e.g. to retry failed projects
+daemon_full_run_interval = 6 * 60 * 60
+# (address, port) the /health and /metrics endpoints are served on. None to not serve them
+daemon_http_address = ("0.0.0.0", 8091)
+
+# =====scheduling=====
+# order projects are archived in: "listing" (the order they are listed on the archer server) or "largest_first" (projects part
+# archived by an earlier run, then the projects which free the most space on the archer server)
+schedule_order = "listing"
+# no more projects are started once the free space on the archer server (measured when the run starts, plus the space freed by
+# the run) reaches this many bytes. None to archive all projects
+archer_free_space_goal_bytes = None
+# no more projects are started once the run has freed (or is freeing) this many bytes on the archer server. None for no target
+bytes_to_free_target = None
+# no more projects are started once the run has taken this many seconds. None for no time limit
+time_budget_seconds = None
+# bytes left free in copy_location when projects are copied and tarred (staged transfer mode). Projects wait to be started until
+# there is space for the project folder and its tar as well as this headroom
+local_free_space_headroom_bytes = 50 * 1024 * 1024 * 1024
+
+# =====subprocesses=====
+# "asyncio": shell commands are run on the asyncio execution core (archer_archive_async), with the limits below
+# "popen": each command is run with subprocess.Popen and its output collected when it finishes
+# asyncio needs python 3.8 or later to start commands from its event loop thread (the Docker image has python 3.7)
+subprocess_engine = "asyncio" if sys.version_info >= (3, 8) else "popen"
+# seconds after which a command of each stage is killed ("other" for commands run outside a stage). Stages not listed have no timeout
+subprocess_timeouts = {
+    "other": 10 * 60,
+    "inventory": 30 * 60,
+    "check": 10 * 60,
+    "dedup": 30 * 60,
+    "cleanup": 30 * 60,
+    "fastq_cleanup": 30 * 60,
+}
+# bytes of stdout kept for each command (the most recent lines). Must be large enough for the inventory of the archer server (the run fails if not)
+subprocess_output_limit = 256 * 1024 * 1024
+
+
+def __getattr__(name):
+	"""
+	Settings which need the DNAnexus token, read when first used so the modules can be imported (e.g. by the tests and the
+	benchmark, which set Nexus_API_Key themselves) without the token file
+	"""
+	if name == "Nexus_API_Key":
+		with open(nexus_api_key_file, "r") as nexus_api:
+			globals()[name] = nexus_api.readline().rstrip()
+		return globals()[name]
+	if name == "export_environment":
+		return "export DX_API_TOKEN=%s" % (globals().get("Nexus_API_Key") or __getattr__("Nexus_API_Key"))
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,207 @@
+"""
+Daemon mode of the archer archiving script, in place of running the docker image once a day from cron
+Run with:
+	python archer_archive_script.py --daemon
+
+The ssh known hosts are set up and the ssh connection opened once, and the ledger, DNAnexus project index and API token stay loaded.
+Every config.daemon_poll_interval seconds the archer server is polled with one cheap remote command (archer_archive_inventory.poll_command()),
+which changes when a project folder is added, a project is archived by the archer platform or fastqs are picked up. When it changes,
+or config.daemon_full_run_interval seconds have passed since the last run, a run is made as in a daily run (inventory, archive, clean up),
+with its own script logfile and run report.
+
+SIGTERM or SIGINT stops the daemon: no new projects are started, projects being archived are finished and the ssh connection is closed.
+
+The health and metrics of the daemon are served over HTTP on config.daemon_http_address:
+	/health		JSON status, 200 if the last poll succeeded within 3 poll intervals otherwise 503
+	/metrics	counters and gauges in the Prometheus text format
+"""
+
+import json, signal, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import archer_archive_config as config
+import archer_archive_inventory
+
+
+class ArchiveDaemon():
+	"""
+	Runs archer_archive_script.ArcherArchive (archive) whenever the archer server changes
+	"""
+	def __init__(self, archive, poll_interval=config.daemon_poll_interval, full_run_interval=config.daemon_full_run_interval,
+			http_address=config.daemon_http_address):
+		self.archive = archive
+		self.poll_interval = poll_interval
+		self.full_run_interval = full_run_interval
+		self.http_address = http_address
+		self.stop_event = threading.Event()
+		self.last_poll_hash = None
+		self.started_at = time.time()
+		# totals across all runs, reported by /metrics
+		self._lock = threading.Lock()
+		self.counters = {"polls": 0, "poll_failures": 0, "runs": 0, "projects_archived": 0, "projects_failed": 0, "bytes_freed": 0,
+			"subprocesses": 0, "cycle_errors": 0}
+		self.last_poll_at = None
+		self.last_run_at = None
+		self.last_run_seconds = None
+		self.running = False
+		self.httpd = None
+
+	def stop(self, signal_number=None, frame=None):
+		"""
+		Stop the daemon once the current run has finished. No new projects are started
+		"""
+		self.stop_event.set()
+		self.archive.stopping.set()
+
+	def poll(self):
+		"""
+		Returns the checksum of the archer server folders (see archer_archive_inventory.poll_command()), or None if the poll failed
+		"""
+		cmd = "%s; echo $?" % (self.archive.archer.ssh_command(archer_archive_inventory.poll_command(
+			self.archive.archer_analysis_folder(), self.archive.archer_picked_up_folder())))
+		out, err = self.archive.execute_subprocess_command(cmd)
+		lines = out.strip().splitlines()
+		with self._lock:
+			self.counters["polls"] += 1
+			if len(lines) == 2 and lines[1] == "0":
+				self.last_poll_at = time.time()
+				return lines[0]
+			self.counters["poll_failures"] += 1
+		return None
+
+	def connection_open(self):
+		"""
+		Returns True if the ssh connection is open, reopening it if it has dropped
+		"""
+		return self.archive.archer.check() or self.archive.open_archer_connection()
+
+	def run_once(self):
+		"""
+		Make one run: archive the projects on the archer server, with a new script logfile and run report
+		"""
+		with self._lock:
+			self.running = True
+		self.archive.start_run()
+		try:
+			self.archive.archive_run()
+		finally:
+			self.archive.log_run_summary()
+			self.archive.write_run_report()
+			outcomes = list(self.archive.project_results.values())
+			with self._lock:
+				self.running = False
+				self.counters["runs"] += 1
+				self.counters["projects_archived"] += len([outcome for outcome in outcomes if outcome == "archived"])
+				self.counters["projects_failed"] += len([outcome for outcome in outcomes if outcome.startswith("failed")])
+				self.counters["bytes_freed"] += self.archive.bytes_freed
+				self.counters["subprocesses"] += (sum(record["subprocesses"] for record in self.archive.metrics.stages)
+					+ self.archive.metrics.other_subprocesses)
+				self.last_run_at = time.time()
+				self.last_run_seconds = round(self.last_run_at - self.archive.metrics.started_at, 3)
+
+	def run(self):
+		"""
+		Poll the archer server and archive projects until stopped (SIGTERM or SIGINT)
+		"""
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		self.start_http_server()
+		self.archive.logger("Archer archive daemon started. Polling every %s seconds" % (self.poll_interval), "Archer archive")
+		try:
+			if not self.archive.set_up_ssh_known_hosts():
+				return
+			while not self.stop_event.is_set():
+				self.cycle()
+				self.stop_event.wait(self.poll_interval)
+		finally:
+			self.archive.close_archer_connection()
+			self.archive.close_async_runner()
+			self.stop_http_server()
+			self.archive.logger("Archer archive daemon stopped", "Archer archive")
+
+	def cycle(self):
+		"""
+		Poll the archer server and make a run if it has changed (or a full run is due)
+		An unexpected error is logged and counted (cycle_errors in /metrics), and the daemon carries on polling
+		"""
+		try:
+			if self.connection_open():
+				poll_hash = self.poll()
+				full_run_due = self.last_run_at is None or time.time() - self.last_run_at > self.full_run_interval
+				if poll_hash is not None and (poll_hash != self.last_poll_hash or full_run_due):
+					self.run_once()
+					# only recorded once the run has been made, so a run interrupted by an error is made again
+					self.last_poll_hash = poll_hash
+		except Exception as error:
+			with self._lock:
+				self.counters["cycle_errors"] += 1
+			# Rapid 7 alert set up
+			self.archive.logger("ERROR: unexpected error in archer archive daemon: %s" % (error), "Archer archive")
+
+	def health(self):
+		"""
+		Returns (healthy, status dict)
+		"""
+		with self._lock:
+			healthy = self.last_poll_at is not None and time.time() - self.last_poll_at < self.poll_interval * 3
+			status = {"status": "ok" if healthy else "unhealthy", "running": self.running, "stopping": self.stop_event.is_set(),
+				"started_at": self.started_at, "last_poll_at": self.last_poll_at, "last_run_at": self.last_run_at,
+				"last_run_seconds": self.last_run_seconds, "last_logfile": self.archive.logfile_name}
+		# a run in progress holds the connection busy, so the poll time is not expected to be recent
+		return healthy or status["running"], status
+
+	def metrics_text(self):
+		"""
+		Returns the metrics of the daemon in the Prometheus text format
+		"""
+		with self._lock:
+			lines = []
+			for name, value in sorted(self.counters.items()):
+				lines.append("# TYPE archer_archive_%s_total counter" % (name))
+				lines.append("archer_archive_%s_total %s" % (name, value))
+			gauges = {"running": int(self.running), "last_poll_timestamp_seconds": self.last_poll_at or 0,
+				"last_run_timestamp_seconds": self.last_run_at or 0, "last_run_duration_seconds": self.last_run_seconds or 0,
+				"uptime_seconds": round(time.time() - self.started_at, 3)}
+		gauges["pending_fastq_deletions"] = len(self.archive.ledger.pending_fastq_deletions())
+		# fraction of the throttle profile's limits in use, lowered while the servers are busy
+		gauges["throttle_factor"] = self.archive.throttle.factor
+		for name, value in sorted(gauges.items()):
+			lines.append("# TYPE archer_archive_%s gauge" % (name))
+			lines.append("archer_archive_%s %s" % (name, value))
+		return "\n".join(lines) + "\n"
+
+	def start_http_server(self):
+		"""
+		Serve /health and /metrics on self.http_address (not started if it is None)
+		"""
+		if not self.http_address:
+			return
+		daemon = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path == "/health":
+					healthy, status = daemon.health()
+					self._reply(200 if healthy else 503, "application/json", json.dumps(status))
+				elif self.path == "/metrics":
+					self._reply(200, "text/plain; version=0.0.4", daemon.metrics_text())
+				else:
+					self._reply(404, "text/plain", "not found\n")
+
+			def _reply(self, status, content_type, body):
+				data = body.encode()
+				self.send_response(status)
+				self.send_header("Content-Type", content_type)
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.httpd = ThreadingHTTPServer(self.http_address, Handler)
+		threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+	def stop_http_server(self):
+		if self.httpd is not None:
+			self.httpd.shutdown()
+			self.httpd.server_close()
@@ -0,0 +1,244 @@
+"""
+In-process access to DNAnexus using dxpy (installed in the docker image)
+dxpy is imported when first needed so the rest of the script can be run where it is not installed.
+"""
+
+import collections, hashlib, json, os, re, threading, time
+import concurrent.futures
+import archer_archive_config as config
+
+# ADX project names (e.g. ADX22001) in DNAnexus project names
+ADX_PATTERN = re.compile(r"ADX\d+")
+
+
+def dxpy_login():
+	"""
+	Import dxpy and authenticate with the DNAnexus API token
+	Returns the dxpy module
+	"""
+	import dxpy
+	dxpy.set_security_context({"auth_token_type": "Bearer", "auth_token": config.Nexus_API_Key})
+	if config.dnanexus_api_server:
+		dxpy.set_api_server_info(*config.dnanexus_api_server)
+	return dxpy
+
+
+def upload_stream(stream, file_name, project_id, part_size, check_stream_complete=None, rate_limiter=None):
+	"""
+	Upload the bytes read from stream to a new file in the root of the DNAnexus project
+	Bytes are uploaded part by part (part_size bytes) as they are read from the stream and the md5 checksum is calculated as they pass,
+	so the whole file never needs to be held in memory or on disk.
+	The md5 checksum is added to the DNAnexus file as the property md5
+	check_stream_complete (optional) is called once the stream is exhausted, before the file is closed, and should raise an error if the
+	stream ended early (e.g. the process writing to it failed)
+	rate_limiter (optional, archer_archive_throttle.RateLimiter) limits the rate the bytes are uploaded at
+	If the upload fails the incomplete file is removed from the project and the error raised
+	Returns (DNAnexus file ID, md5 checksum, bytes uploaded)
+	"""
+	dxpy = dxpy_login()
+	md5 = hashlib.md5()
+	bytes_uploaded = 0
+	dxfile = dxpy.new_dxfile(name=file_name, project=project_id, folder="/", mode="w", write_buffer_size=part_size)
+	try:
+		for chunk in iter(lambda: stream.read(part_size), b""):
+			md5.update(chunk)
+			bytes_uploaded += len(chunk)
+			if rate_limiter:
+				rate_limiter.wait(len(chunk))
+			dxfile.write(chunk)
+		if check_stream_complete:
+			check_stream_complete()
+		dxfile.close(block=True)
+		dxfile.set_properties({"md5": md5.hexdigest()})
+	except Exception:
+		# finish the parts still buffered or in flight first, otherwise they are uploaded (and retried) after the file is removed
+		try:
+			dxfile.flush()
+		except Exception:
+			pass
+		dxpy.api.project_remove_objects(project_id, {"objects": [dxfile.get_id()]})
+		raise
+	return dxfile.get_id(), md5.hexdigest(), bytes_uploaded
+
+
+# result of uploading one file with upload_file(). error is None if the file was uploaded and verified
+UploadResult = collections.namedtuple("UploadResult", ["path", "file_id", "md5", "bytes", "parts", "retries", "error"])
+
+
+class UploadError(Exception):
+	pass
+
+
+def _read_part(path, index, part_size):
+	"""
+	Returns part index (numbered from 1) of the file at path
+	"""
+	with open(path, "rb") as local_file:
+		local_file.seek((index - 1) * part_size)
+		return local_file.read(part_size)
+
+
+def _upload_part(dxfile, data, index, retries, retry_backoff, rate_limiter=None):
+	"""
+	Upload data as part index of the file, retrying up to retries times (waiting retry_backoff seconds, doubling after each attempt)
+	dxpy sends the md5 checksum of the part with it, so DNAnexus rejects a part that arrives corrupted
+	Each attempt waits for rate_limiter (if given)
+	Returns (size, md5 checksum, retries needed) of the part
+	"""
+	for attempt in range(retries + 1):
+		try:
+			if rate_limiter:
+				rate_limiter.wait(len(data))
+			dxfile.upload_part(data, index=index)
+			return len(data), hashlib.md5(data).hexdigest(), attempt
+		except Exception:
+			if attempt == retries:
+				raise
+			time.sleep(retry_backoff * 2 ** attempt)
+
+
+def upload_file(path, project_id, part_size=config.upload_part_size, workers=config.upload_workers, retries=config.upload_retries,
+		retry_backoff=config.upload_retry_backoff, expected_md5=None, rate_limiter=None):
+	"""
+	Upload the file at path to a new file (with the same name) in the root of the DNAnexus project, part_size bytes at a time
+	on workers threads. Parts which fail are retried (see _upload_part()).
+	The upload is verified before the file is closed:
+	- the md5 checksum and size of each part recorded by DNAnexus must match the local part (parts which don't are uploaded again)
+	- the md5 checksum of the whole local file, calculated as the parts are read, must match expected_md5 (if given, e.g. the
+	checksum recorded when the file was made), so a file changed since it was made is not archived
+	The parts are read in order, once, and handed to the upload threads (at most workers parts are held waiting to be uploaded)
+	rate_limiter (optional, archer_archive_throttle.RateLimiter) limits the rate the parts are uploaded at
+	The md5 checksum is added to the DNAnexus file as the property md5. If the upload fails the incomplete file is removed from the project
+	Returns an UploadResult
+	"""
+	size = os.path.getsize(path)
+	# DNAnexus requires at least one part, even for an empty file
+	part_count = max(1, -(-size // part_size))
+	dxfile = None
+	retries_needed = 0
+	try:
+		dxpy = dxpy_login()
+		dxfile = dxpy.new_dxfile(name=os.path.basename(path), project=project_id, folder="/", mode="w")
+		local_parts = {}
+		md5 = hashlib.md5()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+			futures = {}
+			uploading = set()
+			with open(path, "rb") as local_file:
+				for index in range(1, part_count + 1):
+					# the whole file checksum is calculated from the parts as they are read, so the file is only read once
+					data = local_file.read(part_size)
+					md5.update(data)
+					while len(uploading) >= max(1, workers):
+						_, uploading = concurrent.futures.wait(uploading, return_when=concurrent.futures.FIRST_COMPLETED)
+					future = pool.submit(_upload_part, dxfile, data, index, retries, retry_backoff, rate_limiter)
+					futures[future] = index
+					uploading.add(future)
+			for future in concurrent.futures.as_completed(futures):
+				part_size_uploaded, part_md5, attempts = future.result()
+				local_parts[futures[future]] = (part_size_uploaded, part_md5)
+				retries_needed += attempts
+		if expected_md5 and md5.hexdigest() != expected_md5:
+			raise UploadError("md5 checksum of %s (%s) does not match the checksum recorded when it was made (%s)" % (
+				path, md5.hexdigest(), expected_md5))
+		for attempt in range(retries + 1):
+			remote_parts = dxpy.api.file_describe(dxfile.get_id(), {"fields": {"parts": True}}).get("parts", {})
+			mismatched = [index for index, (part_size_uploaded, part_md5) in sorted(local_parts.items())
+				if remote_parts.get(str(index), {}).get("md5") != part_md5 or remote_parts.get(str(index), {}).get("size") != part_size_uploaded]
+			if not mismatched:
+				break
+			if attempt == retries:
+				raise UploadError("parts %s of %s do not match the local file" % (", ".join(str(index) for index in mismatched), path))
+			retries_needed += len(mismatched)
+			for index in mismatched:
+				_upload_part(dxfile, _read_part(path, index, part_size), index, retries, retry_backoff, rate_limiter)
+		dxfile.close(block=True)
+		remote_size = dxpy.api.file_describe(dxfile.get_id(), {"fields": {"size": True}})["size"]
+		if remote_size != size:
+			raise UploadError("%s is %s bytes in DNAnexus but %s bytes locally" % (path, remote_size, size))
+		dxfile.set_properties({"md5": md5.hexdigest()})
+	except Exception as error:
+		if dxfile is not None:
+			try:
+				dxpy.api.project_remove_objects(project_id, {"objects": [dxfile.get_id()]})
+			except Exception:
+				pass
+		return UploadResult(path, None, None, 0, part_count, retries_needed, str(error) or repr(error))
+	return UploadResult(path, dxfile.get_id(), md5.hexdigest(), size, part_count, retries_needed, None)
+
+
+class DxpyProjectBackend():
+	"""
+	Lists the DNAnexus projects that can be viewed with the API token, using dxpy
+	"""
+	def list_projects(self):
+		"""
+		Yields (project ID, project name) for every project
+		"""
+		dxpy = dxpy_login()
+		for project in dxpy.find_projects(level="VIEW", describe={"fields": {"name": True}}):
+			yield project["id"], project["describe"]["name"]
+
+
+class DNAnexusProjectIndex():
+	"""
+	Index of DNAnexus projects by the ADX project names (ADX###) in their names
+	All projects are listed in one API call and the index is saved to cache_path, where it is reused by later runs until it is
+	older than ttl seconds. If an ADX project name is not found the index is refreshed from DNAnexus (at most once every
+	min_refresh_interval seconds), in case the project has been created since the index was made.
+	backend lists the projects (DxpyProjectBackend by default, archer_archive_fakes.FakeProjectBackend for use offline)
+	"""
+	def __init__(self, backend=None, cache_path=config.path_to_dnanexus_project_cache,
+			ttl=config.dnanexus_project_cache_ttl, min_refresh_interval=config.dnanexus_project_cache_min_refresh_interval):
+		self.backend = backend or DxpyProjectBackend()
+		self.cache_path = cache_path
+		self.ttl = ttl
+		self.min_refresh_interval = min_refresh_interval
+		# ADX project name -> list of [project ID, project name]
+		self.projects_by_adx = None
+		self.created_at = 0
+		self._lock = threading.Lock()
+
+	def _load_cache(self):
+		"""
+		Load the index from the cache file if it exists and has not expired. Returns True if loaded
+		"""
+		try:
+			with open(self.cache_path) as cache:
+				cached = json.load(cache)
+		except (OSError, ValueError):
+			return False
+		if time.time() - cached["created_at"] > self.ttl:
+			return False
+		self.projects_by_adx = cached["projects_by_adx"]
+		self.created_at = cached["created_at"]
+		return True
+
+	def refresh(self):
+		"""
+		List all projects from DNAnexus, rebuild the index and save it to the cache file
+		"""
+		projects_by_adx = {}
+		for project_id, project_name in self.backend.list_projects():
+			for project_adx in set(ADX_PATTERN.findall(project_name)):
+				projects_by_adx.setdefault(project_adx, []).append([project_id, project_name])
+		self.projects_by_adx = projects_by_adx
+		self.created_at = time.time()
+		# written to a temporary file then moved, so a reader never sees a partly written cache
+		temporary_path = "%s.%s.tmp" % (self.cache_path, os.getpid())
+		with open(temporary_path, "w") as cache:
+			json.dump({"created_at": self.created_at, "projects_by_adx": projects_by_adx}, cache)
+		os.replace(temporary_path, self.cache_path)
+
+	def find(self, project_adx):
+		"""
+		Returns a list of [project ID, project name] for the DNAnexus projects whose names contain project_adx
+		The age of the index is checked on every call, so it also expires in a long running process (e.g. the daemon)
+		"""
+		with self._lock:
+			expired = self.projects_by_adx is None or time.time() - self.created_at > self.ttl
+			if expired and not self._load_cache():
+				self.refresh()
+			if project_adx not in self.projects_by_adx and time.time() - self.created_at > self.min_refresh_interval:
+				self.refresh()
+			return list(self.projects_by_adx.get(project_adx, []))
@@ -0,0 +1,190 @@
+"""
+Local stand-ins for the external services used by the archer archiving script, so it can be run and tested offline
+"""
+
+import hashlib, json, re, threading, itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeProjectBackend():
+	"""
+	Stand-in for archer_archive_dnanexus.DxpyProjectBackend which lists a fixed set of DNAnexus projects
+	projects is a list of (project ID, project name)
+	"""
+	def __init__(self, projects):
+		self.projects = list(projects)
+		# number of times the projects have been listed (i.e. calls that would be made to the DNAnexus API)
+		self.list_calls = 0
+
+	def list_projects(self):
+		self.list_calls += 1
+		return iter(self.projects)
+
+
+class FakeDNAnexusServer():
+	"""
+	Local HTTP stand-in for the parts of the DNAnexus API used by dxpy to find projects and upload files
+	(/system/findProjects, /file/new, /file-xxxx/upload, /file-xxxx/describe, /file-xxxx/close, /file-xxxx/setProperties,
+	/project-xxxx/describe, /project-xxxx/removeObjects) and for the upload URLs it returns.
+	Point dxpy at it with config.dnanexus_api_server = server.api_server_info(). Files are held in memory in self.files.
+	projects is a list of (project ID, project name). DNAnexus IDs are the class followed by 24 letters or digits (e.g. project-%024d)
+	To test failures, fail_uploads is the number of part uploads answered with an error, and parts (file name, part index) in
+	corrupt_parts are stored with their first byte changed the first time they are uploaded
+	With keep_data=False only the size and md5 checksum of each part are kept (e.g. for benchmarks uploading many files), so
+	file_contents() can't be used
+	"""
+	def __init__(self, projects=(), fail_uploads=0, corrupt_parts=(), keep_data=True, host="127.0.0.1", port=0):
+		self.projects = list(projects)
+		self.fail_uploads = fail_uploads
+		self.corrupt_parts = set(corrupt_parts)
+		self.keep_data = keep_data
+		# file ID -> {"name", "project", "state", "parts": {index: data}, "part_records": {index: (size, md5)}, "properties"}
+		self.files = {}
+		# number of requests made to each API route, and part uploads
+		self.calls = {}
+		self._ids = itertools.count(1)
+		self._lock = threading.Lock()
+		self.httpd = ThreadingHTTPServer((host, port), self._handler())
+		self.host, self.port = self.httpd.server_address[:2]
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+	def api_server_info(self):
+		return (self.host, self.port, "http")
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def file_contents(self, file_id):
+		"""
+		Returns the contents of a file (its parts joined in order)
+		"""
+		if not self.keep_data:
+			raise ValueError("file contents are not kept (keep_data=False)")
+		parts = self.files[file_id]["parts"]
+		return b"".join(parts[index] for index in sorted(parts))
+
+	def _count(self, route):
+		with self._lock:
+			self.calls[route] = self.calls.get(route, 0) + 1
+
+	def _api(self, route, object_id, body):
+		"""
+		Returns (HTTP status, response body) for a call to an API route
+		"""
+		self._count(route)
+		if route == "/system/findProjects":
+			return 200, {"results": [{"id": project_id, "level": "ADMINISTER", "describe": {"id": project_id, "name": name}}
+				for project_id, name in self.projects], "next": None}
+		if route == "/file/new":
+			file_id = "file-%024d" % (next(self._ids))
+			with self._lock:
+				self.files[file_id] = {"name": body.get("name", ""), "project": body["project"], "folder": body.get("folder", "/"),
+					"state": "open", "parts": {}, "part_records": {}, "part_md5s": {}, "properties": {}}
+			return 200, {"id": file_id}
+		if route == "/project-xxxx/describe":
+			name = dict(self.projects).get(object_id, object_id)
+			return 200, {"id": object_id, "name": name, "fileUploadParameters": {"minimumPartSize": 5 * 1024 * 1024,
+				"maximumPartSize": 5 * 1024 * 1024 * 1024, "emptyLastPartAllowed": True, "maximumNumParts": 10000,
+				"maximumFileSize": 5 * 1024 ** 4}}
+		if route == "/project-xxxx/removeObjects":
+			with self._lock:
+				for file_id in body.get("objects", []):
+					self.files.pop(file_id, None)
+			return 200, {"id": object_id}
+		dxfile = self.files.get(object_id)
+		if dxfile is None:
+			return 404, {"error": {"type": "ResourceNotFound", "message": "%s could not be found" % (object_id)}}
+		if route == "/file-xxxx/upload":
+			index = body.get("index", 1)
+			dxfile["part_md5s"][index] = body.get("md5")
+			return 200, {"url": "http://%s:%s/upload/%s/%s" % (self.host, self.port, object_id, index), "expires": 0,
+				"headers": {"content-md5": body.get("md5", ""), "content-length": str(body.get("size", 0))}}
+		if route == "/file-xxxx/describe":
+			parts = {str(index): {"size": size, "md5": md5, "state": "complete"} for index, (size, md5) in dxfile["part_records"].items()}
+			description = {"id": object_id, "class": "file", "name": dxfile["name"], "project": dxfile["project"], "folder": dxfile["folder"],
+				"state": dxfile["state"], "size": sum(size for size, _ in dxfile["part_records"].values()), "properties": dxfile["properties"]}
+			if dxfile["state"] == "open":
+				description["parts"] = parts
+			return 200, description
+		if route == "/file-xxxx/close":
+			dxfile["state"] = "closed"
+			return 200, {"id": object_id}
+		if route == "/file-xxxx/setProperties":
+			dxfile["properties"].update({key: value for key, value in body.get("properties", {}).items() if value is not None})
+			return 200, {"id": object_id}
+		return 404, {"error": {"type": "InvalidInput", "message": "route %s is not supported by the stand-in" % (route)}}
+
+	def _upload(self, file_id, index, data):
+		"""
+		Store an uploaded part. Returns the HTTP status
+		"""
+		self._count("upload")
+		with self._lock:
+			if self.fail_uploads:
+				self.fail_uploads -= 1
+				return 400
+			if (self.files[file_id]["name"], index) in self.corrupt_parts:
+				self.corrupt_parts.discard((self.files[file_id]["name"], index))
+				data = bytes([data[0] ^ 0xff]) + data[1:] if data else data
+			# as in DNAnexus, a part which does not match the md5 checksum sent with it is rejected (unless corrupted above, which
+			# stands in for corruption DNAnexus does not detect)
+			elif hashlib.md5(data).hexdigest() != self.files[file_id]["part_md5s"].get(index):
+				return 400
+			self.files[file_id]["part_records"][index] = (len(data), hashlib.md5(data).hexdigest())
+			if self.keep_data:
+				self.files[file_id]["parts"][index] = data
+		return 200
+
+	def _handler(self):
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def _reply(self, status, body):
+				data = json.dumps(body).encode()
+				self.send_response(status)
+				self.send_header("Content-Type", "application/json")
+				self.send_header("Content-Length", str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def _body(self):
+				return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+			def do_POST(self):
+				body = self._body()
+				match = re.match(r"^/((?:file|project)-[^/]+)(/\w+)$", self.path)
+				if match:
+					object_id = match.group(1)
+					route = "/%s-xxxx%s" % (object_id.split("-")[0], match.group(2))
+				else:
+					object_id, route = None, self.path
+				try:
+					status, response = server._api(route, object_id, json.loads(body or b"{}"))
+				except Exception as error:
+					status, response = 500, {"error": {"type": "InternalError", "message": str(error)}}
+				self._reply(status, response)
+
+			def do_PUT(self):
+				data = self._body()
+				match = re.match(r"^/upload/([^/]+)/(\d+)$", self.path)
+				if not match or match.group(1) not in server.files:
+					self._reply(404, {"error": {"type": "ResourceNotFound", "message": self.path}})
+					return
+				status = server._upload(match.group(1), int(match.group(2)), data)
+				self._reply(status, {} if status == 200 else {"error": {"type": "InvalidInput", "message": "part upload failed"}})
+
+			def log_message(self, format, *args):
+				pass
+
+		return Handler
@@ -0,0 +1,182 @@
+"""
+Inventory of the project folders on the Archer server
+The whole analysis folder is listed with a single remote find command, which records the type, size and modification
+time of every file. The output is parsed into an in-memory index which the archiving steps query, rather than running
+a separate remote ls for every project folder.
+The same remote command lists the fastqs in the picked_up_files folder and the free space on the archer server.
+The records of a project are also written to its fastq locations file (write_locations()), so restores can find the files without parsing ls output.
+FASTQs in the project folder which were archived with an earlier project are listed with the DNAnexus file (project tar) they are stored in.
+"""
+
+import collections, csv, json, shlex
+
+# one record per file or folder in a project folder. type is the find %y code (f file, d directory, l symlink)
+# target is the path a symlink points to ("" for other types)
+FileRecord = collections.namedtuple("FileRecord", ["type", "size", "mtime", "target"])
+
+# find -printf format. Fields are tab separated and each record is terminated with a null character,
+# so file names containing spaces or newlines are parsed correctly. %l is the target of a symlink and %P is the path relative
+# to the folder being listed. Each record starts with the section (ANALYSIS or PICKED_UP) it belongs to
+FIND_FORMAT = "%s\\t%%y\\t%%s\\t%%T@\\t%%l\\t%%P\\0"
+ANALYSIS = "analysis"
+PICKED_UP = "picked_up"
+# files in project folders with these endings are FASTQs
+FASTQ_SUFFIXES = (".fastq.gz", ".fastq")
+
+
+def inventory_command(analysis_folder, picked_up_folder):
+	"""
+	Returns the command (to be run on the archer server) which lists every file in the analysis folder, the fastqs in the
+	picked_up_files folder and then the bytes free on the file system of the analysis folder
+	"""
+	return "find %s -mindepth 1 -printf '%s' && find %s -mindepth 1 -maxdepth 1 -name '*.fastq.gz' -printf '%s' && df -B1 --output=avail %s | tail -n 1" % (
+		shlex.quote(analysis_folder), FIND_FORMAT % (ANALYSIS), shlex.quote(picked_up_folder), FIND_FORMAT % (PICKED_UP), shlex.quote(analysis_folder))
+
+
+def poll_command(analysis_folder, picked_up_folder):
+	"""
+	Returns the command (to be run on the archer server) which prints the md5 checksum of the modification times of the project folders
+	and of the picked_up_files folder. A folder's modification time changes when a file is added to or removed from it, so the
+	checksum changes when a project folder is added, a project is archived by the archer platform (adding <project>.tar.gz) or
+	fastqs are picked up, without listing every file
+	"""
+	return "{ find %s -mindepth 1 -maxdepth 1 -printf '%%T@\\t%%P\\n' && find %s -maxdepth 0 -printf '%%T@\\n'; } | md5sum | cut -d ' ' -f 1" % (
+		shlex.quote(analysis_folder), shlex.quote(picked_up_folder))
+
+# fields of the fastq locations file (see write_locations())
+# FASTQs archived with an earlier project have their md5 checksum and the DNAnexus project, DNAnexus file ID and path of the project tar
+# they are stored in (stored_project_id, stored_file_id and stored_path), as they are not in the tar of this project
+LOCATION_FIELDS = ["section", "path", "type", "size", "mtime", "target", "md5", "stored_project_id", "stored_file_id", "stored_path"]
+
+
+def write_locations(path_prefix, archer_project_ID, project_adx, folders, rows):
+	"""
+	Write the fastq locations file of a project as JSON (path_prefix.json, with the project, ADX project name and the folders the
+	paths are relative to) and TSV (path_prefix.tsv, one row per record)
+	folders is {section: folder on the archer server}, rows are from ArcherInventory.locations()
+	Returns the paths of the files written
+	"""
+	with open(path_prefix + ".json", "w") as json_file:
+		json.dump({"archer_project_id": archer_project_ID, "project_adx": project_adx, "folders": folders, "files": rows}, json_file, indent=1)
+	with open(path_prefix + ".tsv", "w", newline="") as tsv_file:
+		writer = csv.DictWriter(tsv_file, fieldnames=LOCATION_FIELDS, delimiter="\t")
+		writer.writeheader()
+		writer.writerows(rows)
+	return [path_prefix + ".json", path_prefix + ".tsv"]
+
+
+class ArcherInventory():
+	def __init__(self):
+		# project folder name -> {path relative to the project folder: FileRecord}
+		self.projects = collections.OrderedDict()
+		# fastq file name -> FileRecord for the fastqs in the picked_up_files folder
+		self.picked_up_fastqs = collections.OrderedDict()
+		# bytes free on the archer server
+		self.archer_free_bytes = None
+
+	@classmethod
+	def from_inventory_output(cls, out):
+		"""
+		Build the inventory from the output of inventory_command()
+		"""
+		inventory = cls()
+		records, _, free_bytes = out.rpartition("\0")
+		if free_bytes.strip().isdigit():
+			inventory.archer_free_bytes = int(free_bytes)
+		for record in records.split("\0"):
+			if not record:
+				continue
+			section, file_type, size, mtime, target, path = record.split("\t", 5)
+			file_record = FileRecord(file_type, int(size), float(mtime), target)
+			if section == PICKED_UP:
+				inventory.picked_up_fastqs[path] = file_record
+				continue
+			project, _, project_path = path.partition("/")
+			# top level items that are not folders are not archer projects
+			if not project_path:
+				if file_type == "d":
+					inventory.projects.setdefault(project, collections.OrderedDict())
+				continue
+			inventory.projects.setdefault(project, collections.OrderedDict())[project_path] = file_record
+		return inventory
+
+	def project_names(self):
+		"""
+		Returns the names of all folders in the analysis folder
+		"""
+		return list(self.projects)
+
+	def project_file_records(self, archer_project_ID):
+		"""
+		Returns {path relative to the project folder: FileRecord} for everything in the project folder
+		"""
+		return dict(self.projects.get(archer_project_ID, {}))
+
+	def project_files(self, archer_project_ID):
+		"""
+		Returns the names of the files at the top level of the project folder (as would be listed by ls)
+		"""
+		return [path for path in self.projects.get(archer_project_ID, {}) if "/" not in path]
+
+	def is_archived(self, archer_project_ID):
+		"""
+		Returns True if the project folder contains archer_project_ID.tar.gz, i.e. the project has been archived on the archer platform
+		"""
+		return "%s.tar.gz" % (archer_project_ID) in self.projects.get(archer_project_ID, {})
+
+	def project_adx(self, archer_project_ID):
+		"""
+		Returns the ADX project name (ADX###) taken from the first file in the project folder named ADX*, or None
+		"""
+		for file_name in self.project_files(archer_project_ID):
+			if file_name.startswith("ADX"):
+				return file_name.split("_", 1)[0]
+		return None
+
+	def locations(self, archer_project_ID, project_adx, archived_fastqs=None):
+		"""
+		Returns the records of everything in the project folder and of the ADX project's fastqs in the picked_up_files folder,
+		as a list of dicts (LOCATION_FIELDS)
+		archived_fastqs is {path in the project folder: {"md5" and the ledger record of the archived FASTQ}} for FASTQs archived with an
+		earlier project
+		"""
+		archived_fastqs = archived_fastqs or {}
+		rows = []
+		for section, records in ((ANALYSIS, self.projects.get(archer_project_ID, {})),
+				(PICKED_UP, {file_name: self.picked_up_fastqs[file_name] for file_name in self.project_fastqs(project_adx)})):
+			for path, record in records.items():
+				row = dict.fromkeys(LOCATION_FIELDS, "")
+				row.update({"section": section, "path": path, "type": record.type, "size": record.size, "mtime": record.mtime,
+					"target": record.target})
+				archived = archived_fastqs.get(path) if section == ANALYSIS else None
+				if archived:
+					row.update({"md5": archived["md5"], "stored_project_id": archived["dnanexus_project_id"],
+						"stored_file_id": archived["dnanexus_file_id"] or "", "stored_path": archived["path"]})
+				rows.append(row)
+		return rows
+
+	def project_fastq_records(self, archer_project_ID):
+		"""
+		Returns {path relative to the project folder: FileRecord} for the FASTQs (files named *.fastq.gz or *.fastq) in the project folder
+		Symlinks are not included, as they are not copied (see config.rsync_options)
+		"""
+		return {path: record for path, record in self.projects.get(archer_project_ID, {}).items()
+			if record.type == "f" and path.endswith(FASTQ_SUFFIXES)}
+
+	def project_bytes(self, archer_project_ID):
+		"""
+		Returns the total size in bytes of the files in the project folder
+		"""
+		return sum(record.size for record in self.projects.get(archer_project_ID, {}).values() if record.type == "f")
+
+	def project_fastqs(self, project_adx):
+		"""
+		Returns the names of the fastqs in the picked_up_files folder for the ADX project (named ADX###_...fastq.gz)
+		"""
+		return [file_name for file_name in self.picked_up_fastqs if file_name.split("_", 1)[0] == project_adx]
+
+	def fastq_bytes(self, project_adx):
+		"""
+		Returns the total size in bytes of the fastqs in the picked_up_files folder for the ADX project
+		"""
+		return sum(self.picked_up_fastqs[file_name].size for file_name in self.project_fastqs(project_adx))
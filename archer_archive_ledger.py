@@ -0,0 +1,256 @@
+"""
+Ledger of archer projects that have been archived to DNAnexus
+Held in an SQLite database (config.path_to_archived_projects_ledger) with one record per archer project.
+The archived project IDs are loaded into memory once when the ledger is opened, so checking a project is a set lookup.
+Writes are made in an immediate transaction with a busy timeout and the database uses write-ahead logging,
+so several threads or processes can record projects at the same time.
+
+The ledger also holds the archiving state of projects that are part way through being archived: the last step completed
+(ARCHIVING_STEPS) and the data needed to resume from that step (e.g. paths and checksums of files made by earlier steps),
+and the paths of fastqs on the archer server waiting to be deleted, so fastqs not deleted by a run are deleted by the next.
+The md5 checksum and size of each FASTQ archived in a project tar are recorded (archived_fastqs), so a FASTQ which is in more than one
+project folder (e.g. a re-analysed sample) is only archived once.
+
+The ledger replaces the text file of archived project IDs (config.path_to_archived_project_ids). When a new ledger is
+created the text file is imported, or it can be imported with:
+	python archer_archive_ledger.py import [path to text file]
+"""
+
+import sqlite3, threading, datetime, argparse, json
+import archer_archive_config as config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archived_projects (
+	archer_project_id TEXT PRIMARY KEY,
+	project_adx TEXT,
+	dnanexus_project_id TEXT,
+	started_at TEXT,
+	archived_at TEXT,
+	project_bytes INTEGER,
+	uploaded_bytes INTEGER
+);
+CREATE TABLE IF NOT EXISTS project_state (
+	archer_project_id TEXT PRIMARY KEY,
+	step TEXT,
+	state TEXT,
+	updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS pending_fastq_deletions (
+	path TEXT PRIMARY KEY,
+	archer_project_id TEXT,
+	project_adx TEXT,
+	queued_at TEXT
+);
+CREATE TABLE IF NOT EXISTS archived_fastqs (
+	md5 TEXT,
+	size INTEGER,
+	archer_project_id TEXT,
+	path TEXT,
+	dnanexus_project_id TEXT,
+	dnanexus_file_id TEXT,
+	archived_at TEXT,
+	PRIMARY KEY (md5, size)
+);
+"""
+
+# steps of archiving a project, in the order they are completed
+# (copied and tarred are only used when the project is staged on the genomics server, see config.transfer_mode)
+# remote_cleaned is reached when the project folder on the archer server is emptied and fastqs_queued when the project's fastqs are
+# added to the pending fastq deletions, which are deleted for all projects at once at the end of the run
+ARCHIVING_STEPS = ["listed", "copied", "tarred", "uploaded", "remote_cleaned", "fastqs_queued", "ledgered", "local_cleaned"]
+
+
+def step_reached(step, target_step):
+	"""
+	Returns True if step (the last step completed for a project, or None) is target_step or a later step
+	"""
+	if step is None:
+		return False
+	return ARCHIVING_STEPS.index(step) >= ARCHIVING_STEPS.index(target_step)
+
+
+def timestamp():
+	return '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
+
+
+class ArchivedProjectsLedger():
+	def __init__(self, path=config.path_to_archived_projects_ledger, import_path=config.path_to_archived_project_ids):
+		"""
+		Open the ledger at path, creating it (and importing the text file at import_path, if it exists) if it does not exist
+		"""
+		self.path = path
+		self._lock = threading.Lock()
+		# the connection is shared by the threads of this process, access is serialised by self._lock
+		self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		with self._lock:
+			new_ledger = not self.connection.execute(
+				"SELECT name FROM sqlite_master WHERE type='table' AND name='archived_projects'").fetchone()
+			self.connection.executescript(SCHEMA)
+		self.archived_ids = set()
+		if new_ledger and import_path:
+			self.import_text_file(import_path)
+		self.archived_ids = set(row[0] for row in self.connection.execute("SELECT archer_project_id FROM archived_projects"))
+
+	def is_archived(self, archer_project_ID):
+		"""
+		Returns True if the archer project is in the ledger
+		Projects not in the set loaded when the ledger was opened are looked up by primary key, in case they have been recorded by another process
+		"""
+		if archer_project_ID in self.archived_ids:
+			return True
+		with self._lock:
+			row = self.connection.execute(
+				"SELECT 1 FROM archived_projects WHERE archer_project_id = ?", (archer_project_ID,)).fetchone()
+		if row:
+			self.archived_ids.add(archer_project_ID)
+		return bool(row)
+
+	def record(self, archer_project_ID, project_adx=None, dnanexus_project_id=None, started_at=None, project_bytes=None, uploaded_bytes=None):
+		"""
+		Add (or update) the record for an archived project
+		"""
+		with self._lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				self.connection.execute(
+					"INSERT OR REPLACE INTO archived_projects VALUES (?, ?, ?, ?, ?, ?, ?)",
+					(archer_project_ID, project_adx, dnanexus_project_id, started_at, timestamp(), project_bytes, uploaded_bytes))
+				self.connection.execute("COMMIT")
+			except Exception:
+				self.connection.execute("ROLLBACK")
+				raise
+		self.archived_ids.add(archer_project_ID)
+
+	def compression_ratio(self):
+		"""
+		Returns the ratio of bytes uploaded to project bytes across all archived projects which recorded both, or None if there are none
+		"""
+		with self._lock:
+			uploaded_bytes, project_bytes = self.connection.execute(
+				"SELECT SUM(uploaded_bytes), SUM(project_bytes) FROM archived_projects WHERE uploaded_bytes > 0 AND project_bytes > 0").fetchone()
+		if not project_bytes:
+			return None
+		return uploaded_bytes / project_bytes
+
+	def project_state(self, archer_project_ID):
+		"""
+		Returns the last archiving step completed for the project and the saved state (dict), or (None, {}) if no state is saved
+		"""
+		with self._lock:
+			row = self.connection.execute(
+				"SELECT step, state FROM project_state WHERE archer_project_id = ?", (archer_project_ID,)).fetchone()
+		if row:
+			return row[0], json.loads(row[1])
+		return None, {}
+
+	def save_state(self, archer_project_ID, step, state):
+		"""
+		Save the last archiving step completed for the project and the state (dict, saved as JSON) needed to resume from it
+		"""
+		with self._lock:
+			self.connection.execute(
+				"INSERT OR REPLACE INTO project_state VALUES (?, ?, ?, ?)",
+				(archer_project_ID, step, json.dumps(state), timestamp()))
+
+	def clear_state(self, archer_project_ID):
+		"""
+		Remove the saved state of a project once it is fully archived
+		"""
+		with self._lock:
+			self.connection.execute("DELETE FROM project_state WHERE archer_project_id = ?", (archer_project_ID,))
+
+	def queue_fastq_deletions(self, archer_project_ID, project_adx, paths):
+		"""
+		Add the paths of a project's fastqs on the archer server to the pending fastq deletions
+		"""
+		with self._lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			self.connection.executemany("INSERT OR REPLACE INTO pending_fastq_deletions VALUES (?, ?, ?, ?)",
+				[(path, archer_project_ID, project_adx, timestamp()) for path in paths])
+			self.connection.execute("COMMIT")
+
+	def pending_fastq_deletions(self):
+		"""
+		Returns (path, archer project ID, ADX project name) for every fastq waiting to be deleted, in the order they were queued
+		"""
+		with self._lock:
+			return self.connection.execute(
+				"SELECT path, archer_project_id, project_adx FROM pending_fastq_deletions ORDER BY queued_at, path").fetchall()
+
+	def fastq_deletions_done(self, paths):
+		"""
+		Remove deleted fastqs from the pending fastq deletions
+		"""
+		with self._lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			self.connection.executemany("DELETE FROM pending_fastq_deletions WHERE path = ?", [(path,) for path in paths])
+			self.connection.execute("COMMIT")
+
+	def archived_fastq_sizes(self):
+		"""
+		Returns the set of sizes of the archived FASTQs, so only FASTQs of one of these sizes need to be checksummed to find duplicates
+		"""
+		with self._lock:
+			return set(row[0] for row in self.connection.execute("SELECT DISTINCT size FROM archived_fastqs"))
+
+	def find_archived_fastq(self, md5, size):
+		"""
+		Returns the record of the archived FASTQ with the md5 checksum and size (dict: archer_project_id, path in the project tar,
+		dnanexus_project_id and dnanexus_file_id of the project tar), or None if it has not been archived
+		"""
+		with self._lock:
+			row = self.connection.execute(
+				"SELECT archer_project_id, path, dnanexus_project_id, dnanexus_file_id FROM archived_fastqs WHERE md5 = ? AND size = ?",
+				(md5, size)).fetchone()
+		if row:
+			return dict(zip(["archer_project_id", "path", "dnanexus_project_id", "dnanexus_file_id"], row))
+		return None
+
+	def record_archived_fastqs(self, archer_project_ID, dnanexus_project_id, dnanexus_file_id, fastqs):
+		"""
+		Record the FASTQs archived in a project tar. fastqs is a list of (md5 checksum, size, path in the tar)
+		dnanexus_file_id is the DNAnexus file ID of the tar (None if not known). FASTQs already recorded keep their first record
+		"""
+		with self._lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			self.connection.executemany("INSERT OR IGNORE INTO archived_fastqs VALUES (?, ?, ?, ?, ?, ?, ?)",
+				[(md5, size, archer_project_ID, path, dnanexus_project_id, dnanexus_file_id, timestamp()) for md5, size, path in fastqs])
+			self.connection.execute("COMMIT")
+
+	def import_text_file(self, path):
+		"""
+		Import the archer project IDs from the text file of archived projects (one ID per line)
+		Projects already in the ledger are left unchanged
+		Returns the number of projects imported
+		"""
+		try:
+			with open(path) as archived_projects_list:
+				archer_project_IDs = [line.strip() for line in archived_projects_list if line.strip()]
+		except FileNotFoundError:
+			return 0
+		with self._lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			before = self.connection.total_changes
+			self.connection.executemany(
+				"INSERT OR IGNORE INTO archived_projects (archer_project_id, archived_at) VALUES (?, ?)",
+				[(archer_project_ID, None) for archer_project_ID in archer_project_IDs])
+			imported = self.connection.total_changes - before
+			self.connection.execute("COMMIT")
+		self.archived_ids.update(archer_project_IDs)
+		return imported
+
+	def close(self):
+		self.connection.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Ledger of archer projects archived to DNAnexus")
+	commands = parser.add_subparsers(dest="command")
+	commands.required = True
+	import_parser = commands.add_parser("import", help="import the text file of archived archer project IDs into the ledger")
+	import_parser.add_argument("path", nargs="?", default=config.path_to_archived_project_ids, help="path to the text file")
+	args = parser.parse_args()
+	ledger = ArchivedProjectsLedger(import_path=None)
+	print("%s archer projects imported into %s" % (ledger.import_text_file(args.path), ledger.path))
+	ledger.close()
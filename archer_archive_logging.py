@@ -0,0 +1,49 @@
+"""
+Writes log messages to the system log with python's logging module (SysLogHandler), in place of running /usr/bin/logger for every message
+
+Messages keep the format they had when written with /usr/bin/logger, so the Rapid7 and Slack alerts continue to match them.
+The tool name was passed to logger -t unquoted, so the first word of the tool became the syslog tag and the rest of the tool
+was added to the start of the message, e.g. tool "Archer archive" was logged as "Archer: archive <message>".
+logger's default priority (user.notice) is also kept.
+"""
+
+import logging
+from logging.handlers import SysLogHandler
+import archer_archive_config as config
+
+
+class _SysLogHandler(SysLogHandler):
+	"""
+	SysLogHandler which raises errors writing to the system log, so the caller can record the failure
+	(by default logging prints the error to stderr and carries on)
+	"""
+	priority_map = dict(SysLogHandler.priority_map, INFO="notice")
+
+	def handleError(self, record):
+		raise
+
+
+def syslog_message(message, tool):
+	"""
+	Returns the message as it was written to the system log by /usr/bin/logger -t tool
+	"""
+	tag, _, tool_words = tool.partition(" ")
+	if tool_words:
+		return "%s: %s %s" % (tag, tool_words, message)
+	return "%s: %s" % (tag, message)
+
+
+def get_syslog_logger(address=config.syslog_address):
+	"""
+	Returns the logger which writes to the system log at address (a unix socket path, or a (host, port) tuple), or None if the
+	system log can't be connected to
+	"""
+	try:
+		handler = _SysLogHandler(address=address, facility=SysLogHandler.LOG_USER)
+	except OSError:
+		return None
+	handler.setFormatter(logging.Formatter("%(message)s"))
+	# the logger is not registered with logging.getLogger() so messages are only written to the system log
+	logger = logging.Logger("archer_archive.syslog", logging.INFO)
+	logger.addHandler(handler)
+	return logger
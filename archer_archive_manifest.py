@@ -0,0 +1,107 @@
+"""
+Manifest of the copy of a project folder on the genomics server
+When a project folder has been copied with rsync the size, modification time and (optionally) md5 checksum of every file in the copy is
+written to a manifest next to it (<copy_location>/<archer project ID>_manifest.json).
+On a later run the copy is known to be complete and unchanged, without reading it again or contacting the archer server, if:
+- the files of the project in the inventory of the archer server have the sizes and modification times in the manifest, and
+- the files of the copy have the sizes and modification times in the manifest (checked with stat, or also by md5 checksum if requested)
+The md5 checksums are taken as the copy is read to make the tar where possible (add_checksums()), rather than by reading the copy again.
+"""
+
+import hashlib, json, os
+
+# rsync keeps partly transferred files here (inside the project folder) so an interrupted copy can be resumed (see config.rsync_options)
+PARTIAL_DIR = ".rsync-partial"
+
+
+def manifest_path(copy_location, archer_project_ID):
+	return os.path.join(copy_location, "%s_manifest.json" % (archer_project_ID))
+
+
+def file_md5(path):
+	"""
+	Returns the md5 checksum of the file at path
+	"""
+	md5 = hashlib.md5()
+	with open(path, "rb") as local_file:
+		for chunk in iter(lambda: local_file.read(1024 * 1024), b""):
+			md5.update(chunk)
+	return md5.hexdigest()
+
+
+def build_manifest(folder, checksums=True):
+	"""
+	Returns the manifest of the files in folder: {path relative to folder: {"size", "mtime" and, if checksums, "md5"}}
+	"""
+	manifest = {}
+	for root, folders, files in os.walk(folder):
+		if PARTIAL_DIR in folders:
+			folders.remove(PARTIAL_DIR)
+		for file_name in files:
+			path = os.path.join(root, file_name)
+			stat = os.stat(path)
+			entry = {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+			if checksums:
+				entry["md5"] = file_md5(path)
+			manifest[os.path.relpath(path, folder)] = entry
+	return manifest
+
+
+def add_checksums(path, md5s):
+	"""
+	Add md5 checksums ({path relative to the project folder: md5}, e.g. taken as the project tar was made) to the manifest at path
+	"""
+	manifest = read_manifest(path)
+	if manifest is None:
+		return
+	for file_path, md5 in md5s.items():
+		if file_path in manifest:
+			manifest[file_path]["md5"] = md5
+	write_manifest(path, manifest)
+
+
+def write_manifest(path, manifest):
+	# written to a temporary file then moved, so a manifest is never partly written
+	temporary_path = "%s.tmp" % (path)
+	with open(temporary_path, "w") as manifest_file:
+		json.dump(manifest, manifest_file, indent=1)
+	os.replace(temporary_path, path)
+
+
+def read_manifest(path):
+	"""
+	Returns the manifest at path, or None if there isn't one
+	"""
+	try:
+		with open(path) as manifest_file:
+			return json.load(manifest_file)
+	except (OSError, ValueError):
+		return None
+
+
+def remote_differences(manifest, file_records):
+	"""
+	Returns the paths which differ between the manifest and file_records (the project's {path: FileRecord} from the inventory)
+	Only files are compared, and modification times to the second (as preserved by rsync -t)
+	"""
+	remote_files = {path: record for path, record in file_records.items() if record.type == "f"}
+	differences = set(manifest) ^ set(remote_files)
+	for path in set(manifest) & set(remote_files):
+		if manifest[path]["size"] != remote_files[path].size or manifest[path]["mtime"] != int(remote_files[path].mtime):
+			differences.add(path)
+	return sorted(differences)
+
+
+def local_differences(manifest, folder, checksums=False):
+	"""
+	Returns the paths which differ between the manifest and the files in folder (by size and modification time, and md5 checksum
+	if checksums is True and the manifest has them)
+	"""
+	local = build_manifest(folder, checksums=False)
+	differences = set(manifest) ^ set(local)
+	for path in set(manifest) & set(local):
+		if manifest[path]["size"] != local[path]["size"] or manifest[path]["mtime"] != local[path]["mtime"]:
+			differences.add(path)
+		elif checksums and "md5" in manifest[path] and manifest[path]["md5"] != file_md5(os.path.join(folder, path)):
+			differences.add(path)
+	return sorted(differences)
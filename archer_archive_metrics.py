@@ -0,0 +1,188 @@
+"""
+Timing and throughput of each stage of an archiving run
+Each stage of each project records its wall time, the bytes it processed, its throughput (MB/s) and the number of subprocesses it ran.
+At the end of a run the records are written next to the script logfile as a JSON report (YYYYMMDD_HHMMSSarchivereport.json)
+and a CSV of the stage records (YYYYMMDD_HHMMSSarchivereport.csv).
+
+The reports from earlier runs can be summarised with:
+	python archer_archive_metrics.py summary [--folder script logfile folder]
+"""
+
+import time, json, csv, glob, os, threading, contextlib, argparse
+import archer_archive_config as config
+
+STAGE_FIELDS = ["archer_project_id", "stage", "started_at", "seconds", "bytes", "mb_per_second", "subprocesses"]
+
+
+def mb_per_second(bytes_processed, seconds):
+	"""
+	Returns the throughput in MB/s, or None if it can't be calculated
+	"""
+	if not bytes_processed or not seconds:
+		return None
+	return round(bytes_processed / (1024 * 1024) / seconds, 3)
+
+
+class RunMetrics():
+	def __init__(self):
+		self.started_at = time.time()
+		# one dict (STAGE_FIELDS) per stage of each project
+		self.stages = []
+		# subprocesses run outside of a stage (e.g. setting up ssh)
+		self.other_subprocesses = 0
+		self._lock = threading.Lock()
+		# the stage being run by each thread, so subprocesses are counted against it
+		self._local = threading.local()
+
+	@contextlib.contextmanager
+	def stage(self, archer_project_ID, stage):
+		"""
+		Time a stage. Yields the stage record; the stage should set record["bytes"] to the number of bytes it processed
+		"""
+		record = {"archer_project_id": archer_project_ID, "stage": stage, "started_at": time.time(), "bytes": None, "subprocesses": 0}
+		previous_record = getattr(self._local, "record", None)
+		self._local.record = record
+		try:
+			yield record
+		finally:
+			self._local.record = previous_record
+			record["seconds"] = round(time.time() - record["started_at"], 3)
+			record["mb_per_second"] = mb_per_second(record["bytes"], record["seconds"])
+			with self._lock:
+				self.stages.append(record)
+
+	def current_stage(self):
+		"""
+		Returns the name of the stage being run by the calling thread, or None
+		"""
+		record = getattr(self._local, "record", None)
+		return record["stage"] if record else None
+
+	def joined_stage(self):
+		"""
+		Returns a context manager which counts the subprocesses run by another thread against the stage being run by the calling
+		thread (e.g. a thread started by the stage), to be entered by that thread
+		"""
+		record = getattr(self._local, "record", None)
+
+		@contextlib.contextmanager
+		def join():
+			previous_record = getattr(self._local, "record", None)
+			self._local.record = record
+			try:
+				yield record
+			finally:
+				self._local.record = previous_record
+		return join()
+
+	def count_subprocess(self):
+		"""
+		Count a subprocess against the stage being run by the calling thread
+		"""
+		record = getattr(self._local, "record", None)
+		# locked, as a stage's record can be shared with threads it started (see joined_stage())
+		with self._lock:
+			if record is None:
+				self.other_subprocesses += 1
+			else:
+				record["subprocesses"] += 1
+
+	def stage_totals(self):
+		"""
+		Returns the total seconds, bytes and subprocesses of each stage across all projects, with the overall throughput
+		"""
+		totals = {}
+		for record in self.stages:
+			total = totals.setdefault(record["stage"], {"count": 0, "seconds": 0, "bytes": 0, "subprocesses": 0})
+			total["count"] += 1
+			total["seconds"] += record["seconds"]
+			total["bytes"] += record["bytes"] or 0
+			total["subprocesses"] += record["subprocesses"]
+		for total in totals.values():
+			total["seconds"] = round(total["seconds"], 3)
+			total["mb_per_second"] = mb_per_second(total["bytes"], total["seconds"])
+		return totals
+
+	def write_report(self, report_path_prefix, run_details):
+		"""
+		Write the JSON report (run_details, the stage totals and every stage record) and the CSV of stage records
+		report_path_prefix is the path of the report without the extension
+		Returns the path of the JSON report
+		"""
+		report = dict(run_details)
+		report.update({
+			"started_at": self.started_at,
+			"seconds": round(time.time() - self.started_at, 3),
+			"subprocesses": sum(record["subprocesses"] for record in self.stages) + self.other_subprocesses,
+			"stage_totals": self.stage_totals(),
+			"stages": self.stages,
+		})
+		with open(report_path_prefix + ".json", "w") as report_file:
+			json.dump(report, report_file, indent=1)
+		with open(report_path_prefix + ".csv", "w", newline="") as csv_file:
+			writer = csv.DictWriter(csv_file, fieldnames=STAGE_FIELDS, extrasaction="ignore")
+			writer.writeheader()
+			writer.writerows(self.stages)
+		return report_path_prefix + ".json"
+
+
+def load_reports(folder=config.script_logfile_folder):
+	"""
+	Returns the JSON reports of earlier runs in folder, oldest first
+	"""
+	reports = []
+	for report_path in sorted(glob.glob(os.path.join(folder, "*archivereport.json"))):
+		try:
+			with open(report_path) as report_file:
+				reports.append(json.load(report_file))
+		except (OSError, ValueError):
+			continue
+	return reports
+
+
+def historical_throughput(reports):
+	"""
+	Returns the throughput (MB/s) of each stage across all reports (total bytes / total seconds)
+	"""
+	totals = {}
+	for report in reports:
+		for stage, stage_total in report.get("stage_totals", {}).items():
+			# only stages which recorded the bytes they processed give a throughput
+			if stage_total.get("bytes"):
+				total = totals.setdefault(stage, [0, 0])
+				total[0] += stage_total["bytes"]
+				total[1] += stage_total["seconds"]
+	return {stage: mb_per_second(total_bytes, seconds) for stage, (total_bytes, seconds) in totals.items()}
+
+
+def summary(folder=config.script_logfile_folder):
+	"""
+	Print one line per run (time, projects archived, subprocesses, ssh connections and the time and throughput of the main stages),
+	followed by the throughput of each stage across all runs
+	"""
+	reports = load_reports(folder)
+	stages = ["inventory", "copy", "tar", "upload", "cleanup"]
+	print("%-17s %8s %9s %6s %5s %s" % ("run", "seconds", "archived", "procs", "ssh", " ".join("%18s" % (stage) for stage in stages)))
+	for report in reports:
+		stage_columns = []
+		for stage in stages:
+			total = report.get("stage_totals", {}).get(stage)
+			if total:
+				stage_columns.append("%18s" % ("%ss %sMB/s" % (int(total["seconds"]), total["mb_per_second"] or "-")))
+			else:
+				stage_columns.append("%18s" % ("-"))
+		archived = len([outcome for outcome in report.get("project_results", {}).values() if outcome == "archived"])
+		print("%-17s %8s %9s %6s %5s %s" % (report.get("run", "-"), int(report["seconds"]), archived, report["subprocesses"],
+			report.get("ssh_connections", "-"), " ".join(stage_columns)))
+	print("Throughput across %s runs (MB/s): %s" % (len(reports), ", ".join(
+		"%s %s" % (stage, throughput) for stage, throughput in sorted(historical_throughput(reports).items()))))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Timing and throughput reports of archer archiving runs")
+	commands = parser.add_subparsers(dest="command")
+	commands.required = True
+	summary_parser = commands.add_parser("summary", help="summarise the reports of earlier runs")
+	summary_parser.add_argument("--folder", default=config.script_logfile_folder, help="folder containing the reports")
+	args = parser.parse_args()
+	summary(args.folder)
@@ -0,0 +1,193 @@
+"""
+Dry run plan of an archiving run
+The plan is made from the inventory of the archer server (one ssh command), the ledger of archived projects and the DNAnexus project
+index, so no data is copied, uploaded or deleted. For each project it gives the action the run would take, the ADX project name and
+DNAnexus project matched, the bytes that would be freed on the archer server and uploaded, and the time the transfer and compression
+would take, estimated from the throughput of earlier runs (archer_archive_metrics) and the compression ratio of archived projects.
+
+Run with:
+	python archer_archive_script.py --plan
+The plan is printed and written next to the script logfile as JSON (YYYYMMDD_HHMMSSarchiveplan.json) and TSV (YYYYMMDD_HHMMSSarchiveplan.tsv).
+"""
+
+import json, csv, shutil
+import archer_archive_config as config
+import archer_archive_ledger
+import archer_archive_metrics
+
+PLAN_FIELDS = ["archer_project_id", "action", "project_adx", "dnanexus_project_id", "dnanexus_project_name", "bytes_freed", "upload_bytes",
+	"transfer_seconds", "compress_seconds", "estimated_seconds"]
+
+# actions of projects which would be archived by the run
+ARCHIVE_ACTIONS = ("archive", "resume")
+
+
+def estimate_seconds(bytes_to_process, mb_per_second):
+	"""
+	Returns the seconds to process bytes_to_process at mb_per_second, or None if there is no throughput to estimate from
+	"""
+	if not bytes_to_process:
+		return 0
+	if not mb_per_second:
+		return None
+	return round(bytes_to_process / (1024 * 1024) / mb_per_second, 1)
+
+
+def stop_reason(seconds, bytes_freed, archer_free_bytes):
+	"""
+	Returns the reason no more projects should be started, given the seconds since the run started, the bytes freed (and being freed)
+	on the archer server and the bytes free on the archer server when the run started, or None if projects can still be started
+	(see config.time_budget_seconds, config.bytes_to_free_target and config.archer_free_space_goal_bytes)
+	"""
+	if config.time_budget_seconds is not None and seconds > config.time_budget_seconds:
+		return "time budget of %s seconds used" % (config.time_budget_seconds)
+	if config.bytes_to_free_target is not None and bytes_freed >= config.bytes_to_free_target:
+		return "target of %s bytes to free reached" % (config.bytes_to_free_target)
+	if (config.archer_free_space_goal_bytes is not None and archer_free_bytes is not None
+			and archer_free_bytes + bytes_freed >= config.archer_free_space_goal_bytes):
+		return "goal of %s bytes free on the archer server reached" % (config.archer_free_space_goal_bytes)
+	return None
+
+
+class ArchivePlanner():
+	"""
+	Makes the plan of an archiving run
+	inventory is an archer_archive_inventory.ArcherInventory, ledger an archer_archive_ledger.ArchivedProjectsLedger and
+	dnanexus_projects an archer_archive_dnanexus.DNAnexusProjectIndex
+	throughput is the MB/s of each stage (by default from the reports of earlier runs) and compression_ratio the ratio of bytes
+	uploaded to project bytes (by default from the ledger, or 1 if no projects recorded it)
+	"""
+	def __init__(self, inventory, ledger, dnanexus_projects, transfer_mode=config.transfer_mode, throughput=None, compression_ratio=None):
+		self.inventory = inventory
+		self.ledger = ledger
+		self.dnanexus_projects = dnanexus_projects
+		self.transfer_mode = transfer_mode
+		if throughput is None:
+			throughput = archer_archive_metrics.historical_throughput(archer_archive_metrics.load_reports())
+		self.throughput = throughput
+		self.compression_ratio = compression_ratio or ledger.compression_ratio() or 1.0
+
+	def plan_project(self, archer_project_ID):
+		"""
+		Returns the plan of one project (dict of PLAN_FIELDS)
+		"""
+		row = dict.fromkeys(PLAN_FIELDS)
+		row["archer_project_id"] = archer_project_ID
+		step, state = self.ledger.project_state(archer_project_ID)
+		if archer_archive_ledger.step_reached(step, "listed"):
+			# as in the run, a part archived project is resumed without the checks, as its folder may already have been removed
+			# from the archer server. Its ADX project name and size were saved when it was listed
+			project_adx = state["project_adx"]
+			project_bytes = state["project_bytes"]
+			fastq_bytes = state.get("fastq_bytes", 0)
+		else:
+			if self.ledger.is_archived(archer_project_ID):
+				row["action"] = "skip: previously archived"
+				return row
+			if not self.inventory.is_archived(archer_project_ID):
+				row["action"] = "skip: not archived on Archer platform"
+				return row
+			project_adx = self.inventory.project_adx(archer_project_ID)
+			if not project_adx:
+				row["action"] = "skip: no ADX project name"
+				return row
+			project_bytes = self.inventory.project_bytes(archer_project_ID)
+			fastq_bytes = self.inventory.fastq_bytes(project_adx)
+		row["project_adx"] = project_adx
+		row["bytes_freed"] = project_bytes + fastq_bytes
+		try:
+			matching_projects = self.dnanexus_projects.find(project_adx)
+		except Exception as error:
+			# the DNAnexus projects couldn't be listed (e.g. an authentication or network error)
+			row["action"] = "fail: unable to list DNAnexus projects: %s" % (error)
+			return row
+		if len(matching_projects) == 1:
+			row["dnanexus_project_id"], row["dnanexus_project_name"] = matching_projects[0]
+		elif not archer_archive_ledger.step_reached(step, "uploaded"):
+			row["action"] = "fail: %s DNAnexus projects match %s" % (len(matching_projects), project_adx)
+			return row
+		row["action"] = "resume after %s" % (step) if step else "archive"
+		# estimate the stages still to run (the upload stage of a streamed project includes the tar and compression)
+		# the FASTQs archived with earlier projects are not copied, tarred or uploaded
+		copy_bytes = state.get("copy_bytes", project_bytes)
+		upload_bytes = state.get("uploaded_bytes") or int(copy_bytes * self.compression_ratio)
+		copy_seconds = compress_seconds = upload_seconds = 0
+		# a tar streamed by an earlier run (tar_file_id saved before uploaded) is not made or uploaded again
+		tar_uploaded = archer_archive_ledger.step_reached(step, "uploaded") or "tar_file_id" in state
+		if self.transfer_mode == "staged" and not tar_uploaded and not archer_archive_ledger.step_reached(step, "copied"):
+			copy_seconds = estimate_seconds(copy_bytes, self.throughput.get("copy"))
+		if self.transfer_mode == "staged" and not tar_uploaded and not archer_archive_ledger.step_reached(step, "tarred"):
+			compress_seconds = estimate_seconds(copy_bytes, self.throughput.get("tar"))
+		if not tar_uploaded:
+			row["upload_bytes"] = upload_bytes
+			upload_seconds = estimate_seconds(upload_bytes, self.throughput.get("upload"))
+		row["transfer_seconds"] = None if None in (copy_seconds, upload_seconds) else copy_seconds + upload_seconds
+		row["compress_seconds"] = compress_seconds
+		if None not in (row["transfer_seconds"], compress_seconds):
+			row["estimated_seconds"] = row["transfer_seconds"] + compress_seconds
+		return row
+
+	def plan(self, archer_project_IDs):
+		"""
+		Returns the plan of each project (in the order they would be archived), applying the limits of the run scheduler:
+		projects are not started once the time budget, bytes to free target or free space goal is reached (using the estimated
+		time of the projects before them), or if there isn't space for the project in copy_location
+		"""
+		rows = []
+		bytes_freed = 0
+		seconds = 0
+		for archer_project_ID in archer_project_IDs:
+			row = self.plan_project(archer_project_ID)
+			rows.append(row)
+			if not row["action"].startswith(ARCHIVE_ACTIONS):
+				continue
+			reason = stop_reason(seconds, bytes_freed, self.inventory.archer_free_bytes)
+			if not reason and self.transfer_mode == "staged" and row["action"] == "archive":
+				local_bytes = self.inventory.project_bytes(archer_project_ID) * 2
+				if local_bytes > shutil.disk_usage(config.copy_location).free - config.local_free_space_headroom_bytes:
+					reason = "not enough space in %s for %s bytes" % (config.copy_location, local_bytes)
+			if reason:
+				row["action"] = "not started: %s" % (reason)
+				continue
+			bytes_freed += row["bytes_freed"]
+			# projects archived at the same time share the run time
+			seconds += (row["estimated_seconds"] or 0) / max(1, config.project_workers)
+		return rows
+
+
+def format_plan(rows):
+	"""
+	Returns the plan as lines of text: one line per project followed by the totals of the projects which would be archived
+	"""
+	def size(bytes_count):
+		return "-" if bytes_count is None else "%.1f" % (bytes_count / (1024 * 1024))
+
+	def duration(seconds):
+		return "-" if seconds is None else "%d" % (seconds)
+
+	lines = ["%-8s %-10s %-30s %10s %10s %10s %10s  %s" % (
+		"project", "ADX", "DNAnexus project", "freed MB", "upload MB", "transfer s", "compress s", "action")]
+	for row in rows:
+		lines.append("%-8s %-10s %-30s %10s %10s %10s %10s  %s" % (row["archer_project_id"], row["project_adx"] or "-",
+			row["dnanexus_project_name"] or "-", size(row["bytes_freed"]), size(row["upload_bytes"]), duration(row["transfer_seconds"]),
+			duration(row["compress_seconds"]), row["action"]))
+	archived = [row for row in rows if row["action"].startswith(ARCHIVE_ACTIONS)]
+	estimates = [row["estimated_seconds"] for row in archived]
+	lines.append("%s of %s projects would be archived, freeing %s MB on the archer server and uploading %s MB, estimated %s seconds%s" % (
+		len(archived), len(rows), size(sum(row["bytes_freed"] for row in archived)), size(sum(row["upload_bytes"] or 0 for row in archived)),
+		duration(sum(estimate or 0 for estimate in estimates)), " (no throughput recorded for some stages)" if None in estimates else ""))
+	return lines
+
+
+def write_plan(rows, plan_path_prefix):
+	"""
+	Write the plan as JSON and TSV. plan_path_prefix is the path of the plan without the extension
+	Returns the path of the JSON plan
+	"""
+	with open(plan_path_prefix + ".json", "w") as plan_file:
+		json.dump(rows, plan_file, indent=1)
+	with open(plan_path_prefix + ".tsv", "w", newline="") as tsv_file:
+		writer = csv.DictWriter(tsv_file, fieldnames=PLAN_FIELDS, delimiter="\t")
+		writer.writeheader()
+		writer.writerows(rows)
+	return plan_path_prefix + ".json"
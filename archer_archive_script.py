@@ -2,34 +2,107 @@
 to check for archived folders on the archer server and upload to the DNANexus project
 on the archer platform projects are archived after 45 days. 
 All project files are in a folder named with an integer (e.g. 4767) in /var/www/analysis
+Take an inventory of every file in /var/www/analysis with a single remote command
 Look through folders and identify those not on the already archived list
 Then look in each project folder for a file named [projectno].tar.gz
 If tar.gz file present project is archived on the Archer platform and can be backed up to DNAnexus
 List the contents and locations of all files in the project folder (including the symlinks to the FASTQs) and save as a file
 Capture the project name from other files in the folder (i.e. ADX21030)
+Checksum the FASTQs in the project folder which may have been archived with an earlier project, so they are not copied and uploaded again
 Transfer the project folder to the genomics server with rsync
 make tar.gz of the whole project folder
 Find the matching project in DNANexus 
 Upload it to DNA Nexus along with the locations file and delete from the genomics server
-add archer project id (e.g. 4767) to the list of archived projects
-#TODO consider possible edge case for archer project ids that are >4 or <4 characters. ?possible these would not be handled well by this section of th script
+add archer project id (e.g. 4767) to the ledger of archived projects
+Archer project ids are the names of folders made only of digits, of any length (e.g. 999, 4767 or 10234)
 
 This script was developed by the Viapath Genome Informatics team
 July 2022
 """
 
-import os, datetime, subprocess
+import os, datetime, subprocess, threading, io, tempfile, argparse, shutil, contextlib, time, shlex
+import concurrent.futures
 import git_tag
 import archer_archive_config as config
+import archer_archive_ssh
+import archer_archive_inventory
+import archer_archive_dnanexus
+import archer_archive_compress
+import archer_archive_ledger
+import archer_archive_logging
+import archer_archive_metrics
+import archer_archive_plan
+import archer_archive_manifest
+import archer_archive_daemon
+import archer_archive_async
+import archer_archive_throttle
 
 class ArcherArchive():
-	def __init__(self):
-		self.now = str('{:%Y%m%d_%H%M%S}'.format(datetime.datetime.now()))
-		# Set script log file path and name
+	def __init__(self, transfer_mode=config.transfer_mode):
+		# read the DNAnexus token now so a missing token file stops the run before anything is done
+		self.nexus_api_key = config.Nexus_API_Key
+		# "staged" or "streaming" (see config.transfer_mode)
+		self.transfer_mode = transfer_mode
+		# Set script log file path
 		self.script_logfile_path = config.script_logfile_folder
+		self._script_logfile = None
+		# logger writing to the system log (None if the system log can't be connected to)
+		self.syslog = archer_archive_logging.get_syslog_logger(config.syslog_address)
+		# per-thread state, used to hold the log buffer of the project being archived by that thread
+		self._local = threading.local()
+		self._log_lock = threading.Lock()
+		# one semaphore per stage, bounding how many projects can be in that stage at the same time
+		self.stage_slots = {stage: threading.BoundedSemaphore(size) for stage, size in config.stage_pool_sizes.items()}
+		self._schedule = threading.Condition()
+		# set to stop new projects being started (e.g. when the daemon is shutting down)
+		self.stopping = threading.Event()
+		self.start_run()
+		# event loop running the shell commands (None when they are run with subprocess.Popen, see config.subprocess_engine)
+		self.async_runner = archer_archive_async.AsyncRunner() if config.subprocess_engine == "asyncio" else None
+		# builds the commands run on the archer server, sent down a single ssh connection when config.ssh_multiplex is True
+		self.archer = archer_archive_ssh.ArcherConnection(self.execute_subprocess_command)
+		# bandwidth and priority limits of the current time of day (see archer_archive_throttle)
+		self.throttle = archer_archive_throttle.Throttle(archer_load=self.archer_load,
+			log=lambda message: self.logger(message, "Archer archive throttle"))
+		# index of DNAnexus projects by ADX project name, made once and cached between runs
+		self.dnanexus_projects = archer_archive_dnanexus.DNAnexusProjectIndex(cache_path=config.path_to_dnanexus_project_cache)
+		# ledger of archived projects, loaded once per run
+		self.ledger = archer_archive_ledger.ArchivedProjectsLedger(config.path_to_archived_projects_ledger, config.path_to_archived_project_ids)
+		# index of the project folders on the archer server, populated by take_archer_inventory()
+		self.inventory = archer_archive_inventory.ArcherInventory()
+
+	def start_run(self):
+		"""
+		Start a new run: open a new script logfile and reset the outcomes and metrics of the run
+		Called when the script starts, and at the start of each cycle in daemon mode (see archer_archive_daemon)
+		"""
+		self.now = str('{:%Y%m%d_%H%M%S}'.format(datetime.datetime.now()))
 		self.logfile_name = self.script_logfile_path + "/" + self.now + "archivelog.txt"
-		# Open the script logfile for logging throughout script.
-		self.script_logfile = open(self.logfile_name, 'a')
+		# Open the script logfile for logging throughout script. Line buffered, so each line is written to the file as it is logged
+		if self._script_logfile is not None:
+			self._script_logfile.close()
+		self._script_logfile = open(self.logfile_name, 'a', buffering=1)
+		# outcome of each project processed in this run, keyed by archer project ID
+		self.project_results = {}
+		# time, bytes and subprocesses of each stage of each project, written to the run report
+		self.metrics = archer_archive_metrics.RunMetrics()
+		# bytes freed on the archer server in this run, and expected to be freed by projects being archived (see reserve_space())
+		self.bytes_freed = 0
+		self.bytes_being_freed = {}
+		# bytes of copy_location reserved by projects being archived
+		self.local_bytes_reserved = 0
+
+	@property
+	def script_logfile(self):
+		"""
+		The script logfile for the calling thread.
+		While a project is being archived by archive_project() on the thread pool, log lines are held in a per-project buffer,
+		so that projects archived concurrently do not interleave in the script logfile
+		"""
+		project_log = getattr(self._local, "project_log", None)
+		if project_log is None:
+			return self._script_logfile
+		return project_log
 	
 	def set_up_ssh_known_hosts(self):
 		"""
@@ -43,61 +116,142 @@ class ArcherArchive():
 		# use ssh-keyscan to get the key and add it in.
 		# repeat the ssh-keygen command - this should now return a string which includes "# Host grpvgaa01.viapath.local found" - stdout can be tested for this
 		# NB expect some outputs in stderr from the ssh-keyscan command at this stage
+		# not required when commands are run in a local shell in place of the archer server
+		if config.archer_local_shell:
+			return True
 		cmd="mkdir -p ~/.ssh; touch ~./ssh/known_hosts;\
-			if [ -z $(ssh-keygen -F grpvgaa01.viapath.local) ]; then \
-				ssh-keyscan -H grpvgaa01.viapath.local >> ~/.ssh/known_hosts; fi; ssh-keygen -F grpvgaa01.viapath.local"
+			if [ -z $(ssh-keygen -F %s) ]; then \
+				ssh-keyscan -H %s >> ~/.ssh/known_hosts; fi; ssh-keygen -F %s" % (
+					config.archer_server, config.archer_server, config.archer_server)
 		self.script_logfile.write("\tCommand to set up ssh known hosts: '%s'\n" % (cmd))
 		out, err = self.execute_subprocess_command(cmd)
 
-		if self.success_in_stdout(out, "Host grpvgaa01.viapath.local found"):
+		if self.success_in_stdout(out, "Host %s found" % (config.archer_server)):
 			self.logger("host added to known hosts ok", "Archer archive SSH set up")
 			return True
 		else:
 			self.logger("host NOT added to known hosts", "Archer archive SSH set up") # Rapid7 alert set up
 			return False
 
-	def list_archer_projects(self):
+	def open_archer_connection(self):
 		"""
-		List all projects in /var/www/analysis on the Archer platform (when config.testing=True it looks in /var/www/analysis/test1 instead)
-		Yields project ids (format 4 digits e.g.4690)
+		Open the ssh connection to the archer server which is reused by all commands in this run
+		Returns True if successful
+		"""
+		if self.archer.open():
+			self.logger("ssh connection to archer server opened", "Archer archive SSH set up")
+			return True
+		else:
+			# Rapid7 alert set up
+			self.logger("ERROR: failed to open ssh connection to archer server", "Archer archive SSH set up")
+			return False
+
+	def close_archer_connection(self):
+		"""
+		Close the ssh connection to the archer server and record how many ssh connections were opened in this run
+		"""
+		self.archer.close()
+		self.logger("%s ssh connection(s) opened to archer server in this run" % (self.archer.connections_opened), "Archer archive SSH set up")
+
+	def close_async_runner(self):
+		"""
+		Kill any commands still running on the asyncio execution core and stop its event loop, once all commands have been run
+		Later commands are run with subprocess.Popen
+		"""
+		if self.async_runner is not None:
+			self.async_runner.close()
+			self.async_runner = None
+
+	def archer_load(self):
+		"""
+		Returns the 1 minute load average of the archer server divided by its number of CPUs, or None if it can't be measured
+		Used by self.throttle to lower the bandwidth limits while the archer server is busy
+		"""
+		out,err = self.execute_subprocess_command(self.archer.ssh_command("echo $(cut -d ' ' -f 1 /proc/loadavg) $(nproc)"))
+		try:
+			load, cpus = out.split()
+			return float(load) / int(cpus)
+		except ValueError:
+			return None
+
+	def archer_analysis_folder(self):
+		"""
+		Returns the folder containing the archer project folders (config.path_to_analysis_test_folder when config.testing=True)
+		"""
+		if config.testing:
+			return config.path_to_analysis_test_folder
+		return config.path_to_analysis_folder
+
+	def archer_picked_up_folder(self):
+		"""
+		Returns the folder containing the fastqs picked up by the archer platform (config.path_to_picked_up_test_files when config.testing=True)
 		"""
-		# ssh on to archer platform using ssh pass and list the contents of /var/www/analysis (/var/www/analysis/test1 when testing)
 		if config.testing:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls %s" % (
-					config.path_to_archerdx_pw, 
-					config.path_to_analysis_test_folder) 
+			return config.path_to_picked_up_test_files
+		return config.path_to_picked_up_files
+
+	def take_archer_inventory(self):
+		"""
+		List every file in /var/www/analysis on the Archer platform (/var/www/analysis/test1 when config.testing=True), the fastqs in
+		picked_up_files and the free space on the archer server in a single remote command
+		The type, size and modification time of each file are held in self.inventory, which is queried by the later steps
+		instead of listing each project folder on the archer server
+		Returns True if successful
+		"""
+		cmd = "%s; echo $?" % (self.archer.ssh_command(archer_archive_inventory.inventory_command(
+			self.archer_analysis_folder(),self.archer_picked_up_folder())))
+		self.script_logfile.write("\tCommand to take inventory of Archer projects: '%s'\n" % (cmd))
+		result = self.run_subprocess_command(cmd)
+		out, err = result.stdout, result.stderr
+		if result.truncated:
+			# the inventory is one null separated line, which is dropped whole when stdout is cut to the output limit
+			# Rapid 7 alert set up
+			self.logger("ERROR: failed to take inventory of Archer server. The inventory is larger than subprocess_output_limit (%s bytes)" % (
+				config.subprocess_output_limit), "Archer archive")
+			return False
+		# the exit status is on the last line
+		inventory_output, _, exit_status = out.rstrip("\n").rpartition("\n")
+		if exit_status.strip() == "0":
+			self.inventory = archer_archive_inventory.ArcherInventory.from_inventory_output(inventory_output)
+			self.logger("Inventory of Archer server taken. %s folders and %s fastqs found. %s bytes free on Archer server" % (
+				len(self.inventory.projects),len(self.inventory.picked_up_fastqs),self.inventory.archer_free_bytes), "Archer archive")
+			return True
 		else:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls %s" % (
-					config.path_to_archerdx_pw, 
-					config.path_to_analysis_folder) 
-		self.script_logfile.write("\tCommand to list Archer projects: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
-		# for each item in the out (list of items in the /var/www/analysis folder) yeild the name if length=4 
-		for folder_name in out.split("\n"):
-			if len(folder_name) == 4:
+			# Rapid 7 alert set up
+			self.logger("ERROR: failed to take inventory of Archer server. Error message: %s" % (err), "Archer archive")
+			return False
+
+	def list_archer_projects(self):
+		"""
+		List all projects in /var/www/analysis on the Archer platform (when config.testing=True it looks in /var/www/analysis/test1 instead)
+		Uses the inventory taken by take_archer_inventory()
+		Yields project ids (digits e.g.4690, of any length)
+		"""
+		# for each folder in the /var/www/analysis folder yield the name if it is a project ID (all digits)
+		# other folders are counted and logged once, rather than logging each one
+		not_identified = 0
+		for folder_name in self.inventory.project_names():
+			if folder_name.isdigit():
 				self.logger("identified project %s" % (folder_name), "Archer archive")
 				yield folder_name
 			else:
-				self.logger("Archer project not identified.", "Archer archive")
+				not_identified += 1
+		if not_identified:
+			self.logger("%s folders not identified as Archer projects." % (not_identified), "Archer archive")
 
 	def check_previously_archived(self,archer_project_ID):
-			"""
-			Check if project is in the list of previously archived projects (config.path_to_archived_project_ids)
-			input: Archer project id (####)
-			output: True/False
-			#TODO consider possible outcomes if eg prev archived run 123 on list, and run 1234 identified. Linked to possibility that archer project ID is not 4 characters (which would cause issues elsewhere)
-			"""
-			archived_runs = open(config.path_to_archived_project_ids)
-			archived_runs_list = archived_runs.read().splitlines()
-			# check if project is on list of previously archived projects. Return True if it is, False if not
-			if archer_project_ID in archived_runs_list:
-				self.logger("Archer project %s is on the list of archived projects. No further archiving required" % (archer_project_ID), "Archer archive")
-				return True
-			else:
-				self.logger("Archer project %s has not previously been archived. Proceed to checking if it is archived on the Archer platform" % (archer_project_ID), "Archer archive")
-				return False
+		"""
+		Check if project is in the ledger of previously archived projects (config.path_to_archived_projects_ledger)
+		input: Archer project id (####)
+		output: True/False
+		"""
+		# check if project is in the ledger of previously archived projects. Return True if it is, False if not
+		if self.ledger.is_archived(archer_project_ID):
+			self.logger("Archer project %s is on the list of archived projects. No further archiving required" % (archer_project_ID), "Archer archive")
+			return True
+		else:
+			self.logger("Archer project %s has not previously been archived. Proceed to checking if it is archived on the Archer platform" % (archer_project_ID), "Archer archive")
+			return False
 
 	def check_project_archived(self,archer_project_ID):
 		"""
@@ -110,104 +264,151 @@ class ArcherArchive():
 			-return the adx project name (ADX###)
 		if not, logs that the project isn't ready for archiving
 			-return None
-		"""		
-		if config.testing:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls %s" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_test_folder,archer_project_ID))
-		else:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls %s" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_folder,archer_project_ID))
-		self.script_logfile.write("\tCommand to list project contents: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
+		The contents of the project folder are taken from the inventory (take_archer_inventory())
+		"""
 		# look through list of contents for file "archer_project_ID.tar.gz"
-		archer_tar = archer_project_ID + ".tar.gz"
-		if archer_tar in out.split("\n"):
-			for file in out.split("\n"):
-				if file.startswith("ADX"):
-					project_adx = file.split("_",1)[0]
-					self.logger("Project %s %s has been archived in Archer software. Can be backed up to DNA Nexus." % (archer_project_ID,project_adx), "Archer archive")
-					return project_adx
+		if self.inventory.is_archived(archer_project_ID):
+			project_adx = self.inventory.project_adx(archer_project_ID)
+			if project_adx:
+				self.logger("Project %s %s has been archived in Archer software. Can be backed up to DNA Nexus." % (archer_project_ID,project_adx), "Archer archive")
+				return project_adx
 		# if no .tar.gz file present file is not ready for archiving
 		else:
 			self.logger("Project %s not yet archived in Archer software. Move on to next project" % (archer_project_ID), "Archer archive")
 			return None
 
-	def list_archer_project_files(self,archer_project_ID):
+	def list_archer_project_files(self,archer_project_ID,project_adx,archived_fastqs=None):
 		"""
-		create txt file with ls -l of the archer project folder
-		takes archer project ID (####) as input
-		Returns the path of the fastq locations file that is created as an item in a list. 
+		create the fastq locations files of the archer project: the type, size, modification time and symlink target of everything in
+		the project folder and of the project's fastqs in the picked_up_files folder, as JSON and TSV (see archer_archive_inventory.write_locations())
+		takes archer project ID (####) and ADX project name as input. The records are taken from the inventory, so no remote command is run
+		FASTQs archived with an earlier project (archived_fastqs, see find_archived_fastqs()) are listed with the DNAnexus file they are stored in
+		Returns the paths of the fastq locations files that are created, as a list
 		"""
-		# echo $? returns exit status of last command, non zero means it's failed
-		fastq_loc_file = "%s_fastq_loc.txt" % (os.path.join(config.fastq_locations_folder,archer_project_ID))
-		if config.testing: #point to analysis_test_folder
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls -l %s > %s; echo $?" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_test_folder,archer_project_ID),
-					fastq_loc_file)
-		else:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls -l %s > %s; echo $?" % (
-					config.path_to_archerdx_pw,
-					os.path.join(config.path_to_analysis_folder,archer_project_ID),
-					fastq_loc_file)
-		self.script_logfile.write("\tCommand to list and record project files: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
-		# check for errors in the stdout
-		if self.success_in_stdout(out.rstrip(), "0"):
-			self.logger("Fastq locations file for project %s generated." % (archer_project_ID), "Archer archive")
-			return [fastq_loc_file] #return the file as a list for downstream processing
+		path_prefix = "%s_fastq_loc" % (os.path.join(config.fastq_locations_folder,archer_project_ID))
+		folders = {archer_archive_inventory.ANALYSIS: os.path.join(self.archer_analysis_folder(),archer_project_ID),
+			archer_archive_inventory.PICKED_UP: self.archer_picked_up_folder()}
+		try:
+			fastq_loc_files = archer_archive_inventory.write_locations(path_prefix, archer_project_ID, project_adx, folders,
+				self.inventory.locations(archer_project_ID, project_adx, archived_fastqs))
+		except OSError as error:
+			# Rapid 7 alert set up
+			self.logger("ERROR: Failed to generate fastq locations file for project %s. Error message: %s" % (archer_project_ID, error), "Archer archive")
+			return None
+		self.logger("Fastq locations file for project %s generated." % (archer_project_ID), "Archer archive")
+		return fastq_loc_files
+
+	def find_archived_fastqs(self,archer_project_ID):
+		"""
+		Find the FASTQs in the project folder which have already been archived with an earlier project (same md5 checksum and size in
+		the ledger), so they are not copied, tarred and uploaded again
+		The FASTQs are checksummed on the archer server in one remote command (md5sum), which is sent the paths on stdin. Only FASTQs the
+		same size as an archived FASTQ are checksummed, unless the checksums won't be in the copy manifest (streaming transfer mode, or
+		config.copy_manifest_checksums False), when all are checksummed so they can be recorded in the ledger once archived
+		Returns ({path: archived FASTQ record (see archer_archive_ledger.find_archived_fastq()) with its "md5"}, {path: md5 checksum} of the
+		FASTQs checksummed), or None if the checksums failed
+		"""
+		fastqs = self.inventory.project_fastq_records(archer_project_ID)
+		if self.transfer_mode == "staged" and config.copy_manifest_checksums:
+			archived_sizes = self.ledger.archived_fastq_sizes()
+			paths = sorted(path for path, record in fastqs.items() if record.size in archived_sizes)
 		else:
+			paths = sorted(fastqs)
+		if not paths:
+			return {}, {}
+		cmd = "%s; echo $?" % (self.archer.ssh_command("cd %s && xargs -0 %smd5sum --" % (
+			shlex.quote(os.path.join(self.archer_analysis_folder(),archer_project_ID)),self.throttle.priority_prefix())))
+		self.script_logfile.write("\tCommand to checksum %s FASTQs of archer project: '%s'\n" % (len(paths),cmd))
+		out,err = self.execute_subprocess_command(cmd, "".join("%s\0" % (path) for path in paths))
+		lines = out.rstrip("\n").split("\n")
+		if lines[-1] != "0":
 			# Rapid 7 alert set up
-			self.logger("ERROR: Failed to generate fastq locations file for project %s." % (archer_project_ID), "Archer archive")
+			self.logger("ERROR: failed to checksum the FASTQs of archer project %s. Error message: %s" % (archer_project_ID,err), "Archer archive")
 			return None
+		# one line per FASTQ: md5 checksum, two spaces and the path (names md5sum has to escape start with \ and are not matched)
+		md5s = {}
+		for line in lines[:-1]:
+			md5, _, path = line.partition("  ")
+			if path in fastqs:
+				md5s[path] = md5
+		archived = {}
+		for path, md5 in md5s.items():
+			record = self.ledger.find_archived_fastq(md5, fastqs[path].size)
+			if record and record["archer_project_id"] != archer_project_ID:
+				record["md5"] = md5
+				archived[path] = record
+		if archived:
+			self.logger("%s FASTQs (%s bytes) of archer project %s were archived with earlier projects and will not be archived again" % (
+				len(archived),sum(fastqs[path].size for path in archived),archer_project_ID), "Archer archive")
+		return archived, md5s
 
-	def copy_archer_project(self,archer_project_ID):
+	def copy_archer_project(self,archer_project_ID,excluded_paths=()):
 		"""
 		Copy the archer project folder to the genomics server using rsync
 		Only do this if the tar.gz file is present in /var/www/analysis/archer_project_ID (check_project_archived=True) AND no processed runs log for this archer_project_ID (check_if_already_completed=False)
 		folder will be rsync copied to config.copy_location 
 		Input: archer_project_ID
 		Output: If rsync successful returns True
+		The copy is incremental: files already copied by an earlier run are skipped and partly copied files are resumed (config.rsync_options).
+		excluded_paths (relative to the project folder, e.g. FASTQs archived with an earlier project) are not copied
+		The copy is limited to the bandwidth and run at the priority set by self.throttle
+		Once copied, the manifest of the copy is written (see archer_archive_manifest)
 		"""
 		# rsync archer project folder to genomics server. -r recursive, ensures all subfiles and folders copied, -t preserves modification times
 		# echo $? returns exit status of last command, non zero means it's failed
-		if config.testing:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw rsync -rt s_archerupload@grpvgaa01.viapath.local:%s %s;\
-				echo $?" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_test_folder,archer_project_ID),
-					config.copy_location
-					)
-		else:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw rsync -rt s_archerupload@grpvgaa01.viapath.local:%s %s;\
-				echo $?" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_folder,archer_project_ID),
-					config.copy_location
-					)
-		self.script_logfile.write("\tCommand to copy archer project files: '%s'\n" % (cmd))
-		# capture stdout and look for exit code
-		out,err = self.execute_subprocess_command(cmd)
+		with self.throttle.transfer("copy"):
+			rsync_options = config.rsync_options
+			if excluded_paths:
+				# read from stdin, one pattern per line. Patterns starting with / are anchored to the parent of the project folder
+				rsync_options += " --exclude-from=-"
+			# the bandwidth limit is set when the copy starts
+			bandwidth_kbps = self.throttle.bandwidth_kbps("copy")
+			if bandwidth_kbps:
+				rsync_options += " --bwlimit=%s" % (bandwidth_kbps)
+			cmd = "%s; echo $?" % (self.archer.rsync_command(
+				os.path.join(self.archer_analysis_folder(),archer_project_ID),
+				config.copy_location, rsync_options, self.throttle.priority_prefix()))
+			self.script_logfile.write("\tCommand to copy archer project files: '%s'\n" % (cmd))
+			# capture stdout and look for exit code
+			out,err = self.execute_subprocess_command(cmd, "".join("/%s/%s\n" % (archer_project_ID,path) for path in excluded_paths) if excluded_paths else None)
 		if self.success_in_stdout(out.rstrip(), "0"):
+			# with the parallel compression engine the checksums are taken as the tar is made (create_project_tar()), not by reading the copy again
+			checksums = config.copy_manifest_checksums and config.compression_engine != "parallel"
+			archer_archive_manifest.write_manifest(archer_archive_manifest.manifest_path(config.copy_location, archer_project_ID),
+				archer_archive_manifest.build_manifest(os.path.join(config.copy_location, archer_project_ID), checksums))
 			self.logger("folder for Archer project %s copied to genomics server." % (archer_project_ID), "Archer archive")
 			return True
 		else:
 			# Rapid 7 alert set up
-			self.logger("ERROR: Failed to copy Archer project folder" % (archer_project_ID), "Archer archive")	
-			return False		
+			self.logger("ERROR: Failed to copy Archer project folder %s" % (archer_project_ID), "Archer archive")
+			return False
+
+	def copy_still_valid(self,archer_project_ID,excluded_paths=()):
+		"""
+		Returns True if the copy of the project folder made in an earlier run is complete and unchanged, so it does not need copying again
+		The manifest of the copy is compared with the inventory of the archer server (except excluded_paths, which are not copied) and the
+		files of the copy (see archer_archive_manifest), so no data is read from the archer server
+		"""
+		manifest = archer_archive_manifest.read_manifest(archer_archive_manifest.manifest_path(config.copy_location, archer_project_ID))
+		project_folder = os.path.join(config.copy_location, archer_project_ID)
+		if manifest is None or not os.path.isdir(project_folder):
+			return False
+		file_records = {path: record for path, record in self.inventory.project_file_records(archer_project_ID).items() if path not in excluded_paths}
+		remote_differences = archer_archive_manifest.remote_differences(manifest, file_records)
+		local_differences = archer_archive_manifest.local_differences(manifest, project_folder, config.copy_verify_checksums)
+		if remote_differences or local_differences:
+			self.script_logfile.write("\tCopy of archer project %s will be updated: %s files changed on the archer server, %s files changed in the copy\n" % (
+				archer_project_ID, len(remote_differences), len(local_differences)))
+			return False
+		self.logger("Copy of archer project %s made in an earlier run is complete and will be reused" % (archer_project_ID), "Archer archive")
+		return True
 
 	def create_project_tar(self,archer_project_ID):
 		"""
 		create tar archive of the copied project folder
-		Returns tarfile name 
+		With the parallel compression engine the md5 checksum of the tar, and of each file in it (added to the copy manifest when
+		config.copy_manifest_checksums is True), are calculated as the tar is written, so neither is read again
+		Returns (tarfile name, md5 checksum of the tar), or (None, None) if the tar failed
 		"""
 		# cd to the project folder location
 		# c creates an archive
@@ -215,68 +416,206 @@ class ArcherArchive():
 		# z filters the archive through gzip
 		# provide the folder name, not the full filepath to ensure the tar doesn't contain the full path from root
 		# redirect stderr to stdout so we can test for errors
+		# with the parallel compression engine tar writes the uncompressed archive to stdout, which is compressed by compress_command_output()
+		# tar is run at the priority set by self.throttle
 		tarfile_name = "%s.tar.gz" % (archer_project_ID)
-		cmd = "cd %s; tar -czf %s %s 2>&1" % (config.copy_location,tarfile_name,archer_project_ID)
-		self.script_logfile.write("\tCommand to create  tar archive on genomics server: '%s'\n" % (cmd))
-		out, err = self.execute_subprocess_command(cmd)
+		tar_path = os.path.join(config.copy_location,tarfile_name)
+		if config.compression_engine == "parallel":
+			cmd = "cd %s; %star -cf - %s" % (config.copy_location,self.throttle.priority_prefix(),archer_project_ID)
+			self.script_logfile.write("\tCommand to create tar archive on genomics server (compressed with %s threads): '%s'\n" % (self.throttle.compression_workers(),cmd))
+			member_md5s = {} if config.copy_manifest_checksums else None
+			with open(tar_path,"wb") as tar_file:
+				tar_writer = archer_archive_compress.MD5Writer(tar_file)
+				out = self.compress_command_output(cmd,tar_writer,member_md5s)
+			tar_md5 = tar_writer.hexdigest()
+			if not out and member_md5s:
+				# paths in the tar start with the project folder, paths in the manifest are relative to it
+				archer_archive_manifest.add_checksums(archer_archive_manifest.manifest_path(config.copy_location,archer_project_ID),
+					{path.split("/",1)[1]: md5 for path, md5 in member_md5s.items() if "/" in path})
+		else:
+			cmd = "cd %s; %star -czf %s %s 2>&1" % (config.copy_location,self.throttle.priority_prefix(),tarfile_name,archer_project_ID)
+			self.script_logfile.write("\tCommand to create  tar archive on genomics server: '%s'\n" % (cmd))
+			out, err = self.execute_subprocess_command(cmd)
+			tar_md5 = archer_archive_manifest.file_md5(tar_path) if len(out) == 0 else None
 		# assess stdout+stderr - if successful tar does not return any output
 		if len(out) ==0:
 			self.logger("Tar of archer project %s generated successfully" % (archer_project_ID),"Archer archive")
-			return tarfile_name
+			return tarfile_name, tar_md5
 		else:
 			# Rapid 7 alert set up 
 			self.logger("ERROR: failed to generate tar of archer project %s. n\Error message: %s. \nProject will not be archived." % (archer_project_ID,out),"Archer archive")
-			return None
+			return None, None
+
+	def stream_project_to_dnanexus(self,archer_project_ID,dnanexus_projectID,excluded_paths=()):
+		"""
+		Streaming alternative to copy_archer_project(), create_project_tar() and uploading the tar with upload_to_dnanexus()
+		The project folder is archived with tar on the archer server and sent over the ssh connection, compressed with gzip as it arrives
+		and uploaded to the DNAnexus project in parts, so no copy of the project is written to the genomics server.
+		The tar.gz has the same name and layout as the one made by create_project_tar(). excluded_paths (relative to the project folder)
+		are left out of it
+		Returns the DNAnexus file ID of the tar and the number of bytes uploaded if successful, otherwise (None, None)
+		"""
+		tarfile_name = "%s.tar.gz" % (archer_project_ID)
+		# the excluded paths are matched exactly (--no-wildcards) against the whole name in the tar (--anchored)
+		excludes = "".join(" --exclude=%s" % (shlex.quote("%s/%s" % (archer_project_ID,path))) for path in sorted(excluded_paths))
+		cmd = self.archer.ssh_command("%star%s -C %s -cf - %s" % (self.throttle.priority_prefix(),
+			" --anchored --no-wildcards" + excludes if excludes else "",shlex.quote(self.archer_analysis_folder()),archer_project_ID))
+		self.script_logfile.write("\tCommand to stream tar archive of archer project to DNAnexus: '%s'\n" % (cmd))
+		# the tar is compressed on a background thread and written to a pipe, which is read by the upload
+		read_fd, write_fd = os.pipe()
+		compression = {}
+		# the tar command is counted against the upload stage, which is run by this thread
+		upload_stage = self.metrics.joined_stage()
+
+		def compress():
+			try:
+				with upload_stage, os.fdopen(write_fd, "wb") as pipe_in:
+					compression["error"] = self.compress_command_output(cmd,pipe_in)
+			# raised if the upload stops reading from the pipe
+			except OSError as error:
+				compression["error"] = str(error)
+
+		compressor = threading.Thread(target=compress)
+
+		def check_tar_complete():
+			compressor.join()
+			if compression["error"]:
+				raise RuntimeError(compression["error"])
+
+		with os.fdopen(read_fd, "rb") as pipe_out, self.throttle.transfer("upload"):
+			compressor.start()
+			try:
+				file_id, md5, bytes_uploaded = archer_archive_dnanexus.upload_stream(pipe_out, tarfile_name, dnanexus_projectID,
+					config.stream_part_size, check_tar_complete, self.throttle.rate_limiter("upload"))
+			except Exception as error:
+				upload_error = error
+			else:
+				upload_error = None
+		compressor.join()
+		if upload_error:
+			# Rapid 7 alert set up
+			self.logger("ERROR: failed to stream tar of archer project %s to DNAnexus project %s. Error message: %s" % (
+				archer_project_ID,dnanexus_projectID,upload_error),"Archer archive")
+			return None, None
+		self.logger("Tar of archer project %s streamed to DNAnexus project %s as %s (%s bytes, md5 %s)" % (
+			archer_project_ID,dnanexus_projectID,file_id,bytes_uploaded,md5),"Archer archive")
+		return file_id, bytes_uploaded
+
+	def compress_command_output(self,cmd,destination,member_md5s=None):
+		"""
+		Run cmd and write its stdout, gzip compressed, to destination (a binary file object)
+		Compressed by the parallel compression engine when config.compression_engine = "parallel", otherwise by gzip
+		With the parallel compression engine, if member_md5s is a dict the output of cmd must be a tar archive, and the md5 checksum
+		of each file in it is added to member_md5s (see archer_archive_compress.copy_tar())
+		Returns an error message if cmd or the compression fails (including anything cmd writes to stderr), otherwise an empty string
+		"""
+		if config.compression_engine != "parallel":
+			# pipefail so that a failure of cmd is not hidden by the exit status of gzip
+			cmd = "set -o pipefail; %s | gzip -%s -c" % (cmd,config.compression_level)
+		# stderr is written to a temporary file so it can't fill a pipe and stall the command
+		with tempfile.TemporaryFile() as stderr:
+			self.metrics.count_subprocess()
+			proc = subprocess.Popen([cmd], stdout=subprocess.PIPE, stderr=stderr, shell=True, executable="/bin/bash")
+			try:
+				if config.compression_engine == "parallel":
+					archer_archive_compress.compress_stream(proc.stdout, destination, self.throttle.compression_workers(),
+						config.compression_level, config.compression_block_size, member_md5s)
+				else:
+					shutil.copyfileobj(proc.stdout, destination, config.compression_block_size)
+			except Exception as error:
+				proc.kill()
+				proc.wait()
+				stderr.seek(0)
+				return "compression failed: %s %s" % (error, stderr.read().decode("utf-8","replace").strip())
+			finally:
+				proc.stdout.close()
+			proc.wait()
+			stderr.seek(0)
+			errors = stderr.read().decode("utf-8","replace")
+		if proc.returncode != 0 or errors:
+			return "%s (exit status %s)" % (errors.strip(),proc.returncode)
+		return ""
 
 	def find_DNAnexus_project(self,archer_project_ID,project_adx):
 		"""
-		search for matching DNAnexus project using project_adx (archer run name: ADX###)
+		search for matching DNAnexus project using project_adx (archer run name: ADX###) in the DNAnexus project index
 		returns the DNAnexu projectID and projectname
-		If no matching projects, or greater than 1 project matches will return error- send to rapid 7
+		If no matching projects, or greater than 1 project matches, or the projects can't be listed will return error- send to rapid 7
 		"""
-		# search DNAnexus for project matching project_adx (ADX###)
-		#cmd = config.source_command+";dx find projects --name='*%s*' --auth-token %s" % (project_adx,config.Nexus_API_Key)
-		cmd = "dx find projects --name='*%s*' --auth-token %s" % (project_adx,config.Nexus_API_Key)
-		self.script_logfile.write("\tCommand to find DNAnexus project: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
+		# look up project_adx (ADX###) in the index of DNAnexus projects, which is made once and cached between runs
+		try:
+			matching_projects = self.dnanexus_projects.find(project_adx)
+		except Exception as error:
+			# making the index lists the projects with dxpy, which raises on an authentication, network or API error
+			# Rapid 7 alert set up
+			self.logger("ERROR: Unable to list DNAnexus projects to find %s. Unable to backup Archer project %s. Error message: %s" % (
+				project_adx,archer_project_ID,error), "Archer list projects")
+			return None,None
 		# count number of projects returned. If unable to identify a single matching project return error
-		# note: if one project found len(matchingprojects)=2 because there is a newline 
-		matching_projects = out.split("\n")
-		if len(matching_projects) != 2:
+		if len(matching_projects) != 1:
 			# Rapid 7 alert set up 
 			self.logger("ERROR: Unable to identify a single DNAnexus project matching %s. Unable to backup Archer project %s" % (project_adx,archer_project_ID), "Archer list projects")
 			return None,None
 		else:
 			# extract the projectid and projectname for use later
-			projectid,colon,projectname,access = matching_projects[0].split(" ")
+			projectid,projectname = matching_projects[0]
 			self.logger("DNAnexus project identified matching %s (Archer project %s). Project name: %s." % (project_adx,archer_project_ID,projectname),"Archer list projects")
 			return projectid,projectname
 
-	def upload_to_dnanexus(self,file_list,dnanexus_projectname):
+	def upload_to_dnanexus(self,file_list,dnanexus_projectname,dnanexus_projectID=None,expected_md5s=None):
 		"""
 		can be called twice- to upload tar.gz and fastq_loc file
-		takes a file and the DNAnexus project as input
-		returns True if upload successfil
+		takes a list of files and the DNAnexus project (name and ID) as input
+		With config.upload_engine "dxpy" each file is uploaded in parts by archer_archive_dnanexus.upload_file() and verified against
+		its md5 checksum (expected_md5s, a dict of path: md5 checksum, for files with a checksum recorded when they were made)
+		With "ua" the files are uploaded by the upload agent, which prints the DNAnexus file ID of each file uploaded
+		The upload is limited to the bandwidth (and the upload agent run at the priority) set by self.throttle
+		returns {path: DNAnexus file ID} if all files were uploaded successfully (the file IDs are None when uploaded by the upload agent),
+		otherwise None
 		"""
 		# read list of files to upload into a string to include in the upload command
 		list_of_files = " ".join(file_list)
-		# generate command to upload file to DNAnexus project
-		cmd = "%s --auth-token %s --project %s --do-not-compress %s" % (
-			config.path_to_dx_upload_agent,
-			config.Nexus_API_Key,
-			dnanexus_projectname,
-			list_of_files) 
-		self.script_logfile.write("\tCommand to upload files to DNAnexus using upload agent: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
-		# check output of this command
-		if out.startswith("file-"):
-		#if self.success_in_stdout(out,"file*"):
+		if config.upload_engine == "dxpy":
+			expected_md5s = expected_md5s or {}
+			failed = []
+			file_ids = {}
+			with self.throttle.transfer("upload"):
+				rate_limiter = self.throttle.rate_limiter("upload")
+				for path in file_list:
+					result = archer_archive_dnanexus.upload_file(path, dnanexus_projectID, expected_md5=expected_md5s.get(path), rate_limiter=rate_limiter)
+					file_ids[path] = result.file_id
+					if result.error:
+						failed.append(path)
+						self.script_logfile.write("\tFailed to upload %s in %s parts (%s retries): %s\n" % (path, result.parts, result.retries, result.error))
+					else:
+						self.script_logfile.write("\tUploaded %s as %s: %s bytes in %s parts (%s retries), md5 %s\n" % (
+							path, result.file_id, result.bytes, result.parts, result.retries, result.md5))
+		else:
+			with self.throttle.transfer("upload"):
+				# --throttle limits the upload agent to a number of bytes per second
+				bandwidth_kbps = self.throttle.bandwidth_kbps("upload")
+				# generate command to upload file to DNAnexus project
+				cmd = "%s%s --auth-token %s --project %s --do-not-compress%s %s" % (
+					self.throttle.priority_prefix(),
+					config.path_to_dx_upload_agent,
+					self.nexus_api_key,
+					dnanexus_projectname,
+					" --throttle %s" % (bandwidth_kbps * 1024) if bandwidth_kbps else "",
+					list_of_files) 
+				self.script_logfile.write("\tCommand to upload files to DNAnexus using upload agent: '%s'\n" % (cmd))
+				out,err = self.execute_subprocess_command(cmd)
+			# check output of this command - the upload agent prints a file ID for each file uploaded
+			uploaded_ids = [line for line in out.splitlines() if line.startswith("file-")]
+			failed = file_list if len(uploaded_ids) != len(file_list) else []
+			# the file IDs printed are not matched to the files
+			file_ids = dict.fromkeys(file_list)
+		if not failed:
 			self.logger("files %s successfully uploaded to DNAnexus project %s" % (list_of_files,dnanexus_projectname),"Archer archive")
-			return True
+			return file_ids
 		else:
 			# Rapid 7 alert set up
-			self.logger("ERROR: failed to upload file %s to DNAnexus project %s" % (list_of_files,dnanexus_projectname),"Archer archive")
-			return False
+			self.logger("ERROR: failed to upload file %s to DNAnexus project %s" % (" ".join(failed),dnanexus_projectname),"Archer archive")
+			return None
 
 	def cleanup_archer_project_folder(self,archer_project_ID):
 		"""
@@ -284,17 +623,8 @@ class ArcherArchive():
 		Once project is archived in DNAnexus the copy on the archer platform can be deleted.
 		Returns true if successful
 		"""
-		# ssh on to archer platform using ssh pass and empty the project folder.
-		if config.testing:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local rm -r %s/*; echo $?" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_test_folder,archer_project_ID))
-		else:
-			cmd = "archer_pw=$(<%s); \
-				sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local rm -r %s/*; echo $?" % (
-					config.path_to_archerdx_pw, 
-					os.path.join(config.path_to_analysis_folder,archer_project_ID)) 
+		# ssh on to archer platform and empty the project folder.
+		cmd = "%s; echo $?" % (self.archer.ssh_command("rm -r %s/*" % (shlex.quote(os.path.join(self.archer_analysis_folder(),archer_project_ID)))))
 		self.script_logfile.write("\tCommand to cleanup project on archer server: '%s'\n" % (cmd))
 		out,err = self.execute_subprocess_command(cmd)
 		# check for success in stdout
@@ -306,65 +636,83 @@ class ArcherArchive():
 			self.logger("ERROR: failed to correctly empty archer project folder %s." % (archer_project_ID),"Archer archive")
 			return False
 
-	def cleanup_archer_fastqs(self,project_adx):
+	def queue_archer_fastqs_for_deletion(self,archer_project_ID,project_adx):
 		"""
 		Need to delete the fastqs from the watched folder on the Archer platform
-		uses the archer project name ADX# to identify the fastq filesx
-		Call list_archer_fastq_for_deletion() to add the files to the log and get the path used for deleting the files
-		Returns True if successful
+		uses the archer project name ADX# to identify the fastq files in the inventory (ADX###_...fastq.gz), so the exact paths are known
+		without listing the folder again. The paths are written to the logfile and added to the pending fastq deletions in the ledger,
+		which are deleted for all projects at once by cleanup_archer_fastqs()
 		"""
-		# call list_archer_fastq_for_deletion() to get path
-		path_to_fastqs = self.list_archer_fastq_for_deletion(project_adx)
-		# ssh on to archer platform using ssh pass and empty the project folder
-		cmd = "archer_pw=$(<%s); \
-			sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local rm %s; echo $?" % ( 
-			config.path_to_archerdx_pw, 
-			path_to_fastqs) 
-		self.script_logfile.write("\tCommand to cleanup archer FASTQs: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
-		# check for success in stdout
-		if self.success_in_stdout(out,"0"):
-			self.logger("FASTQs for archer project %s deleted from picked_up_files folder." % (project_adx),"Archer archive")
+		paths = [os.path.join(self.archer_picked_up_folder(),file_name) for file_name in self.inventory.project_fastqs(project_adx)]
+		self.script_logfile.write("\tList of fastq files to be deleted from %s for project %s:\n%s" % (
+			self.archer_picked_up_folder(),project_adx,"".join("%s\n" % (path) for path in paths)))
+		self.ledger.queue_fastq_deletions(archer_project_ID,project_adx,paths)
+
+	def cleanup_archer_fastqs(self):
+		"""
+		Delete the fastqs of all archived projects (the pending fastq deletions in the ledger) from the picked_up_files folder on the
+		Archer platform in one remote command. The paths are sent to the command on stdin (null separated), and it reports the outcome
+		of each path, so only the listed files can be removed. Paths which do not exist are reported as missing: they are removed from the
+		pending deletions (there is nothing left to delete) but logged as a warning, as the path may be wrong
+		Returns True if all pending fastqs were deleted
+		"""
+		pending = self.ledger.pending_fastq_deletions()
+		if not pending:
 			return True
-		else:
-			# Rapid 7 alert set up
-			self.logger("ERROR: failed to correctly delete the FASTQ files for project %s" % (project_adx),"Archer archive")
-			return False
+		self.script_logfile.write("FASTQs to be deleted from the picked_up_files folder:\n%s" % (
+			"".join("\t%s (%s %s)\n" % (path,archer_project_ID,project_adx) for path,archer_project_ID,project_adx in pending)))
+		cmd = self.archer.ssh_command(
+			"""while IFS= read -r -d '' f; do if [ ! -e "$f" ]; then printf 'missing\\t%s\\n' "$f"; """
+			"""elif rm -f -- "$f" && [ ! -e "$f" ]; then printf 'deleted\\t%s\\n' "$f"; else printf 'failed\\t%s\\n' "$f"; fi; done""")
+		self.script_logfile.write("Command to cleanup archer FASTQs: '%s'\n" % (cmd))
+		out,err = self.execute_subprocess_command(cmd, "".join("%s\0" % (path) for path,_,_ in pending))
+		# one line per path: deleted, missing or failed, a tab and the path
+		outcomes = {path: outcome for outcome,path in (line.split("\t",1) for line in out.splitlines() if "\t" in line)}
+		self.script_logfile.write("".join("\t%s: %s\n" % (path,outcomes.get(path,"not attempted")) for path,_,_ in pending))
+		done = [path for path,_,_ in pending if outcomes.get(path) in ("deleted","missing")]
+		self.ledger.fastq_deletions_done(done)
+		for project_adx in sorted(set(project_adx for _,_,project_adx in pending)):
+			project_outcomes = [outcomes.get(path) for path,_,adx in pending if adx == project_adx]
+			if all(outcome == "deleted" for outcome in project_outcomes):
+				self.logger("FASTQs for archer project %s deleted from picked_up_files folder." % (project_adx),"Archer archive")
+			elif all(outcome in ("deleted","missing") for outcome in project_outcomes):
+				self.logger("WARNING: %s of the FASTQs for archer project %s were not found in the picked_up_files folder." % (
+					project_outcomes.count("missing"),project_adx),"Archer archive")
+			else:
+				# Rapid 7 alert set up
+				self.logger("ERROR: failed to correctly delete the FASTQ files for project %s" % (project_adx),"Archer archive")
+		return len(done) == len(pending)
 
-	def list_archer_fastq_for_deletion(self,project_adx):
+	def update_list_archived_projects(self,archer_project_ID,project_adx,dnanexus_projectID=None,started_at=None,uploaded_bytes=None,project_bytes=None):
 		"""
-		list the fastqs that will be deleted and write them to the logfile
-		input: project_adx (ADX###)
-		output: the path to the fastqs (so the path used to list the fastqs is the same as the path to delete them)
+		Add project id (e.g.4798) to the ledger of archived runs, with the DNAnexus project, the time archiving started and the
+		size of the project folder and of the tar.gz uploaded.
+		This will prevent future archiving of the run- the ledger is searched by check_previously_archived()
+		Inputs:		archer project ID (4 digits), ADX project name, DNAnexus project ID, start time, bytes uploaded and size of the project folder
+		Outputs:	updated archived projects ledger (config.path_to_archived_projects_ledger)
 		"""
-		# first get the path to the fastq files location
-		if config.testing:
-			path_to_fastqs = "%s*.fastq.gz" % (os.path.join(config.path_to_picked_up_test_files,project_adx))
-		else:
-			path_to_fastqs = "%s*.fastq.gz" % (os.path.join(config.path_to_picked_up_files,project_adx))
-		# command to list fastq files to be deleted
-		cmd = "archer_pw=$(<%s); \
-			sshpass -p $archer_pw ssh s_archerupload@grpvgaa01.viapath.local ls %s; echo $?" % ( 
-			config.path_to_archerdx_pw, 
-			path_to_fastqs) 
-		self.script_logfile.write("\tCommand to list Archer FASTQs for deletion: '%s'\n" % (cmd))
-		out,err = self.execute_subprocess_command(cmd)
-		# write the list of files to the log
-		self.script_logfile.write("\tList of fastq files to be deleted from %s for project %s:\n%s" % (path_to_fastqs,project_adx,out))
-		# return the file path to be used by clean_up_archer_fastqs()
-		return path_to_fastqs
+		self.ledger.record(archer_project_ID, project_adx, dnanexus_projectID, started_at, project_bytes, uploaded_bytes)
+		self.script_logfile.write("\tProject ID %s (%s) added to archived projects ledger\n" % (archer_project_ID,project_adx))
 
-	def update_list_archived_projects(self,archer_project_ID,project_adx):
+	def record_archived_fastqs(self,archer_project_ID,state):
 		"""
-		Add project id (e.g.4798) to the list of archived runs. 
-		This will prevent future archiving of the run- the file is searched by check_previously_archived() 
-		Inputs:		archer project ID (4 digits)
-		Outputs:	updated archived projects list (config.path_to_archived_project_ids)
+		Record the md5 checksum and size of the FASTQs archived in the project tar in the ledger, with the DNAnexus file ID of the tar
+		The checksums are those taken by find_archived_fastqs() or, for FASTQs it did not checksum, those in the copy manifest
+		(FASTQs without a checksum are not recorded). FASTQs archived with earlier projects are not in the tar, so are not recorded
+		The copy manifest is read whenever it is there, including for a project copied by a staged run and resumed in streaming mode
 		"""
-		# open the archived projects file and add the project ID of the archived project to the list
-		with open(config.path_to_archived_project_ids,"a") as archived_projects_list:
-			archived_projects_list.write("%s\n" % (archer_project_ID))
-			self.script_logfile.write("\tProject ID %s added to archived projects list" % (project_adx),"Archer archive")
+		manifest = archer_archive_manifest.read_manifest(archer_archive_manifest.manifest_path(config.copy_location,archer_project_ID)) or {}
+		fastqs = []
+		for path, size in state.get("fastq_sizes", {}).items():
+			if path in state.get("archived_fastqs", {}):
+				continue
+			md5 = state.get("fastq_md5s", {}).get(path)
+			if md5 is None and manifest.get(path, {}).get("size") == size:
+				md5 = manifest[path].get("md5")
+			if md5:
+				fastqs.append((md5, size, "%s/%s" % (archer_project_ID,path)))
+		self.ledger.record_archived_fastqs(archer_project_ID, state["dnanexus_project_id"], state.get("tar_file_id"), fastqs)
+		self.script_logfile.write("\t%s FASTQs of project %s recorded in the ledger of archived FASTQs\n" % (len(fastqs),archer_project_ID))
 
 	def cleanup_genomics_server(self,archer_project_ID):
 		"""
@@ -373,10 +721,12 @@ class ArcherArchive():
 		Inputs:		archer_project_ID (four digit ID)
 		Outputs:	Returns True if all files deleted successfully
 		"""
-		# downloaded fastq files location on genomics server
-		path_to_project_folder = os.path.join(config.copy_location,"%s" % (archer_project_ID))
-		# command to delete the downloaded fastq files
-		cmd = "rm -r %s*; echo $?" % (path_to_project_folder)
+		# downloaded fastq files location on genomics server, its tar and manifest. Exact paths are given so no other project's files can match
+		paths = [os.path.join(config.copy_location,"%s" % (archer_project_ID)),
+			os.path.join(config.copy_location,"%s.tar.gz" % (archer_project_ID)),
+			archer_archive_manifest.manifest_path(config.copy_location,archer_project_ID)]
+		# command to delete the downloaded fastq files. -f so files already removed by an earlier run are not an error
+		cmd = "rm -rf %s; echo $?" % (" ".join(shlex.quote(path) for path in paths))
 		self.script_logfile.write("\tCommand to clean up Genomics Server: '%s'\n" % (cmd))
 		out, err = self.execute_subprocess_command(cmd)
 		if self.success_in_stdout(out, "0"):
@@ -395,15 +745,29 @@ class ArcherArchive():
 			if expected_txt in stdout:
 				return True
 
-	def execute_subprocess_command(self, command):
+	def execute_subprocess_command(self, command, stdin=None):
 		"""
-		Input = command (string)
-		Takes a command, executes using subprocess.Popen
+		Input = command (string), and optionally the text to send to the command on stdin
+		Takes a command, executes using subprocess.Popen, or on the asyncio execution core when config.subprocess_engine is "asyncio"
+		(see run_subprocess_command())
 		Returns =  (stdout,stderr) (tuple)
+		"""
+		result = self.run_subprocess_command(command, stdin)
+		return result.stdout, result.stderr
+
+	def run_subprocess_command(self, command, stdin=None):
+		"""
+		As execute_subprocess_command(), but returns the archer_archive_async.CommandResult of the command, which also says whether
+		the start of stdout was dropped (truncated) to stay within config.subprocess_output_limit
+		On the asyncio execution core (see archer_archive_async) commands time out and their output is bounded
 		universal_newlines=True is required to force the outputs to be strings not bytes in python 3. For python 3.7 onwards can use text=True instead
 		"""
+		self.metrics.count_subprocess()
+		if self.async_runner is not None:
+			return self.async_runner.run(command, stdin, self.metrics.current_stage())
 		proc = subprocess.Popen(
 			[command],
+			stdin=subprocess.PIPE if stdin is not None else None,
 			stderr=subprocess.PIPE,
 			stdout=subprocess.PIPE,
 			shell=True,
@@ -411,7 +775,8 @@ class ArcherArchive():
 			executable="/bin/bash",
 		)
 		# capture the streams
-		return proc.communicate()
+		out, err = proc.communicate(stdin)
+		return archer_archive_async.CommandResult(out, err, proc.returncode, False, False)
 
 	def logger(self, message, tool):
 		"""
@@ -422,55 +787,428 @@ class ArcherArchive():
 		tool (str)
 			Tool name. Used to search within the insight ops website.
 		printing is required to send log information to stdout (allows logs to be sent to syslog when run in Docker)
+		Messages are written by the logging module (see archer_archive_logging) in the same format as /usr/bin/logger -t tool
 		"""
-		# Create subprocess command string, passing message and tool name to the command
-		log = "/usr/bin/logger -t %s '%s'" % (tool, message)
 		time = str('{:%Y%m%d_%H%M%S}'.format(datetime.datetime.now()))
-		if subprocess.call([log], shell=True) == 0:
-			# If the log command produced no errors, record the log command string to the script logfile.
+		logged = False
+		if self.syslog is not None:
+			try:
+				self.syslog.info(archer_archive_logging.syslog_message(message, tool))
+				logged = True
+			except OSError:
+				pass
+		if logged:
+			# If the log produced no errors, record the log message to the script logfile.
 			self.script_logfile.write(time + " : " + tool + ": " + message + "\n")
 			print("%s : %s" % (tool,message))
 		# Else record failure to write to system log to the script log file
 		else:
-			self.script_logfile.write(time + " : Failed to write log to /var/log/syslog\n" + log + "\n")
+			self.script_logfile.write(time + " : Failed to write log to /var/log/syslog\n" + tool + ": " + message + "\n")
 			print("Failed to write log to /var/log/syslog %s : %s" % (tool,message))
 
+	def archive_project(self, archer_project_ID):
+		"""
+		Run the archiving chain for a single Archer project
+		When projects are archived concurrently (config.project_workers > 1) log lines are buffered while the project is processed and
+		written to the script logfile as one block when it finishes. Otherwise they are written as they are logged, so they are kept if
+		the run is stopped part way through the project
+		Input: archer_project_ID
+		Output: outcome of the project (str) for the run summary
+		"""
+		if config.project_workers <= 1:
+			self._script_logfile.write("Archer project %s\n" % (archer_project_ID))
+			return self.archive_project_stages(archer_project_ID)
+		self._local.project_log = io.StringIO()
+		try:
+			return self.archive_project_stages(archer_project_ID)
+		finally:
+			project_log = self._local.project_log
+			self._local.project_log = None
+			with self._log_lock:
+				self._script_logfile.write("Archer project %s\n%s" % (archer_project_ID, project_log.getvalue()))
+				self._script_logfile.flush()
+
+	def archive_project_stages(self, project):
+		"""
+		Calls each stage of the archiving chain for one project, stopping at the first stage that fails
+		Each stage is gated by its slot in self.stage_slots (sizes set in config.stage_pool_sizes)
+		so when projects run concurrently network bound (copy, upload) and CPU bound (tar) stages overlap across projects
+		The time, bytes processed and subprocesses run by each stage are recorded in self.metrics
+		The last step completed is saved in the ledger (see archer_archive_ledger.ARCHIVING_STEPS) so that if a run stops part way through,
+		the next run resumes the project from that step, skipping any steps whose output is still valid
+		Returns the outcome of the project (str)
+		"""
+		step, state = self.ledger.project_state(project)
+		if step:
+			self.logger("Archer project %s was part archived by an earlier run. Resuming after step: %s" % (project, step), "Archer archive")
+		else:
+			state["started_at"] = archer_archive_ledger.timestamp()
+		if not archer_archive_ledger.step_reached(step, "listed"):
+			with self.stage(project, "check"):
+				# check if the project is on the previously archived list
+				if self.check_previously_archived(project):
+					return "previously archived"
+				# check if project archived on archer, return project name (ADX##) if so
+				adx_project_name = self.check_project_archived(project)
+				if not adx_project_name:
+					return "not archived on Archer platform"
+			fastq_sizes = {path: record.size for path, record in self.inventory.project_fastq_records(project).items()}
+			archived_fastqs, fastq_md5s = {}, {}
+			if config.deduplicate_fastqs:
+				with self.stage(project, "dedup") as record:
+					# find the FASTQs in the project folder which were archived with an earlier project, so they are not archived again
+					fastq_checksums = self.find_archived_fastqs(project)
+					if fastq_checksums is None:
+						return "failed: FASTQ checksums"
+					archived_fastqs, fastq_md5s = fastq_checksums
+					record["bytes"] = sum(fastq_sizes[path] for path in fastq_md5s)
+			# generate files listing locations of files in the archer project folder. Filenames are returned as a list
+			files_to_upload = self.list_archer_project_files(project,adx_project_name,archived_fastqs)
+			if not files_to_upload:
+				return "failed: fastq locations file"
+			# the bytes of the project which are copied, tarred and uploaded (the FASTQs archived with earlier projects are left out)
+			project_bytes = self.inventory.project_bytes(project)
+			copy_bytes = project_bytes - sum(fastq_sizes[path] for path in archived_fastqs)
+			step = self.save_step(project, "listed", state, project_adx=adx_project_name, fastq_loc_files=files_to_upload,
+				project_bytes=project_bytes, fastq_bytes=self.inventory.fastq_bytes(adx_project_name), copy_bytes=copy_bytes,
+				fastq_sizes=fastq_sizes, fastq_md5s=fastq_md5s, archived_fastqs=archived_fastqs)
+		# projects are only started while the schedule allows (time budget, free space goal)
+		stop_reason = self.schedule_stop_reason()
+		if stop_reason:
+			self.logger("Archer project %s not started: %s" % (project, stop_reason), "Archer archive")
+			return "not started: %s" % (stop_reason)
+		# and, when staged, if there is space for the copy and tar in copy_location
+		bytes_freed = state["project_bytes"] + state.get("fastq_bytes", 0)
+		local_bytes = self.local_bytes_needed(step, state)
+		if not self.reserve_space(project, bytes_freed, local_bytes):
+			# Rapid7 alert set up
+			self.logger("WARNING: Archer project %s not started: not enough space in %s for %s bytes" % (project, config.copy_location, local_bytes), "Archer archive")
+			return "not started: not enough local space"
+		try:
+			return self.archive_listed_project(project, step, state)
+		finally:
+			self.release_space(project, local_bytes)
+
+	def archive_listed_project(self, project, step, state):
+		"""
+		Calls the stages of the archiving chain after the project has been listed (see archive_project_stages())
+		Returns the outcome of the project (str)
+		"""
+		adx_project_name = state["project_adx"]
+		# projects listed by earlier releases have a single fastq locations file (ls -l)
+		files_to_upload = list(state["fastq_loc_files"]) if "fastq_loc_files" in state else [state["fastq_loc_file"]]
+		# FASTQs archived with earlier projects are left out of the copy and tar (projects listed by earlier releases have none)
+		archived_fastqs = state.get("archived_fastqs", {})
+		copy_bytes = state.get("copy_bytes", state["project_bytes"])
+		# in streaming mode the project is not copied to the genomics server, it is streamed to DNAnexus in the upload stage
+		# the tar streamed by an earlier run (tar_file_id, saved before the project reaches uploaded) is not made again in either mode
+		if self.transfer_mode == "staged" and "tar_file_id" not in state and not archer_archive_ledger.step_reached(step, "uploaded"):
+			# a tar made by an earlier run is reused if it is unchanged, otherwise the copy is reused if it is complete and unchanged
+			# (any partial copy left by an earlier run is updated by rsync rather than copied again)
+			if not self.tar_still_valid(project, step, state):
+				if not self.copy_still_valid(project, archived_fastqs):
+					with self.stage(project, "copy") as record:
+						record["bytes"] = copy_bytes
+						# rsync archer project folder to genomics server
+						if not self.copy_archer_project(project, archived_fastqs):
+							return "failed: copy"
+					step = self.save_step(project, "copied", state)
+				with self.stage(project, "tar") as record:
+					record["bytes"] = copy_bytes
+					# tar the archer project folder
+					tar_name, tar_md5 = self.create_project_tar(project)
+					if not tar_name:
+						return "failed: tar"
+				tar_path = os.path.join(config.copy_location,tar_name)
+				step = self.save_step(project, "tarred", state, tar_path=tar_path, tar_md5=tar_md5, uploaded_bytes=os.path.getsize(tar_path))
+			# add tar name (with path) to a list of files to be uploaded to DNAnexus
+			files_to_upload.append(state["tar_path"])
+		if not archer_archive_ledger.step_reached(step, "uploaded"):
+			with self.stage(project, "find"):
+				# look for the DNAnexus project. If no unique project found projectid and projectname will be None
+				projectID,projectname = self.find_DNAnexus_project(project,adx_project_name)
+				if not projectID:
+					return "failed: DNAnexus project"
+			with self.stage(project, "upload") as record:
+				if self.transfer_mode == "streaming" and "tar_file_id" not in state:
+					tar_file_id, uploaded_bytes = self.stream_project_to_dnanexus(project,projectID,archived_fastqs)
+					if not uploaded_bytes:
+						return "failed: upload"
+					# saved now so that if the fastq locations files fail to upload, the next run doesn't stream the project again
+					step = self.save_step(project, step, state, tar_file_id=tar_file_id, uploaded_bytes=uploaded_bytes)
+				# upload tar.gz (staged mode) and fastq locations file to DNAnexus
+				# a project tarred by an earlier staged run and resumed in streaming mode has a tar_path, but its tar is streamed
+				upload_tar = "tar_file_id" not in state
+				tar_md5s = {state["tar_path"]: state["tar_md5"]} if upload_tar else None
+				file_ids = self.upload_to_dnanexus(files_to_upload,projectname,projectID,tar_md5s)
+				if file_ids is None:
+					return "failed: upload"
+				if upload_tar:
+					state["tar_file_id"] = file_ids[state["tar_path"]]
+				record["bytes"] = state["uploaded_bytes"]
+			step = self.save_step(project, "uploaded", state, dnanexus_project_id=projectID)
+		if not archer_archive_ledger.step_reached(step, "remote_cleaned"):
+			with self.stage(project, "cleanup") as record:
+				# bytes freed on the archer server
+				record["bytes"] = state["project_bytes"]
+				#clean up archer platform
+				if not self.cleanup_archer_project_folder(project):
+					return "failed: Archer server clean up"
+			self.record_bytes_freed(project)
+			step = self.save_step(project, "remote_cleaned", state)
+		if not archer_archive_ledger.step_reached(step, "fastqs_queued"):
+			# the fastqs are deleted with those of all other projects at the end of the run (cleanup_archer_fastqs())
+			self.queue_archer_fastqs_for_deletion(project,adx_project_name)
+			step = self.save_step(project, "fastqs_queued", state)
+		if not archer_archive_ledger.step_reached(step, "ledgered"):
+			# record the FASTQs archived in the tar, so later projects containing them don't archive them again
+			if config.deduplicate_fastqs:
+				self.record_archived_fastqs(project, state)
+			#add archer project ID to archived project list
+			self.update_list_archived_projects(project,adx_project_name,state["dnanexus_project_id"],state["started_at"],
+				state["uploaded_bytes"],state["project_bytes"])
+			step = self.save_step(project, "ledgered", state)
+		# a copy or tar left by an earlier staged run of a project resumed in streaming mode is removed too
+		staged_files = [os.path.join(config.copy_location,project), os.path.join(config.copy_location,"%s.tar.gz" % (project))]
+		if (self.transfer_mode == "staged" or any(os.path.exists(path) for path in staged_files)) and not self.cleanup_genomics_server(project):
+			# the step stays at ledgered so the clean up is tried again in the next run
+			return "archived"
+		# local_cleaned is the last step, so once it is reached the saved state is no longer needed
+		self.ledger.clear_state(project)
+		return "archived"
+
+	def schedule_projects(self, projects):
+		"""
+		Returns the projects in the order they should be archived (config.schedule_order)
+		listing: the order they are listed on the archer server
+		largest_first: projects part archived by an earlier run first, then projects waiting to be archived, largest first
+		(by the bytes freed on the archer server: the project folder and its fastqs in picked_up_files), then all other projects
+		"""
+		if config.schedule_order != "largest_first":
+			return projects
+
+		def priority(project):
+			if self.ledger.project_state(project)[0]:
+				return float("inf")
+			if self.ledger.is_archived(project) or not self.inventory.is_archived(project):
+				return -1
+			return self.inventory.project_bytes(project) + self.inventory.fastq_bytes(self.inventory.project_adx(project))
+
+		scheduled = sorted(projects, key=priority, reverse=True)
+		self.script_logfile.write("Projects will be archived in the order: %s\n" % (", ".join(scheduled)))
+		return scheduled
+
+	def schedule_stop_reason(self):
+		"""
+		Returns the reason no more projects should be started in this run, or None if projects can still be started
+		Projects are not started once config.time_budget_seconds has passed, or once the bytes freed (and being freed) on the archer
+		server reach config.bytes_to_free_target, or bring the free space on the archer server to config.archer_free_space_goal_bytes,
+		or once self.stopping is set
+		"""
+		if self.stopping.is_set():
+			return "shutting down"
+		with self._schedule:
+			bytes_freed = self.bytes_freed + sum(self.bytes_being_freed.values())
+		return archer_archive_plan.stop_reason(time.time() - self.metrics.started_at, bytes_freed, self.inventory.archer_free_bytes)
+
+	def local_bytes_needed(self, step, state):
+		"""
+		Returns the bytes needed in copy_location for the steps of the project still to be run
+		(the project folder copy and a tar no larger than it, when staged, without the FASTQs archived with earlier projects)
+		"""
+		if self.transfer_mode != "staged" or archer_archive_ledger.step_reached(step, "tarred"):
+			return 0
+		copy_bytes = state.get("copy_bytes", state["project_bytes"])
+		if archer_archive_ledger.step_reached(step, "copied"):
+			return copy_bytes
+		return copy_bytes * 2
+
+	def reserve_space(self, archer_project_ID, bytes_freed, local_bytes):
+		"""
+		Reserve local_bytes in copy_location for the project, leaving config.local_free_space_headroom_bytes free, and record the bytes
+		the project is expected to free on the archer server
+		If there isn't space the project waits for other projects to release their reservations. If no other project has a reservation,
+		the project can't fit and False is returned
+		"""
+		with self._schedule:
+			while local_bytes:
+				available = shutil.disk_usage(config.copy_location).free - self.local_bytes_reserved - config.local_free_space_headroom_bytes
+				if local_bytes <= available:
+					break
+				if not self.local_bytes_reserved:
+					return False
+				self._schedule.wait()
+			self.local_bytes_reserved += local_bytes
+			self.bytes_being_freed[archer_project_ID] = bytes_freed
+			return True
+
+	def record_bytes_freed(self, archer_project_ID):
+		"""
+		Record that the project has been removed from the archer server, freeing the bytes expected by reserve_space()
+		"""
+		with self._schedule:
+			self.bytes_freed += self.bytes_being_freed.pop(archer_project_ID, 0)
+
+	def release_space(self, archer_project_ID, local_bytes):
+		"""
+		Release the space reserved for the project by reserve_space(), once it has finished with copy_location
+		"""
+		with self._schedule:
+			self.local_bytes_reserved -= local_bytes
+			self.bytes_being_freed.pop(archer_project_ID, None)
+			self._schedule.notify_all()
+
+	@contextlib.contextmanager
+	def stage(self, archer_project_ID, stage):
+		"""
+		Wait for a slot in the stage (self.stage_slots) then time the stage with self.metrics
+		Yields the metrics record for the stage, where the stage sets the number of bytes processed (record["bytes"])
+		"""
+		with self.stage_slots[stage]:
+			with self.metrics.stage(archer_project_ID, stage) as record:
+				yield record
+
+	def save_step(self, archer_project_ID, step, state, **step_data):
+		"""
+		Add step_data to the project state and save it to the ledger as having completed step
+		Returns the step
+		"""
+		state.update(step_data)
+		self.ledger.save_state(archer_project_ID, step, state)
+		return step
+
+	def tar_still_valid(self, archer_project_ID, step, state):
+		"""
+		Returns True if the project tar made in an earlier run is still on the genomics server, unchanged (same size and md5 checksum)
+		"""
+		if not archer_archive_ledger.step_reached(step, "tarred"):
+			return False
+		tar_path = state["tar_path"]
+		if os.path.isfile(tar_path) and os.path.getsize(tar_path) == state["uploaded_bytes"] and archer_archive_manifest.file_md5(tar_path) == state["tar_md5"]:
+			self.logger("Tar of archer project %s made in an earlier run is unchanged and will be reused" % (archer_project_ID), "Archer archive")
+			return True
+		return False
+
+	def log_run_summary(self):
+		"""
+		Write the outcome of each project processed in this run to the script logfile and log the number of projects archived
+		"""
+		self.script_logfile.write("Run summary:\n")
+		for project, outcome in sorted(self.project_results.items()):
+			self.script_logfile.write("\t%s: %s\n" % (project, outcome))
+		archived = [project for project, outcome in self.project_results.items() if outcome == "archived"]
+		failed = [project for project, outcome in self.project_results.items() if outcome.startswith("failed")]
+		self.logger("Archer archive run complete. %s projects archived, %s projects failed" % (len(archived), len(failed)), "Archer archive")
+		self._script_logfile.flush()
+
+	def write_run_report(self):
+		"""
+		Write the timing and throughput report for this run next to the script logfile (see archer_archive_metrics)
+		"""
+		report_path = self.metrics.write_report(self.logfile_name.replace("archivelog.txt", "archivereport"), {
+			"run": self.now,
+			"transfer_mode": self.transfer_mode,
+			"ssh_connections": self.archer.connections_opened,
+			"project_results": self.project_results,
+		})
+		self.script_logfile.write("Run report written to %s\n" % (report_path))
+
 	def go(self):
 		"""
 		Calls all other functions
+		Projects are archived one after another, or concurrently on a thread pool when config.project_workers > 1
+		(each stage runs in a subprocess, so threads are sufficient for the stages of different projects to overlap)
 		"""
-		# set up ssh hosts
-		if self.set_up_ssh_known_hosts():
-			# list projects on archer platform by archer project id (####)
-			for project in self.list_archer_projects():
-				# check if the project is on the previously archived list
-				if not self.check_previously_archived(project):
-					# check if project archived on archer, return project name (ADX##) if so
-					adx_project_name = self.check_project_archived(project)
-					if adx_project_name:
-						# generate file listing locations of files in the archer project folder. Filename is returned as a list
-						files_to_upload = self.list_archer_project_files(project) #returns a list
-						if files_to_upload:
-							# rsync archer project folder to genomics server
-							if self.copy_archer_project(project):
-								# tar the archer project folder
-								tar_name = self.create_project_tar(project)
-								if tar_name:
-									# add tar name (with path) to a list of files to be uploaded to DNAnexus
-									tar_path = os.path.join(config.copy_location,tar_name)
-									files_to_upload.append(tar_path)
-									# look for the DNAnexus project
-									projectID,projectname = self.find_DNAnexus_project(project,adx_project_name)
-									# if no unique project found projectid and projectname will be None
-									if projectID:
-										# upload tar.gz and fastq locations file to DNAnexus
-										if self.upload_to_dnanexus(files_to_upload,projectname):
-											#clean up archer platform
-											if self.cleanup_archer_project_folder(project) and self.cleanup_archer_fastqs(adx_project_name):
-												#add archer project ID to archived project list
-												self.update_list_archived_projects(project,adx_project_name)
-												self.cleanup_genomics_server(project)
+		# set up ssh hosts and open the ssh connection used for all commands run on the archer server
+		try:
+			if self.set_up_ssh_known_hosts() and self.open_archer_connection():
+				try:
+					self.archive_run()
+				finally:
+					self.close_archer_connection()
+				self.log_run_summary()
+				self.write_run_report()
+		finally:
+			self.close_async_runner()
+
+	def archive_run(self):
+		"""
+		Take the inventory of the archer server, archive the projects and delete the fastqs of the archived projects
+		The ssh connection must be open. Returns True if the inventory was taken
+		"""
+		# list the contents of all project folders on the archer server in one go
+		with self.metrics.stage(None, "inventory"):
+			inventory_taken = self.take_archer_inventory()
+		if inventory_taken:
+			self.archive_projects()
+			# delete the fastqs of all archived projects (including any left by earlier runs) at once
+			with self.metrics.stage(None, "fastq_cleanup"):
+				self.cleanup_archer_fastqs()
+		return inventory_taken
+
+	def plan(self):
+		"""
+		Dry run: work out what a run would do from the inventory of the archer server, the ledger and the DNAnexus project index,
+		without copying, uploading or deleting anything (see archer_archive_plan)
+		The plan is printed and written next to the script logfile
+		"""
+		if self.set_up_ssh_known_hosts() and self.open_archer_connection():
+			try:
+				inventory_taken = self.take_archer_inventory()
+			finally:
+				self.close_archer_connection()
+				self.close_async_runner()
+			if inventory_taken:
+				projects = self.schedule_projects(list(self.list_archer_projects()))
+				planner = archer_archive_plan.ArchivePlanner(self.inventory, self.ledger, self.dnanexus_projects, self.transfer_mode)
+				rows = planner.plan(projects)
+				for line in archer_archive_plan.format_plan(rows):
+					print(line)
+					self.script_logfile.write(line + "\n")
+				plan_path = archer_archive_plan.write_plan(rows, self.logfile_name.replace("archivelog.txt", "archiveplan"))
+				print("Plan written to %s" % (plan_path))
+				self.script_logfile.write("Plan written to %s\n" % (plan_path))
+		self._script_logfile.flush()
+
+	def archive_projects(self):
+		"""
+		Archive each project listed on the archer platform
+		"""
+		# list projects on archer platform by archer project id (####), in the order they should be archived
+		projects = self.schedule_projects(list(self.list_archer_projects()))
+		if config.project_workers > 1:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=config.project_workers) as pool:
+				futures = {pool.submit(self.archive_project, project): project for project in projects}
+				for future in concurrent.futures.as_completed(futures):
+					self.record_project_result(futures[future], future.result)
+		else:
+			for project in projects:
+				self.record_project_result(project, lambda: self.archive_project(project))
+
+	def record_project_result(self, archer_project_ID, get_result):
+		"""
+		Record the outcome of a project in self.project_results, returned by get_result (archive_project, or the result of its future)
+		An unexpected error in one project should not stop the other projects being archived, so it is logged and recorded as the outcome
+		"""
+		try:
+			self.project_results[archer_project_ID] = get_result()
+		except Exception as error:
+			self.logger("ERROR: unexpected error archiving Archer project %s: %s" % (archer_project_ID, error), "Archer archive")
+			self.project_results[archer_project_ID] = "failed: %s" % (error)
 
 if __name__ == "__main__":
-	archer = ArcherArchive()
-	archer.go()	
+	parser = argparse.ArgumentParser(description="Archive projects from the Archer platform to DNAnexus")
+	parser.add_argument("--transfer-mode", choices=["staged", "streaming"], default=config.transfer_mode,
+		help="staged: copy, tar and upload the project from the genomics server. streaming: stream the project from the archer server straight into DNAnexus")
+	parser.add_argument("--plan", action="store_true",
+		help="print what the run would do and how long it would take, without copying, uploading or deleting anything")
+	parser.add_argument("--daemon", action="store_true",
+		help="keep running, archiving projects as soon as they are archived on the archer platform (see archer_archive_daemon)")
+	args = parser.parse_args()
+	archer = ArcherArchive(transfer_mode=args.transfer_mode)
+	if args.plan:
+		archer.plan()
+	elif args.daemon:
+		archer_archive_daemon.ArchiveDaemon(archer).run()
+	else:
+		archer.go()
\ No newline at end of file
@@ -0,0 +1,118 @@
+"""
+Connection layer for the Archer server
+Builds the shell commands used to run commands on, and rsync files from, the Archer server.
+
+When config.ssh_multiplex is True, open() starts a single ssh master connection (OpenSSH ControlMaster) and every
+ssh and rsync command built by this class is sent down it, so the TCP connection, key exchange and password
+authentication happen once per run rather than once per command. close() tears the master connection down.
+Commands keep the sshpass prefix so that if the master connection is lost they fall back to opening their own connection.
+
+When config.archer_local_shell is True commands are run in a local shell instead of on the Archer server.
+This allows the script to be run against a local copy of the Archer analysis folders (e.g. for testing or benchmarking).
+"""
+
+import threading, shlex
+import archer_archive_config as config
+
+
+class ArcherConnection():
+	def __init__(self, execute_subprocess_command):
+		"""
+		execute_subprocess_command is the function used to run shell commands (ArcherArchive.execute_subprocess_command)
+		"""
+		self.execute_subprocess_command = execute_subprocess_command
+		self.host = "%s@%s" % (config.archer_user, config.archer_server)
+		self.master_open = False
+		# number of ssh connections opened to the Archer server during this run
+		self.connections_opened = 0
+		self._lock = threading.Lock()
+
+	def _password_prefix(self):
+		"""
+		sshpass prefix which reads the Archer server password from file
+		"""
+		return "archer_pw=$(<%s); sshpass -p $archer_pw" % (config.path_to_archerdx_pw)
+
+	def _ssh_options(self):
+		"""
+		ssh options used by commands, so they are sent down the master connection when it is open
+		"""
+		if config.ssh_multiplex:
+			return "-o ControlMaster=no -o ControlPath=%s" % (config.ssh_control_path)
+		return ""
+
+	def _count_connection(self):
+		"""
+		Commands only open a new connection if there is no master connection for them to use
+		"""
+		with self._lock:
+			if not self.master_open:
+				self.connections_opened += 1
+
+	def ssh_command(self, remote_command):
+		"""
+		Returns the shell command which runs remote_command on the Archer server
+		remote_command is quoted so it is parsed (globs, quotes etc) by the shell on the Archer server exactly as it would be by a local shell
+		Anything added after a ; to the returned command is run locally (e.g. echo $? reports the exit status of ssh)
+		"""
+		if config.archer_local_shell:
+			return remote_command
+		self._count_connection()
+		return "%s ssh %s %s %s" % (self._password_prefix(), self._ssh_options(), self.host, shlex.quote(remote_command))
+
+	def rsync_command(self, remote_path, local_path, rsync_options="-rt", priority=""):
+		"""
+		Returns the shell command which copies remote_path on the Archer server to local_path with rsync
+		priority is put before the command, and before the rsync started on the Archer server (e.g. "nice -n 19 ionice -c 3 ")
+		"""
+		if config.archer_local_shell:
+			return "%srsync %s %s %s" % (priority, rsync_options, shlex.quote(remote_path), shlex.quote(local_path))
+		self._count_connection()
+		if priority:
+			rsync_options = "%s --rsync-path=%s" % (rsync_options, shlex.quote(priority + "rsync"))
+		return "%s %srsync %s -e 'ssh %s' %s %s" % (self._password_prefix(), priority, rsync_options, self._ssh_options(),
+			shlex.quote("%s:%s" % (self.host, remote_path)), shlex.quote(local_path))
+
+	def open(self):
+		"""
+		Start the ssh master connection which all other commands are sent down
+		Returns True if the master connection is open (or is not required)
+		"""
+		if config.archer_local_shell or not config.ssh_multiplex:
+			return True
+		# -f -N puts the master connection into the background once authenticated without running a command
+		# ControlPersist keeps the master connection open until close() is called
+		cmd = "%s ssh -f -N -o ControlMaster=yes -o ControlPersist=yes -o ServerAliveInterval=60 -o ControlPath=%s %s; echo $?" % (
+			self._password_prefix(), config.ssh_control_path, self.host)
+		out, err = self.execute_subprocess_command(cmd)
+		with self._lock:
+			self.connections_opened += 1
+			self.master_open = out.rstrip().split("\n")[-1] == "0"
+		return self.master_open
+
+	def check(self):
+		"""
+		Returns True if the ssh master connection is still open (or is not required)
+		"""
+		if config.archer_local_shell or not config.ssh_multiplex:
+			return True
+		if not self.master_open:
+			return False
+		cmd = "ssh -o ControlPath=%s -O check %s 2>/dev/null; echo $?" % (config.ssh_control_path, self.host)
+		out, err = self.execute_subprocess_command(cmd)
+		if out.strip().splitlines()[-1:] == ["0"]:
+			return True
+		with self._lock:
+			self.master_open = False
+		return False
+
+	def close(self):
+		"""
+		Close the ssh master connection
+		"""
+		if not self.master_open:
+			return
+		cmd = "ssh -o ControlPath=%s -O exit %s" % (config.ssh_control_path, self.host)
+		self.execute_subprocess_command(cmd)
+		with self._lock:
+			self.master_open = False
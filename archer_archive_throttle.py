@@ -0,0 +1,205 @@
+"""
+Bandwidth and priority limits of the archer archiving script, so projects can be archived while the archer server and the genomics
+server are in use (e.g. during lab hours) without slowing the Archer analyses or other jobs
+
+The limits in use are those of the first profile in config.throttle_profiles covering the time of day (and day of the week), or
+config.throttle_default_profile outside them. A profile can set:
+- bandwidth_kbps: cap (KiB/s) on all transfers together, shared equally between the transfers running
+- stage_bandwidth_kbps: cap (KiB/s) on the transfers of each stage ("copy": rsync, "upload": the upload to DNAnexus), shared equally
+between the transfers of that stage running
+- nice, ionice_class and ionice_level: CPU and I/O priority of the commands which read or compress project data (rsync, tar, md5sum and
+the upload agent), on the genomics server and the archer server
+- compression_workers: threads compressing project tars (in place of config.compression_workers)
+- adaptive: True to adjust the caps and compression workers to the load of the servers (see below)
+
+Caps are applied with rsync --bwlimit (set when the copy starts), the upload agent --throttle and, for uploads made with dxpy, a
+RateLimiter which spaces the parts uploaded.
+In an adaptive profile the 1 minute load average per CPU of the genomics server and the archer server is measured
+(at most every config.throttle_adjust_interval seconds). While either is above throttle_load_high the caps and compression workers
+are halved (down to config.throttle_min_factor of the profile's limits), and they are raised again while both are below throttle_load_low.
+"""
+
+import collections, contextlib, datetime, os, threading, time
+import archer_archive_config as config
+
+
+def _minutes(hours_minutes):
+	hours, minutes = hours_minutes.split(":")
+	return int(hours) * 60 + int(minutes)
+
+
+def profile_applies(profile, now):
+	"""
+	Returns True if the profile covers the datetime now. start and end are "HH:MM" (end before start spans midnight, end equal to start
+	is the whole day),
+	days the days of the week (0 Monday - 6 Sunday, all days if not given)
+	"""
+	if "days" in profile and now.weekday() not in profile["days"]:
+		return False
+	minute = now.hour * 60 + now.minute
+	start, end = _minutes(profile["start"]), _minutes(profile["end"])
+	if start < end:
+		return start <= minute < end
+	return minute >= start or minute < end
+
+
+def load_per_cpu():
+	"""
+	Returns the 1 minute load average of this server divided by the number of CPUs
+	"""
+	return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+class RateLimiter():
+	"""
+	Limits the average rate data is sent at to rate() KiB/s (not limited while rate() returns None)
+	wait() is called with the size of each block before it is sent, and sleeps until the blocks before it would have been sent at the rate
+	"""
+	def __init__(self, rate):
+		self.rate = rate
+		self._lock = threading.Lock()
+		self._next_send = time.monotonic()
+
+	def wait(self, bytes_count):
+		kbps = self.rate()
+		with self._lock:
+			now = time.monotonic()
+			if not kbps:
+				self._next_send = now
+				return
+			send_at = max(now, self._next_send)
+			self._next_send = send_at + bytes_count / (kbps * 1024.0)
+		time.sleep(send_at - now)
+
+
+class Throttle():
+	"""
+	Limits in use at the current time of day, adjusted for the load of the servers
+	archer_load is a function returning the load per CPU of the archer server (or None if it can't be measured) and log a function
+	called with a message when the profile or the load factor changes
+	"""
+	def __init__(self, profiles=None, default_profile=None, archer_load=None, log=None):
+		self.profiles = config.throttle_profiles if profiles is None else profiles
+		self.default_profile = config.throttle_default_profile if default_profile is None else default_profile
+		self.archer_load = archer_load
+		self.log = log
+		# limits are multiplied by this factor, lowered when the servers are busy
+		self.factor = 1.0
+		self.profile_name = None
+		self._measured_at = 0
+		self._lock = threading.Lock()
+		self._measuring = threading.Lock()
+		# number of transfers of each stage running
+		self._active = collections.Counter()
+
+	def profile(self, now=None):
+		"""
+		Returns the limits in use at now (by default the current time): the default profile updated with the profile covering now
+		"""
+		now = now or datetime.datetime.now()
+		profile = dict(self.default_profile)
+		for time_profile in self.profiles:
+			if profile_applies(time_profile, now):
+				profile.update(time_profile)
+				break
+		if profile.get("name") != self.profile_name:
+			self.profile_name = profile.get("name")
+			self._log("Throttle profile '%s' in use: %s" % (self.profile_name, self.describe(profile)))
+		return profile
+
+	def describe(self, profile):
+		return ", ".join("%s %s" % (key, profile[key]) for key in
+			("bandwidth_kbps", "stage_bandwidth_kbps", "nice", "ionice_class", "ionice_level", "compression_workers", "adaptive")
+			if profile.get(key) not in (None, {})) or "no limits"
+
+	def _log(self, message):
+		if self.log:
+			self.log(message)
+
+	def load_factor(self, profile):
+		"""
+		Returns the factor the limits of the profile are multiplied by (1 if the profile is not adaptive), measuring the load of the
+		servers if throttle_adjust_interval has passed. Only one thread measures the load at a time, the others use the last factor
+		"""
+		if not profile.get("adaptive"):
+			return 1.0
+		if time.time() - self._measured_at < config.throttle_adjust_interval or not self._measuring.acquire(blocking=False):
+			return self.factor
+		try:
+			self._measured_at = time.time()
+			loads = [load_per_cpu()]
+			if self.archer_load is not None:
+				loads.append(self.archer_load())
+			load = max(load for load in loads if load is not None)
+			if load > config.throttle_load_high:
+				factor = max(config.throttle_min_factor, self.factor / 2)
+			elif load < config.throttle_load_low:
+				factor = min(1.0, self.factor * 2)
+			else:
+				factor = self.factor
+			if factor != self.factor:
+				self._log("Load per CPU %.2f: throttle limits set to %s of the profile's limits" % (load, factor))
+				self.factor = factor
+		finally:
+			self._measuring.release()
+		return self.factor
+
+	def bandwidth_kbps(self, stage):
+		"""
+		Returns the cap (KiB/s) on one transfer of the stage, or None if not capped
+		The stage cap is shared between the transfers of the stage running, and the global cap between all transfers running
+		"""
+		profile = self.profile()
+		with self._lock:
+			stage_transfers = max(1, self._active[stage])
+			transfers = max(1, sum(self._active.values()))
+		caps = []
+		if (profile.get("stage_bandwidth_kbps") or {}).get(stage):
+			caps.append(profile["stage_bandwidth_kbps"][stage] / stage_transfers)
+		if profile.get("bandwidth_kbps"):
+			caps.append(profile["bandwidth_kbps"] / transfers)
+		if not caps:
+			return None
+		return max(1, int(min(caps) * self.load_factor(profile)))
+
+	@contextlib.contextmanager
+	def transfer(self, stage):
+		"""
+		Count a transfer of the stage as running while in the context, so the bandwidth caps are shared with it
+		"""
+		with self._lock:
+			self._active[stage] += 1
+		try:
+			yield
+		finally:
+			with self._lock:
+				self._active[stage] -= 1
+
+	def rate_limiter(self, stage):
+		"""
+		Returns a RateLimiter for a transfer of the stage, following the current caps
+		"""
+		return RateLimiter(lambda: self.bandwidth_kbps(stage))
+
+	def priority_prefix(self):
+		"""
+		Returns the prefix (nice and ionice) which runs a command at the CPU and I/O priority of the current profile, e.g.
+		"nice -n 19 ionice -c 3 ", or "" if no priority is set
+		"""
+		profile = self.profile()
+		prefix = ""
+		if profile.get("nice") is not None:
+			prefix += "nice -n %s " % (profile["nice"])
+		if profile.get("ionice_class") is not None:
+			prefix += "ionice -c %s " % (profile["ionice_class"])
+			# a level can only be given for the realtime (1) and best effort (2) classes
+			if profile.get("ionice_level") is not None and profile["ionice_class"] in (1, 2):
+				prefix += "-n %s " % (profile["ionice_level"])
+		return prefix
+
+	def compression_workers(self):
+		"""
+		Returns the number of threads to compress project tars on
+		"""
+		profile = self.profile()
+		return max(1, int((profile.get("compression_workers") or config.compression_workers) * self.load_factor(profile)))
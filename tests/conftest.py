@@ -0,0 +1,13 @@
+import os, sys
+import pytest
+
+# the archer archive modules are at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import archer_archive_config as config
+
+
+@pytest.fixture(autouse=True)
+def nexus_api_key(monkeypatch):
+	# the DNAnexus token is read from a file which is not there when the tests are run (set in the module dict, as getattr would read the file)
+	monkeypatch.setitem(vars(config), "Nexus_API_Key", "test-token")
@@ -0,0 +1,96 @@
+import sys, threading, time
+import pytest
+import archer_archive_async
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 8), reason="the asyncio subprocess engine needs python 3.8 or later")
+
+
+@pytest.fixture
+def runner():
+	runner = archer_archive_async.AsyncRunner(timeouts={"other": 30, "slow": 0.5}, output_limit=1024)
+	yield runner
+	runner.close()
+
+
+def test_output_and_exit_status(runner):
+	result = runner.run("echo hello; echo oops >&2; printf 'a\\r\\nb'; exit 3")
+	assert result.stdout == "hello\na\nb"
+	assert result.stderr == "oops\n"
+	assert (result.returncode, result.timed_out, result.truncated) == (3, False, False)
+
+
+def test_stdin(runner):
+	result = runner.run("tr a-z A-Z; echo $?", stdin="abc\n" * 100)
+	assert result.stdout == "ABC\n" * 100 + "0\n"
+	assert result.returncode == 0
+
+
+def test_command_exits_before_reading_stdin(runner):
+	# as when ssh fails before the remote command reads its input, the exit status is returned rather than an error
+	for _ in range(20):
+		result = runner.run("exit 7", stdin="x" * (1024 * 1024))
+		assert result.returncode == 7
+
+
+def test_timeout_kills_the_command_and_its_children(runner, tmp_path):
+	marker = tmp_path / "finished"
+	start = time.time()
+	result = runner.run("(sleep 2; touch %s) & sleep 10" % (marker), stage="slow")
+	assert time.time() - start < 5
+	assert result.timed_out and result.returncode is None
+	assert "timed out after 0.5 seconds" in result.stderr
+	time.sleep(2.5)
+	assert not marker.exists()
+
+
+def test_output_limit_keeps_the_last_lines(runner):
+	result = runner.run("for i in $(seq 1 1000); do echo line $i; done; echo 0")
+	assert result.truncated
+	assert result.stdout.endswith("line 1000\n0\n")
+	assert len(result.stdout) <= 1024
+	assert "stdout truncated" in result.stderr
+
+
+def test_long_line_without_limit():
+	runner = archer_archive_async.AsyncRunner(timeouts={}, output_limit=64 * 1024 * 1024)
+	try:
+		result = runner.run("head -c 10000000 /dev/zero | tr '\\0' x; echo; echo 0")
+		assert result.stdout == "x" * 10000000 + "\n0\n"
+		assert not result.truncated
+	finally:
+		runner.close()
+
+
+def test_commands_from_many_threads(runner):
+	results = {}
+
+	def run(index):
+		results[index] = runner.run("sleep 0.2; echo %s" % (index)).stdout
+	threads = [threading.Thread(target=run, args=(index,)) for index in range(10)]
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	# the commands run at the same time
+	assert time.time() - start < 1.5
+	assert results == {index: "%s\n" % (index) for index in range(10)}
+
+
+def test_close_kills_running_commands(runner):
+	errors = []
+
+	def run():
+		try:
+			runner.run("sleep 30")
+		except BaseException as error:
+			errors.append(error)
+	thread = threading.Thread(target=run)
+	thread.start()
+	time.sleep(0.3)
+	start = time.time()
+	runner.close()
+	thread.join()
+	assert time.time() - start < 5
+	# the thread waiting for the command is told it was cancelled
+	assert len(errors) == 1
@@ -0,0 +1,77 @@
+import gzip, hashlib, io, os, random, subprocess, tarfile
+import pytest
+import archer_archive_compress as compress
+
+
+def fastq_like(size):
+	bases = random.Random(size).choices(b"ACGT", k=size)
+	return bytes(bases)
+
+
+@pytest.mark.parametrize("size", [0, 1, 1023, 1024, 1025, 10 * 1024 + 7])
+@pytest.mark.parametrize("workers", [1, 3])
+def test_parallel_gzip_round_trip(size, workers):
+	data = fastq_like(size)
+	output = io.BytesIO()
+	with compress.ParallelGzipWriter(output, workers, level=6, block_size=1024) as writer:
+		# written in pieces which don't line up with the blocks
+		for start in range(0, size, 700):
+			writer.write(data[start:start + 700])
+	assert gzip.decompress(output.getvalue()) == data
+	assert writer.size == size
+
+
+def test_output_read_by_gzip_command():
+	data = fastq_like(300 * 1024)
+	output = io.BytesIO()
+	compress.compress_stream(io.BytesIO(data), output, 4, block_size=64 * 1024)
+	result = subprocess.run(["gzip", "-dc"], input=output.getvalue(), stdout=subprocess.PIPE, check=True)
+	assert result.stdout == data
+
+
+def test_gzip_stream_not_completed_after_error():
+	output = io.BytesIO()
+	with pytest.raises(RuntimeError):
+		with compress.ParallelGzipWriter(output, 2, block_size=1024) as writer:
+			writer.write(fastq_like(5000))
+			raise RuntimeError("source failed")
+	with pytest.raises(EOFError):
+		gzip.decompress(output.getvalue())
+
+
+def test_md5_writer():
+	output = io.BytesIO()
+	writer = compress.MD5Writer(output)
+	writer.write(b"abc")
+	writer.write(b"def")
+	assert output.getvalue() == b"abcdef"
+	assert writer.hexdigest() == hashlib.md5(b"abcdef").hexdigest()
+
+
+def test_tar_member_checksums(tmp_path):
+	project = tmp_path / "5001"
+	(project / "results").mkdir(parents=True)
+	files = {"5001/ADX1_S1_R1_001.fastq.gz": os.urandom(200 * 1024), "5001/results/report.txt": b"report", "5001/empty": b""}
+	for path, data in files.items():
+		(tmp_path / path).write_bytes(data)
+	os.symlink("ADX1_S1_R1_001.fastq.gz", str(project / "link"))
+	archive = io.BytesIO()
+	with tarfile.open(fileobj=archive, mode="w") as tar:
+		tar.add(str(project), arcname="5001")
+	member_md5s = {}
+	output = io.BytesIO()
+	compress.compress_stream(io.BytesIO(archive.getvalue()), output, 2, block_size=64 * 1024, member_md5s=member_md5s)
+	# the whole archive is compressed, including the padding after the last member
+	assert gzip.decompress(output.getvalue()) == archive.getvalue()
+	assert member_md5s == {path: hashlib.md5(data).hexdigest() for path, data in files.items()}
+
+
+def test_truncated_tar_raises():
+	archive = io.BytesIO()
+	with tarfile.open(fileobj=archive, mode="w") as tar:
+		info = tarfile.TarInfo("5001/a")
+		data = os.urandom(10000)
+		info.size = len(data)
+		tar.addfile(info, io.BytesIO(data))
+	with pytest.raises(tarfile.ReadError):
+		compress.copy_tar(io.BytesIO(archive.getvalue()[:5000]), io.BytesIO())
@@ -0,0 +1,91 @@
+import csv, json
+import archer_archive_inventory as inventory
+
+
+def record(section, file_type, size, path, target="", mtime="1700000000.5"):
+	return "%s\t%s\t%s\t%s\t%s\t%s\0" % (section, file_type, size, mtime, target, path)
+
+
+def inventory_output():
+	return "".join([
+		record(inventory.ANALYSIS, "d", 4096, "5001"),
+		record(inventory.ANALYSIS, "f", 100, "5001/ADX30001_S1_R1_001.fastq.gz"),
+		record(inventory.ANALYSIS, "f", 50, "5001/results/report.pdf"),
+		record(inventory.ANALYSIS, "l", 20, "5001/ADX30001_S1_R2_001.fastq.gz", target="/watched/ADX30001_S1_R2_001.fastq.gz"),
+		record(inventory.ANALYSIS, "f", 1, "5001/5001.tar.gz"),
+		record(inventory.ANALYSIS, "d", 4096, "5002"),
+		record(inventory.ANALYSIS, "d", 4096, "5002/empty folder"),
+		record(inventory.ANALYSIS, "f", 10, "notes.txt"),
+		record(inventory.PICKED_UP, "f", 300, "ADX30001_S1_R1_001.fastq.gz"),
+		record(inventory.PICKED_UP, "f", 400, "ADX30001_S1_R2_001.fastq.gz"),
+		record(inventory.PICKED_UP, "f", 500, "ADX300010_S1_R1_001.fastq.gz"),
+	]) + "123456789\n"
+
+
+def test_projects_and_files_are_parsed():
+	archer = inventory.ArcherInventory.from_inventory_output(inventory_output())
+	# top level files are not projects, empty project folders are
+	assert archer.project_names() == ["5001", "5002"]
+	assert archer.archer_free_bytes == 123456789
+	records = archer.project_file_records("5001")
+	assert records["results/report.pdf"] == inventory.FileRecord("f", 50, 1700000000.5, "")
+	assert records["ADX30001_S1_R2_001.fastq.gz"].target == "/watched/ADX30001_S1_R2_001.fastq.gz"
+	assert sorted(archer.project_files("5001")) == ["5001.tar.gz", "ADX30001_S1_R1_001.fastq.gz", "ADX30001_S1_R2_001.fastq.gz"]
+	assert archer.project_file_records("5002") == {"empty folder": inventory.FileRecord("d", 4096, 1700000000.5, "")}
+
+
+def test_paths_with_tabs_and_newlines():
+	out = record(inventory.ANALYSIS, "d", 4096, "5003") + record(inventory.ANALYSIS, "f", 7, "5003/odd\tname\nhere") + "0\n"
+	archer = inventory.ArcherInventory.from_inventory_output(out)
+	assert list(archer.project_file_records("5003")) == ["odd\tname\nhere"]
+
+
+def test_project_queries():
+	archer = inventory.ArcherInventory.from_inventory_output(inventory_output())
+	assert archer.is_archived("5001")
+	assert not archer.is_archived("5002")
+	assert archer.project_adx("5001") == "ADX30001"
+	assert archer.project_adx("5002") is None
+	# symlinks are not counted or copied
+	assert archer.project_bytes("5001") == 151
+	assert list(archer.project_fastq_records("5001")) == ["ADX30001_S1_R1_001.fastq.gz"]
+	# FASTQs of ADX300010 do not belong to ADX30001
+	assert archer.project_fastqs("ADX30001") == ["ADX30001_S1_R1_001.fastq.gz", "ADX30001_S1_R2_001.fastq.gz"]
+	assert archer.fastq_bytes("ADX30001") == 700
+
+
+def test_missing_free_space():
+	archer = inventory.ArcherInventory.from_inventory_output(record(inventory.ANALYSIS, "d", 4096, "5001"))
+	assert archer.archer_free_bytes is None
+	assert archer.project_names() == ["5001"]
+
+
+def test_locations_files(tmp_path):
+	archer = inventory.ArcherInventory.from_inventory_output(inventory_output())
+	archived_fastqs = {"ADX30001_S1_R1_001.fastq.gz": {"md5": "0" * 32, "archer_project_id": "4001", "path": "4001/ADX1_S1_R1_001.fastq.gz",
+		"dnanexus_project_id": "project-1", "dnanexus_file_id": "file-1"}}
+	rows = archer.locations("5001", "ADX30001", archived_fastqs)
+	assert [(row["section"], row["path"]) for row in rows] == [
+		(inventory.ANALYSIS, "ADX30001_S1_R1_001.fastq.gz"), (inventory.ANALYSIS, "results/report.pdf"),
+		(inventory.ANALYSIS, "ADX30001_S1_R2_001.fastq.gz"), (inventory.ANALYSIS, "5001.tar.gz"),
+		(inventory.PICKED_UP, "ADX30001_S1_R1_001.fastq.gz"), (inventory.PICKED_UP, "ADX30001_S1_R2_001.fastq.gz")]
+	assert rows[0]["stored_file_id"] == "file-1"
+	# the FASTQ of the same name in picked_up_files is not the archived one
+	assert rows[4]["stored_file_id"] == ""
+	folders = {inventory.ANALYSIS: "/var/www/analysis/5001", inventory.PICKED_UP: "/watched/user@nhs.net/picked_up_files"}
+	json_path, tsv_path = inventory.write_locations(str(tmp_path / "5001_fastq_loc"), "5001", "ADX30001", folders, rows)
+	with open(json_path) as json_file:
+		written = json.load(json_file)
+	assert written["folders"] == folders
+	assert len(written["files"]) == 6
+	with open(tsv_path, newline="") as tsv_file:
+		tsv_rows = list(csv.DictReader(tsv_file, delimiter="\t"))
+	assert list(tsv_rows[0]) == inventory.LOCATION_FIELDS
+	assert tsv_rows[0]["md5"] == "0" * 32
+
+
+def test_commands_quote_folders():
+	command = inventory.inventory_command("/var/www/analysis", "/watched/user@nhs.net/picked up")
+	assert "find /var/www/analysis -mindepth 1" in command
+	assert "find '/watched/user@nhs.net/picked up' -mindepth 1" in command
+	assert "'/watched/user@nhs.net/picked up'" in inventory.poll_command("/var/www/analysis", "/watched/user@nhs.net/picked up")
@@ -0,0 +1,87 @@
+import archer_archive_ledger as ledger_module
+
+
+def open_ledger(tmp_path, import_path=None):
+	return ledger_module.ArchivedProjectsLedger(str(tmp_path / "ledger.sqlite"), import_path)
+
+
+def test_state_is_kept_until_cleared(tmp_path):
+	ledger = open_ledger(tmp_path)
+	assert ledger.project_state("5001") == (None, {})
+	ledger.save_state("5001", "listed", {"project_adx": "ADX30001", "project_bytes": 100})
+	ledger.save_state("5001", "tarred", {"project_adx": "ADX30001", "project_bytes": 100, "tar_md5": "abc"})
+	ledger.close()
+	# a later run resumes from the last step saved
+	ledger = open_ledger(tmp_path)
+	step, state = ledger.project_state("5001")
+	assert step == "tarred"
+	assert state == {"project_adx": "ADX30001", "project_bytes": 100, "tar_md5": "abc"}
+	ledger.clear_state("5001")
+	assert ledger.project_state("5001") == (None, {})
+	ledger.close()
+
+
+def test_step_reached():
+	assert not ledger_module.step_reached(None, "listed")
+	assert ledger_module.step_reached("tarred", "copied")
+	assert ledger_module.step_reached("tarred", "tarred")
+	assert not ledger_module.step_reached("tarred", "uploaded")
+	assert ledger_module.step_reached("local_cleaned", "ledgered")
+
+
+def test_archived_projects(tmp_path):
+	ledger = open_ledger(tmp_path)
+	assert not ledger.is_archived("5001")
+	ledger.record("5001", "ADX30001", "project-1", "2026-01-01 00:00:00", 1000, 250)
+	assert ledger.is_archived("5001")
+	assert ledger.compression_ratio() == 0.25
+	# a project recorded by another process is found by primary key
+	other = open_ledger(tmp_path)
+	other.record("5002", "ADX30002")
+	assert ledger.is_archived("5002")
+	other.close()
+	ledger.close()
+
+
+def test_text_file_imported_into_new_ledger_only(tmp_path):
+	ids_path = tmp_path / "archived_ids.txt"
+	ids_path.write_text("4001\n4002\n\n")
+	ledger = open_ledger(tmp_path, str(ids_path))
+	assert ledger.is_archived("4001") and ledger.is_archived("4002")
+	ledger.close()
+	ids_path.write_text("4003\n")
+	ledger = open_ledger(tmp_path, str(ids_path))
+	assert not ledger.is_archived("4003")
+	ledger.close()
+
+
+def test_pending_fastq_deletions(tmp_path):
+	ledger = open_ledger(tmp_path)
+	ledger.queue_fastq_deletions("5001", "ADX30001", ["/picked/ADX30001_S1.fastq.gz", "/picked/ADX30001_S2.fastq.gz"])
+	ledger.queue_fastq_deletions("5002", "ADX30002", ["/picked/ADX30002_S1.fastq.gz"])
+	# queueing a path again (e.g. a project resumed from before fastqs_queued) does not duplicate it
+	ledger.queue_fastq_deletions("5001", "ADX30001", ["/picked/ADX30001_S1.fastq.gz"])
+	pending = ledger.pending_fastq_deletions()
+	assert sorted(pending) == [("/picked/ADX30001_S1.fastq.gz", "5001", "ADX30001"), ("/picked/ADX30001_S2.fastq.gz", "5001", "ADX30001"),
+		("/picked/ADX30002_S1.fastq.gz", "5002", "ADX30002")]
+	# only the paths deleted leave the queue, the others are kept for the next run
+	ledger.fastq_deletions_done(["/picked/ADX30001_S1.fastq.gz", "/picked/ADX30002_S1.fastq.gz"])
+	ledger.close()
+	ledger = open_ledger(tmp_path)
+	assert ledger.pending_fastq_deletions() == [("/picked/ADX30001_S2.fastq.gz", "5001", "ADX30001")]
+	ledger.fastq_deletions_done([])
+	assert len(ledger.pending_fastq_deletions()) == 1
+	ledger.close()
+
+
+def test_archived_fastqs_keep_first_record(tmp_path):
+	ledger = open_ledger(tmp_path)
+	assert ledger.archived_fastq_sizes() == set()
+	ledger.record_archived_fastqs("5001", "project-1", "file-1", [("a" * 32, 100, "5001/ADX1_S1.fastq.gz"), ("b" * 32, 200, "5001/ADX1_S2.fastq.gz")])
+	ledger.record_archived_fastqs("5002", "project-2", "file-2", [("a" * 32, 100, "5002/ADX2_S1.fastq.gz")])
+	assert ledger.archived_fastq_sizes() == {100, 200}
+	assert ledger.find_archived_fastq("a" * 32, 100) == {"archer_project_id": "5001", "path": "5001/ADX1_S1.fastq.gz",
+		"dnanexus_project_id": "project-1", "dnanexus_file_id": "file-1"}
+	# the same checksum with a different size is a different FASTQ
+	assert ledger.find_archived_fastq("a" * 32, 101) is None
+	ledger.close()
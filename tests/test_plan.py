@@ -0,0 +1,50 @@
+import archer_archive_dnanexus as dnanexus
+import archer_archive_fakes as fakes
+import archer_archive_inventory as inventory
+import archer_archive_ledger as ledger_module
+import archer_archive_plan as plan
+
+
+def record(file_type, size, path):
+	return "%s\t%s\t%s\t1700000000.0\t\t%s\0" % (inventory.ANALYSIS, file_type, size, path)
+
+
+def planner(tmp_path, projects):
+	archer = inventory.ArcherInventory.from_inventory_output("".join([
+		record("d", 4096, "5001"), record("f", 1000, "5001/ADX30001_S1_R1_001.fastq.gz"), record("f", 1, "5001/5001.tar.gz"),
+		record("d", 4096, "5002"), record("f", 1000, "5002/ADX30002_S1_R1_001.fastq.gz"),
+		# the folder of a project resumed after its files were removed from the archer server
+		record("d", 4096, "5003"),
+	]) + "0\n")
+	ledger = ledger_module.ArchivedProjectsLedger(str(tmp_path / "ledger.sqlite"))
+	index = dnanexus.DNAnexusProjectIndex(fakes.FakeProjectBackend(projects), str(tmp_path / "projects.json"))
+	return plan.ArchivePlanner(archer, ledger, index, "staged", throughput={"copy": 1, "tar": 1, "upload": 1}, compression_ratio=0.5)
+
+
+def test_new_and_unarchived_projects(tmp_path):
+	planner_ = planner(tmp_path, [("project-1", "002_ADX30001_ARCHER")])
+	row = planner_.plan_project("5001")
+	assert (row["action"], row["project_adx"], row["dnanexus_project_id"]) == ("archive", "ADX30001", "project-1")
+	assert (row["bytes_freed"], row["upload_bytes"]) == (1001, 500)
+	assert planner_.plan_project("5002")["action"] == "skip: not archived on Archer platform"
+	planner_.ledger.record("5001", "ADX30001")
+	assert planner_.plan_project("5001")["action"] == "skip: previously archived"
+
+
+def test_resumed_project_uses_saved_state(tmp_path):
+	planner_ = planner(tmp_path, [("project-3", "002_ADX30003_ARCHER")])
+	planner_.ledger.save_state("5003", "remote_cleaned", {"project_adx": "ADX30003", "project_bytes": 5000, "fastq_bytes": 3000,
+		"copy_bytes": 5000, "uploaded_bytes": 2000})
+	row = planner_.plan_project("5003")
+	assert (row["action"], row["project_adx"], row["bytes_freed"]) == ("resume after remote_cleaned", "ADX30003", 8000)
+	# nothing left to copy, tar or upload
+	assert (row["upload_bytes"], row["estimated_seconds"]) == (None, 0)
+
+
+def test_lookup_error_fails_the_project(tmp_path):
+	planner_ = planner(tmp_path, [])
+
+	def list_projects():
+		raise RuntimeError("401 unauthorised")
+	planner_.dnanexus_projects.backend.list_projects = list_projects
+	assert planner_.plan_project("5001")["action"] == "fail: unable to list DNAnexus projects: 401 unauthorised"
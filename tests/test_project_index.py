@@ -0,0 +1,29 @@
+import time
+import archer_archive_dnanexus as dnanexus
+import archer_archive_fakes as fakes
+
+
+def test_project_index(tmp_path):
+	backend = fakes.FakeProjectBackend([("project-1", "002_ADX30001_ARCHER"), ("project-2", "002_ADX30002_ADX30003_ARCHER"),
+		("project-3", "003_ADX30003_ARCHER")])
+	cache_path = str(tmp_path / "projects.json")
+	index = dnanexus.DNAnexusProjectIndex(backend, cache_path, ttl=60, min_refresh_interval=60)
+	assert index.find("ADX30001") == [["project-1", "002_ADX30001_ARCHER"]]
+	assert len(index.find("ADX30003")) == 2
+	# not found: the index was made too recently to be remade
+	assert index.find("ADX30004") == []
+	assert backend.list_calls == 1
+	# a later run uses the cache file
+	later_run = dnanexus.DNAnexusProjectIndex(backend, cache_path, ttl=60, min_refresh_interval=60)
+	assert later_run.find("ADX30002") == [["project-2", "002_ADX30002_ADX30003_ARCHER"]]
+	assert backend.list_calls == 1
+
+
+def test_project_index_expires_in_long_running_process(tmp_path):
+	backend = fakes.FakeProjectBackend([("project-1", "002_ADX30001_ARCHER")])
+	index = dnanexus.DNAnexusProjectIndex(backend, str(tmp_path / "projects.json"), ttl=0.1, min_refresh_interval=60)
+	index.find("ADX30001")
+	backend.projects = [("project-9", "002_ADX30001_ARCHER")]
+	time.sleep(0.2)
+	assert index.find("ADX30001") == [["project-9", "002_ADX30001_ARCHER"]]
+	assert backend.list_calls == 2
@@ -0,0 +1,108 @@
+import hashlib, io, os
+import pytest
+import archer_archive_config as config
+import archer_archive_dnanexus as dnanexus
+import archer_archive_fakes as fakes
+
+PROJECT_ID = "project-%024d" % (1)
+PART_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def local_file(tmp_path):
+	# 3 full parts and a partial one
+	data = os.urandom(PART_SIZE * 3 + 1000)
+	path = tmp_path / "5001.tar.gz"
+	path.write_bytes(data)
+	return str(path), data
+
+
+def fake_server(monkeypatch, **settings):
+	pytest.importorskip("dxpy")
+	server = fakes.FakeDNAnexusServer([(PROJECT_ID, "002_ADX30001_ARCHER")], **settings).start()
+	monkeypatch.setattr(config, "dnanexus_api_server", server.api_server_info())
+	return server
+
+
+def upload(path, **settings):
+	return dnanexus.upload_file(path, PROJECT_ID, part_size=PART_SIZE, workers=2, retries=2, retry_backoff=0, **settings)
+
+
+def test_upload_file(monkeypatch, local_file):
+	path, data = local_file
+	server = fake_server(monkeypatch)
+	try:
+		result = upload(path, expected_md5=hashlib.md5(data).hexdigest())
+		assert result.error is None
+		assert (result.parts, result.retries, result.bytes) == (4, 0, len(data))
+		assert result.md5 == hashlib.md5(data).hexdigest()
+		assert server.file_contents(result.file_id) == data
+		assert server.files[result.file_id]["state"] == "closed"
+		assert server.files[result.file_id]["properties"] == {"md5": result.md5}
+	finally:
+		server.stop()
+
+
+def test_failed_parts_are_retried(monkeypatch, local_file):
+	path, data = local_file
+	server = fake_server(monkeypatch, fail_uploads=2)
+	try:
+		result = upload(path)
+		assert result.error is None
+		assert result.retries == 2
+		assert server.file_contents(result.file_id) == data
+	finally:
+		server.stop()
+
+
+def test_corrupt_parts_are_uploaded_again(monkeypatch, local_file):
+	path, data = local_file
+	server = fake_server(monkeypatch, corrupt_parts=[("5001.tar.gz", 2), ("5001.tar.gz", 4)])
+	try:
+		result = upload(path)
+		assert result.error is None
+		assert result.retries == 2
+		assert server.file_contents(result.file_id) == data
+	finally:
+		server.stop()
+
+
+def test_upload_fails_when_retries_run_out(monkeypatch, local_file):
+	path, _ = local_file
+	server = fake_server(monkeypatch, fail_uploads=100)
+	try:
+		result = upload(path)
+		assert result.error
+		assert result.file_id is None
+		# the incomplete file is removed from the project
+		assert server.files == {}
+	finally:
+		server.stop()
+
+
+def test_file_changed_since_it_was_made(monkeypatch, local_file):
+	path, _ = local_file
+	server = fake_server(monkeypatch)
+	try:
+		result = upload(path, expected_md5="0" * 32)
+		assert "does not match" in result.error
+		assert server.files == {}
+	finally:
+		server.stop()
+
+
+def test_upload_stream(monkeypatch):
+	server = fake_server(monkeypatch)
+	data = os.urandom(PART_SIZE * 2 + 10)
+	try:
+		file_id, md5, bytes_uploaded = dnanexus.upload_stream(io.BytesIO(data), "5001.tar.gz", PROJECT_ID, PART_SIZE)
+		assert (md5, bytes_uploaded) == (hashlib.md5(data).hexdigest(), len(data))
+		assert server.file_contents(file_id) == data
+
+		def stream_ended_early():
+			raise RuntimeError("tar failed")
+		with pytest.raises(RuntimeError):
+			dnanexus.upload_stream(io.BytesIO(data), "5002.tar.gz", PROJECT_ID, PART_SIZE, stream_ended_early)
+		assert list(server.files) == [file_id]
+	finally:
+		server.stop()